@@ -82,6 +82,7 @@ static PyGetSetDef eflags_getseters[] = {
     { "tf", (getter)eflags_get_flag, (setter)eflags_set_flag, "Trap flag", (void *)8 },
     { "df", (getter)eflags_get_flag, (setter)eflags_set_flag, "Direction flag", (void *)10 },
     { "of", (getter)eflags_get_flag, (setter)eflags_set_flag, "Overflow flag", (void *)11 },
+    { "rf", (getter)eflags_get_flag, (setter)eflags_set_flag, "Resume flag", (void *)16 },
     {NULL}  /* Sentinel */
 };
 
@@ -269,6 +270,46 @@ context_get_eflags(PyBones_ContextObject *self, void *closure)
     return (PyObject *)self->eflags;
 }
 
+PyDoc_STRVAR(pack__doc__,
+"pack(self)\n\n\
+Returns the registers as a string of u32 words, in eventlog.CONTEXT_REGISTERS order.");
+
+static PyObject *
+context_pack(PyBones_ContextObject *self)
+{
+    PCONTEXT c = &self->ctx;
+    DWORD words[22];
+
+    words[0] = c->Dr0;
+    words[1] = c->Dr1;
+    words[2] = c->Dr2;
+    words[3] = c->Dr3;
+    words[4] = c->Dr6;
+    words[5] = c->Dr7;
+    words[6] = c->SegGs;
+    words[7] = c->SegFs;
+    words[8] = c->SegEs;
+    words[9] = c->SegDs;
+    words[10] = c->SegCs;
+    words[11] = c->SegSs;
+    words[12] = c->Edi;
+    words[13] = c->Esi;
+    words[14] = c->Ebx;
+    words[15] = c->Ecx;
+    words[16] = c->Edx;
+    words[17] = c->Eax;
+    words[18] = c->Ebp;
+    words[19] = c->Esp;
+    words[20] = c->Eip;
+    words[21] = self->eflags->All;
+    return PyString_FromStringAndSize((const char *)words, sizeof(words));
+}
+
+static PyMethodDef context_methods[] = {
+    { "pack", (PyCFunction)context_pack, METH_NOARGS, pack__doc__ },
+    {NULL}  /* Sentinel */
+};
+
 static PyGetSetDef context_getseters[] = {
     /* name, get, set, doc, closure */
     { "dr0", (getter)context_get_reg, (setter)context_set_reg, "DR0", (void *)(REG_LONG32 | offsetof(CONTEXT, Dr0)) },
@@ -329,7 +370,7 @@ PyTypeObject PyBones_Context_Type = {
     0,  /* tp_weaklistoffset */
     0,  /* tp_iter */
     0,  /* tp_iternext */
-    0,  /* tp_methods */
+    context_methods,  /* tp_methods */
     0,  /* tp_members */
     context_getseters,  /* tp_getset */
     0,  /* tp_base */
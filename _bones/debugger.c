@@ -359,9 +359,12 @@ debugger_wait_event(PyBones_DebuggerObject *self, PyObject *args)
         timeout_ptr = &timeout;
     }
 
+    /* Let other threads (e.g. other debuggers) run while waiting */
+    Py_BEGIN_ALLOW_THREADS
     do
         status = NtWaitForDebugEvent(self->dbgui_object, TRUE, timeout_ptr, &info);
     while (status == STATUS_ALERTED || status == STATUS_USER_APC);
+    Py_END_ALLOW_THREADS
 
     if (status == STATUS_TIMEOUT) {
         Py_RETURN_FALSE;
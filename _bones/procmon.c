@@ -4,9 +4,20 @@
 #include "ntdll.h"
 #include "_bones.h"
 
+typedef struct {
+    ULONG process_id;
+    PSYSTEM_PROCESS_INFORMATION entry;
+} procmon_index_slot;
+
 typedef struct {
     PyObject_HEAD
     PyObject *processes; /* A dict mapping process id -> info object */
+    /* The snapshot buffer; kept across updates, grown as needed */
+    PSYSTEM_PROCESS_INFORMATION buffer;
+    ULONG buffer_length;
+    /* Open addressing hash of the snapshot entries by process id */
+    procmon_index_slot *index;
+    ULONG index_size; /* Always a power of two */
 } PyBones_ProcessMonitorObject;
 
 
@@ -14,6 +25,12 @@ static void
 procmon_dealloc(PyBones_ProcessMonitorObject* self)
 {
     Py_XDECREF(self->processes);
+    if (self->buffer) {
+        HeapFree(GetProcessHeap(), 0, self->buffer);
+    }
+    if (self->index) {
+        HeapFree(GetProcessHeap(), 0, self->index);
+    }
     self->ob_type->tp_free((PyObject*)self);
 }
 
@@ -49,23 +66,118 @@ procmon_init(PyBones_ProcessMonitorObject *self, PyObject *args, PyObject *kwds)
 
 PyDoc_STRVAR(update__doc__,
 "update(self)\n\n\
-Update the counters.");
+Update the counters.\n\
+Calls self._on_update(process_ids, contexts, kernel_times, user_times,\n\
+resources) once, with parallel lists for the tracked processes found\n\
+running; resources holds (working_set, private_bytes, handle_count,\n\
+thread_count) tuples.");
 
-static PSYSTEM_PROCESS_INFORMATION
-procmon_lookup(PSYSTEM_PROCESS_INFORMATION pBuffer, ULONG process_id)
+/* Take a fresh snapshot into self->buffer, growing it if needed */
+static int
+procmon_snapshot(PyBones_ProcessMonitorObject *self)
+{
+    NTSTATUS status;
+    ULONG real_length;
+
+    for (;;) {
+        if (!self->buffer) {
+            if (!self->buffer_length) {
+                self->buffer_length = 0x10000;
+            }
+            self->buffer = (PSYSTEM_PROCESS_INFORMATION)HeapAlloc(GetProcessHeap(), 0, self->buffer_length);
+            if (!self->buffer) {
+                PyErr_NoMemory();
+                return -1;
+            }
+        }
+
+        real_length = 0;
+        status = NtQuerySystemInformation(
+            SystemProcessInformation,
+            self->buffer,
+            self->buffer_length,
+            &real_length);
+        if (NT_SUCCESS(status)) {
+            return 0;
+        }
+        if (status != STATUS_INFO_LENGTH_MISMATCH) {
+            /* Bleh, something bad happened. */
+            PyBones_RaiseNtStatusError(status);
+            return -1;
+        }
+
+        /* Processes come and go; leave some room for the next time */
+        HeapFree(GetProcessHeap(), 0, self->buffer);
+        self->buffer = NULL;
+        if (real_length > self->buffer_length) {
+            self->buffer_length = real_length + real_length / 4;
+        }
+        else {
+            self->buffer_length *= 2;
+        }
+    }
+}
+
+/* One pass over the snapshot, hashing the entries by process id */
+static int
+procmon_build_index(PyBones_ProcessMonitorObject *self)
 {
     PSYSTEM_PROCESS_INFORMATION pCursor;
+    ULONG count, size, mask, i;
 
-    pCursor = pBuffer;
+    count = 1;
+    for (pCursor = self->buffer; pCursor->NextEntryOffset; ) {
+        pCursor = (PSYSTEM_PROCESS_INFORMATION)((PBYTE)pCursor + pCursor->NextEntryOffset);
+        ++count;
+    }
+
+    for (size = 64; size < count * 2; size *= 2)
+        ;
+    if (size > self->index_size) {
+        if (self->index) {
+            HeapFree(GetProcessHeap(), 0, self->index);
+        }
+        self->index = (procmon_index_slot *)HeapAlloc(GetProcessHeap(), 0, size * sizeof(procmon_index_slot));
+        if (!self->index) {
+            self->index_size = 0;
+            PyErr_NoMemory();
+            return -1;
+        }
+        self->index_size = size;
+    }
+    size = self->index_size;
+    mask = size - 1;
+    ZeroMemory(self->index, size * sizeof(procmon_index_slot));
+
+    pCursor = self->buffer;
     for (;;) {
-        if (pCursor->UniqueProcessId == process_id) {
-            return pCursor;
+        i = ((ULONG)(ULONG_PTR)pCursor->UniqueProcessId >> 2) & mask;
+        while (self->index[i].entry) {
+            i = (i + 1) & mask;
         }
+        self->index[i].process_id = (ULONG)(ULONG_PTR)pCursor->UniqueProcessId;
+        self->index[i].entry = pCursor;
         if (!pCursor->NextEntryOffset) {
-            return NULL;
+            break;
         }
         pCursor = (PSYSTEM_PROCESS_INFORMATION)((PBYTE)pCursor + pCursor->NextEntryOffset);
     }
+    return 0;
+}
+
+static PSYSTEM_PROCESS_INFORMATION
+procmon_lookup(PyBones_ProcessMonitorObject *self, ULONG process_id)
+{
+    ULONG mask = self->index_size - 1;
+    /* Process ids are multiples of 4 */
+    ULONG i = (process_id >> 2) & mask;
+
+    while (self->index[i].entry) {
+        if (self->index[i].process_id == process_id) {
+            return self->index[i].entry;
+        }
+        i = (i + 1) & mask;
+    }
 
     return NULL;
 }
@@ -73,47 +185,82 @@ procmon_lookup(PSYSTEM_PROCESS_INFORMATION pBuffer, ULONG process_id)
 static PyObject *
 procmon_update(PyBones_ProcessMonitorObject *self, PyObject *args)
 {
-    NTSTATUS status;
-    ULONG psi_length = 0x1000;
-    ULONG real_length;
-    PSYSTEM_PROCESS_INFORMATION pBuffer, pCursor;
+    PSYSTEM_PROCESS_INFORMATION pCursor;
     PyObject *process_id, *context;
+    PyObject *process_ids = NULL, *contexts = NULL, *kernel_times = NULL, *user_times = NULL;
+    PyObject *resources = NULL;
+    PyObject *value, *cb_result;
     Py_ssize_t pos = 0;
+    int rv;
 
-    for (pBuffer = NULL; ; psi_length *= 2) {
-        pBuffer = (PSYSTEM_PROCESS_INFORMATION)HeapAlloc(GetProcessHeap(), 0, psi_length);
-        status = NtQuerySystemInformation(
-            SystemProcessInformation,
-            pBuffer,
-            psi_length,
-            &real_length);
-        if (NT_SUCCESS(status)) {
-            break;
-        }
+    if (procmon_snapshot(self) < 0 || procmon_build_index(self) < 0) {
+        return NULL;
+    }
 
-        HeapFree(GetProcessHeap(), 0, pBuffer);
-        if (status != STATUS_INFO_LENGTH_MISMATCH) {
-            /* Bleh, something bad happened. */
-            PyBones_RaiseNtStatusError(status);
-            return NULL;
-        }
+    process_ids = PyList_New(0);
+    contexts = PyList_New(0);
+    kernel_times = PyList_New(0);
+    user_times = PyList_New(0);
+    resources = PyList_New(0);
+    if (!process_ids || !contexts || !kernel_times || !user_times || !resources) {
+        goto fail;
     }
 
     while (PyDict_Next(self->processes, &pos, &process_id, &context)) {
-        pCursor = procmon_lookup(pBuffer, PyInt_AsLong(process_id));
-        if (pCursor) {
-            PyObject *cb_result = NULL;
-
-            cb_result = PyObject_CallMethod((PyObject *)self, "_on_update", "OOKK",
-                process_id,
-                context,
-                pCursor->KernelTime.QuadPart,
-                pCursor->UserTime.QuadPart);
+        pCursor = procmon_lookup(self, PyInt_AsLong(process_id));
+        if (!pCursor) {
+            continue;
+        }
+        if (PyList_Append(process_ids, process_id) < 0 || PyList_Append(contexts, context) < 0) {
+            goto fail;
+        }
+        value = PyLong_FromUnsignedLongLong(pCursor->KernelTime.QuadPart);
+        rv = value ? PyList_Append(kernel_times, value) : -1;
+        Py_XDECREF(value);
+        if (rv < 0) {
+            goto fail;
+        }
+        value = PyLong_FromUnsignedLongLong(pCursor->UserTime.QuadPart);
+        rv = value ? PyList_Append(user_times, value) : -1;
+        Py_XDECREF(value);
+        if (rv < 0) {
+            goto fail;
+        }
+        /* Taken from the same snapshot entry */
+        value = Py_BuildValue("(kkkk)",
+            (unsigned long)pCursor->WorkingSetSize,
+            (unsigned long)pCursor->PrivatePageCount,
+            (unsigned long)pCursor->HandleCount,
+            (unsigned long)pCursor->NumberOfThreads);
+        rv = value ? PyList_Append(resources, value) : -1;
+        Py_XDECREF(value);
+        if (rv < 0) {
+            goto fail;
         }
     }
 
-    HeapFree(GetProcessHeap(), 0, pBuffer);
+    /* A single callback for all the tracked processes */
+    cb_result = PyObject_CallMethod((PyObject *)self, "_on_update", "OOOOO",
+        process_ids, contexts, kernel_times, user_times, resources);
+    if (!cb_result) {
+        goto fail;
+    }
+    Py_DECREF(cb_result);
+
+    Py_DECREF(process_ids);
+    Py_DECREF(contexts);
+    Py_DECREF(kernel_times);
+    Py_DECREF(user_times);
+    Py_DECREF(resources);
     Py_RETURN_NONE;
+
+fail:
+    Py_XDECREF(process_ids);
+    Py_XDECREF(contexts);
+    Py_XDECREF(kernel_times);
+    Py_XDECREF(user_times);
+    Py_XDECREF(resources);
+    return NULL;
 }
 
 PyDoc_STRVAR(track_process__doc__,
@@ -0,0 +1,219 @@
+"""
+Layer 3 of the METALBONES core -- high-level code.
+
+Runs a fuzzing campaign over several target runners in worker processes.
+"""
+
+import os
+import time
+import Queue
+import logging
+import functools
+import traceback
+import multiprocessing
+import dbg
+import crashdb
+import coverage
+import mutation
+import runner
+
+class FakeRunner(object):
+    """Stands in for runner.TargetRunner without running anything.
+
+    The test case path is taken to be the last word of the command line;
+    the "target" crashes if the marker is found in it and reports the
+    distinct values of the first bytes as its features.
+    """
+    def __init__(self, crash_marker='\xDE\xAD', feature_bytes=16):
+        self.crash_marker = crash_marker
+        self.feature_bytes = feature_bytes
+        self.evidence = None
+        self.features = ()
+        self.done = False
+        self._path = None
+    def start(self, cmdline):
+        self._path = cmdline.split()[-1]
+    def update(self):
+        with open(self._path, 'rb') as fp:
+            data = fp.read()
+        self.features = frozenset(enumerate(data[:self.feature_bytes]))
+        offset = data.find(self.crash_marker)
+        if offset >= 0:
+            info = (0xC0000005L, 0x401000L + offset, 0L, (1L, 0L), None)
+            self.evidence = runner.ExceptionEvidence(dbg.AccessViolationInfo(info))
+        self.done = True
+#
+
+class WorkerError(Exception):
+    "A worker process failed; the message has its traceback"
+    pass
+
+def coverage_runner(blocks):
+    "A TargetRunner collecting block coverage (see coverage.load_blocks) as features"
+    return runner.TargetRunner(coverage=coverage.CoverageCollector(blocks))
+
+def _worker(task_queue, result_queue, runner_factory, cmdline, work_dir, suffix):
+    """Worker process: run test cases until told to stop by a None task.
+
+    An exception is reported as a (None, traceback) result and ends the
+    worker.
+    """
+    try:
+        _work(task_queue, result_queue, runner_factory, cmdline, work_dir, suffix)
+    except Exception:
+        result_queue.put((None, traceback.format_exc()))
+
+def _work(task_queue, result_queue, runner_factory, cmdline, work_dir, suffix):
+    path = os.path.join(work_dir, 'case_%d%s' % (os.getpid(), suffix))
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        task_id, seed_path, mutations = task
+        with open(seed_path, 'rb') as fp:
+            data = fp.read()
+        with open(path, 'w+b') as fp:
+            fp.write(data)
+            mutation.apply_mutations(mutations, fp)
+            fp.seek(0)
+            data = fp.read()
+        started = time.time()
+        r = runner_factory()
+        r.start(cmdline % path)
+        while not r.done:
+            r.update()
+        exec_time = time.time() - started
+        features = getattr(r, 'features', ())
+        hung = getattr(r, 'timed_out', False)
+        result_queue.put((task_id, exec_time, features, r.evidence, hung, data))
+    if os.path.exists(path):
+        os.remove(path)
+
+class Campaign(object):
+    """Fans test cases out to worker processes and collects the outcomes.
+
+    The master process owns the corpus, the mutator scheduler and the
+    crash store: mutations are generated here, workers only apply them,
+    run the target through `runner_factory` and report back. Runners must
+    provide features for the corpus to grow: by default, TargetRunners
+    with coverage of the given `blocks` (see coverage.load_blocks) are
+    used; FakeRunner is there for testing. A worker failing or dying
+    raises WorkerError.
+
+    Crashes are deduplicated into a crashdb.CrashStore under `crash_path`;
+    `crashes` counts them all, `unique_crashes` the new buckets.
+    """
+    def __init__(self, corpus, cmdline, crash_path, runner_factory=None,
+            workers=None, mutators=(mutation.BitFlipper, mutation.ByteSetter),
+            max_mutations=8, scheduler=None, work_dir=None, suffix='', blocks=None,
+            poll_interval=1.0):
+        if runner_factory is None:
+            if not blocks:
+                raise ValueError('No feature source: give coverage blocks or a runner_factory.')
+            runner_factory = functools.partial(coverage_runner, blocks)
+        self._logger = logging.getLogger()
+        self.corpus = corpus
+        # Command line template, '%s' is replaced with the test case path
+        self.cmdline = cmdline
+        self.crash_path = crash_path
+        self.runner_factory = runner_factory
+        self.workers = workers or multiprocessing.cpu_count()
+        self.mutators = list(mutators)
+        self.max_mutations = max_mutations
+        self.scheduler = scheduler
+        self.work_dir = work_dir or crash_path
+        self.suffix = suffix
+        # How often to check on the workers while waiting for results
+        self.poll_interval = poll_interval
+        self.executions = 0
+        self.crashes = 0
+        self.unique_crashes = 0
+        self.crash_store = crashdb.CrashStore(crash_path, suffix=suffix)
+
+    def run(self, iterations):
+        "Run the given number of test cases"
+        task_queue = multiprocessing.Queue()
+        result_queue = multiprocessing.Queue()
+        procs = []
+        for i in xrange(self.workers):
+            p = multiprocessing.Process(target=_worker,
+                args=(task_queue, result_queue, self.runner_factory, self.cmdline, self.work_dir, self.suffix))
+            p.daemon = True
+            p.start()
+            procs.append(p)
+        in_flight = {}
+        tasks = self._tasks()
+        task_id = 0
+        finished = False
+        try:
+            while task_id < iterations or in_flight:
+                # Keep every worker busy with one task queued behind it
+                while task_id < iterations and len(in_flight) < self.workers * 2:
+                    entry, mutations = next(tasks)
+                    in_flight[task_id] = entry, mutations
+                    task_queue.put((task_id, self.corpus.entry_path(entry), mutations))
+                    task_id += 1
+                result = self._next_result(result_queue, procs)
+                entry, mutations = in_flight.pop(result[0])
+                self._on_result(entry, mutations, *result[1:])
+            finished = True
+        finally:
+            if finished:
+                for p in procs:
+                    task_queue.put(None)
+            else:
+                # The rest may be stuck putting results nobody will read
+                for p in procs:
+                    p.terminate()
+            for p in procs:
+                p.join()
+            self.corpus.save()
+            self.crash_store.flush()
+            if self.scheduler is not None and self.scheduler.path is not None:
+                self.scheduler.save()
+
+    def close(self):
+        "Release the crash store"
+        self.crash_store.close()
+
+    def _next_result(self, result_queue, procs):
+        while True:
+            try:
+                result = result_queue.get(timeout=self.poll_interval)
+            except Queue.Empty:
+                for p in procs:
+                    if not p.is_alive():
+                        raise WorkerError('Worker %d exited with code %s' % (p.pid, p.exitcode))
+                continue
+            if result[0] is None:
+                raise WorkerError(result[1])
+            return result
+
+    def _tasks(self):
+        while True:
+            entry, energy = self.corpus.next()
+            length = len(self.corpus.read(entry))
+            for i in xrange(energy):
+                mutations = mutation.generate_mutations(self.mutators, length, self.max_mutations, self.scheduler)
+                yield entry, mutations
+
+    def _on_result(self, entry, mutations, exec_time, features, evidence, hung, data):
+        self.executions += 1
+        new_entry = self.corpus.add(data, exec_time, features, parent=entry)
+        if evidence is not None:
+            self._save_crash(evidence, data, mutations)
+        if self.scheduler is not None:
+            self.scheduler.reward(mutations,
+                new_coverage=new_entry.new_features if new_entry is not None else 0,
+                crashes=1 if evidence is not None else 0,
+                hangs=1 if hung else 0)
+
+    def _save_crash(self, evidence, data, mutations):
+        self.crashes += 1
+        key, new = self.crash_store.add(evidence, data, mutations)
+        if new:
+            self.unique_crashes += 1
+            self._logger.info('Crash: %s (new bucket %s)', evidence.info, key[:12])
+        else:
+            self._logger.debug('Crash: %s (bucket %s)', evidence.info, key[:12])
+# EOF
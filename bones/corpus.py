@@ -0,0 +1,152 @@
+"""
+Layer 3 of the METALBONES core -- high-level code.
+
+Keeps a corpus of interesting inputs and schedules them for mutation.
+"""
+
+import os
+import cPickle
+
+class SetFeedback(object):
+    """Novelty tracking over sets of hashable features.
+
+    Features can be anything the runner observes: hit breakpoint addresses,
+    (module, offset) of exceptions, edge ids and so on.
+    """
+    def __init__(self):
+        self.seen = set()
+    def novel(self, features):
+        "Record the features, returning how many were never seen before"
+        new = set(features) - self.seen
+        self.seen.update(new)
+        return len(new)
+#
+class CorpusEntry(object):
+    def __init__(self, id, exec_time, new_features, depth=0):
+        self.id = id
+        self.exec_time = exec_time
+        self.new_features = new_features
+        self.depth = depth
+        self.times_chosen = 0
+    def __str__(self):
+        return 'Entry %06d (%.3fs, %d new features, depth %d)' % (
+            self.id, self.exec_time, self.new_features, self.depth)
+    @property
+    def name(self):
+        return 'id_%06d' % self.id
+#
+class Corpus(object):
+    """A persistent, feedback-driven queue of inputs.
+
+    Entry data lives in `<path>/queue`, the scheduler state (entries and
+    the feedback object) in `<path>/state.pickle`. A `feedback` object
+    given by the caller is kept over the saved one.
+    """
+
+    STATE_NAME = 'state.pickle'
+
+    def __init__(self, path, feedback=None, base_energy=100, min_energy=10, max_energy=1600):
+        self.path = path
+        self.queue_path = os.path.join(path, 'queue')
+        self.feedback = feedback if feedback is not None else SetFeedback()
+        self.own_feedback = feedback is None
+        self.base_energy = base_energy
+        self.min_energy = min_energy
+        self.max_energy = max_energy
+        self.entries = []
+        self.cursor = 0
+        self.total_exec_time = 0.0
+        # Entries with a measured exec_time; seeds aren't timed
+        self.timed_entries = 0
+        if not os.path.isdir(self.queue_path):
+            os.makedirs(self.queue_path)
+        self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add_seed(self, data):
+        "Add an initial input regardless of its feedback"
+        return self._add(data, 0.0, 0, 0)
+
+    def add(self, data, exec_time, features, parent=None):
+        "Add the input if its features are novel; returns the new entry or None"
+        new_features = self.feedback.novel(features)
+        if not new_features:
+            return None
+        depth = parent.depth + 1 if parent is not None else 0
+        return self._add(data, exec_time, new_features, depth)
+
+    def next(self):
+        "Pick the next entry to fuzz; returns (entry, energy)"
+        if not self.entries:
+            raise IndexError('The corpus is empty.')
+        if self.cursor >= len(self.entries):
+            self.cursor = 0
+        entry = self.entries[self.cursor]
+        self.cursor += 1
+        energy = self.energy(entry)
+        entry.times_chosen += 1
+        return entry, energy
+
+    def energy(self, entry):
+        "How many mutated children to derive from the entry in one round"
+        energy = float(self.base_energy)
+        # Favour fast executions...
+        if entry.exec_time > 0:
+            avg_time = self.total_exec_time / self.timed_entries
+            ratio = avg_time / entry.exec_time
+            energy *= min(max(ratio, 0.25), 3.0)
+        # ...entries that brought in new edges...
+        energy *= 1 + min(entry.new_features, 15) / 5.0
+        # ...and the ones that have not been fuzzed much yet
+        if entry.times_chosen == 0:
+            energy *= 2
+        return int(min(max(energy, self.min_energy), self.max_energy))
+
+    def read(self, entry):
+        with open(self.entry_path(entry), 'rb') as fp:
+            return fp.read()
+
+    def entry_path(self, entry):
+        return os.path.join(self.queue_path, entry.name)
+
+    def load(self):
+        path = os.path.join(self.path, Corpus.STATE_NAME)
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as fp:
+            state = cPickle.load(fp)
+        self.entries = state['entries']
+        self.cursor = state['cursor']
+        self.total_exec_time = state['total_exec_time']
+        self.timed_entries = sum(1 for e in self.entries if e.exec_time > 0)
+        if self.own_feedback:
+            self.feedback = state['feedback']
+
+    def save(self):
+        state = {
+            'entries' : self.entries,
+            'cursor' : self.cursor,
+            'total_exec_time' : self.total_exec_time,
+            'feedback' : self.feedback,
+        }
+        path = os.path.join(self.path, Corpus.STATE_NAME)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as fp:
+            cPickle.dump(state, fp, cPickle.HIGHEST_PROTOCOL)
+        # No atomic replace on Windows
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+
+    def _add(self, data, exec_time, new_features, depth):
+        entry = CorpusEntry(len(self.entries), exec_time, new_features, depth)
+        with open(self.entry_path(entry), 'wb') as fp:
+            fp.write(data)
+        self.entries.append(entry)
+        self.total_exec_time += exec_time
+        if exec_time > 0:
+            self.timed_entries += 1
+        return entry
+# EOF
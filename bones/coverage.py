@@ -0,0 +1,110 @@
+"""
+Layer 3 of the METALBONES core -- high-level code.
+
+Basic block coverage via one-shot breakpoints.
+
+Every known block start of the watched modules gets a breakpoint when the
+module loads; the first hit marks the block in the module's bitmap and
+the breakpoint is never re-armed, so each block costs one debug event.
+"""
+
+import array
+
+def load_blocks(path):
+    """Read block starts from a text file of `module rva` lines.
+
+    Returns a dict mapping lowercase module names to lists of RVAs.
+    """
+    blocks = {}
+    with open(path, 'r') as fp:
+        for line in fp:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            name, rva = line.split()
+            blocks.setdefault(name.lower(), []).append(int(rva, 16))
+    return blocks
+
+class ModuleCoverage(object):
+    "Blocks of a module and the bitmap of hit ones, indexed by block id"
+    def __init__(self, name, block_rvas):
+        self.name = name
+        self.block_rvas = array.array('I', sorted(set(block_rvas)))
+        self.bitmap = bytearray(len(self.block_rvas))
+    def __str__(self):
+        return '%s: %d/%d blocks' % (self.name, self.hit_count(), len(self.bitmap))
+    def hit_count(self):
+        return len(self.bitmap) - self.bitmap.count(0)
+    def reset(self):
+        self.bitmap = bytearray(len(self.block_rvas))
+#
+class CoverageCollector(object):
+    """Collects block coverage of one run.
+
+    Route the debugger's on_module_load, on_module_unload and
+    on_managed_breakpoint events here.
+    """
+    def __init__(self, blocks):
+        self.modules = {}
+        for name, rvas in blocks.iteritems():
+            self.modules[name.lower()] = ModuleCoverage(name.lower(), rvas)
+        # Armed block address -> (module coverage, block id), per process
+        self._targets = {}
+
+    def on_module_load(self, module):
+        cov = self.modules.get(module.name.lower())
+        if cov is None:
+            return
+        base = module.base_address
+        targets = self._targets.setdefault(module.process.id, {})
+        addresses = []
+        for block_id, rva in enumerate(cov.block_rvas):
+            if not cov.bitmap[block_id]:
+                address = base + rva
+                targets[address] = cov, block_id
+                addresses.append(address)
+        module.process.breakpoint_manager.arm(addresses)
+
+    def on_module_unload(self, module):
+        cov = self.modules.get(module.name.lower())
+        if cov is None:
+            return
+        targets = self._targets.get(module.process.id, {})
+        base = module.base_address
+        addresses = [base + rva for rva in cov.block_rvas]
+        for address in addresses:
+            targets.pop(address, None)
+        # The code is gone; don't try to restore anything
+        module.process.breakpoint_manager.discard(addresses)
+
+    def on_managed_breakpoint(self, thread, context, address):
+        "Record the hit; returns False if the breakpoint is not a block start"
+        try:
+            cov, block_id = self._targets[thread.process.id].pop(address)
+        except KeyError:
+            return False
+        cov.bitmap[block_id] = 1
+        return True
+
+    def bitmaps(self):
+        "Per-module hit bitmaps, indexed by block id"
+        return dict((name, cov.bitmap) for name, cov in self.modules.iteritems())
+
+    def features(self):
+        """Hit blocks, as a feature set for corpus feedback.
+
+        There are no edges: one-shot breakpoints only see the first hit of
+        each block, so consecutive hits don't tell which branch was taken.
+        """
+        features = set()
+        for name, cov in self.modules.iteritems():
+            bitmap = cov.bitmap
+            features.update((name, i) for i in xrange(len(bitmap)) if bitmap[i])
+        return features
+
+    def reset(self):
+        "Forget hits, e.g. before the next run"
+        for cov in self.modules.itervalues():
+            cov.reset()
+        self._targets.clear()
+# EOF
@@ -0,0 +1,141 @@
+"""
+Layer 3 of the METALBONES core -- high-level code.
+
+On-disk crash store with fuzzy bucketing.
+
+Crashes are bucketed by a hash over the evidence signature: for
+exceptions, the code, the faulting module+offset and the module+offsets
+of the top stack frames. Only the first crash of a bucket keeps its test
+case and pickled evidence; later ones just bump the bucket's counter,
+in memory until the next flush. The index is an sqlite database next to
+the samples.
+"""
+
+import os
+import cPickle
+import time
+import hashlib
+import sqlite3
+
+def bucket_key(evidence, depth=5):
+    "The bucket hash of the evidence, over its top `depth` frames"
+    return hashlib.sha1('\n'.join(evidence.signature(depth))).hexdigest()
+
+class Bucket(object):
+    def __init__(self, key, signature, count, first_seen, last_seen, sample):
+        self.key = key
+        self.signature = signature
+        self.count = count
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+        # Test case path, relative to the store
+        self.sample = sample
+    def __str__(self):
+        return '%s: %d hit(s), %s' % (self.key[:12], self.count, self.signature.replace('\n', ' / '))
+#
+class CrashStore(object):
+    """Crash buckets and their first test cases under `path`.
+
+    The bucket keys are also kept in memory, so checking whether a crash
+    was seen before doesn't touch the disk. Hits on known buckets are
+    counted in memory too and written in one transaction every
+    `flush_interval` seconds, on reads and on flush() or close().
+    """
+    def __init__(self, path, depth=5, suffix='', flush_interval=5.0):
+        self.path = path
+        self.depth = depth
+        self.suffix = suffix
+        self.flush_interval = flush_interval
+        # Key -> [hits, last seen] not yet written
+        self.pending = {}
+        self._flushed = time.time()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.db = sqlite3.connect(os.path.join(path, 'buckets.sqlite'))
+        self.db.execute('''CREATE TABLE IF NOT EXISTS buckets (
+            key TEXT PRIMARY KEY,
+            signature TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            first_seen REAL NOT NULL,
+            last_seen REAL NOT NULL,
+            sample TEXT NOT NULL)''')
+        self.db.commit()
+        self.keys = set(row[0] for row in self.db.execute('SELECT key FROM buckets'))
+
+    def __len__(self):
+        return len(self.keys)
+    def __contains__(self, key):
+        return key in self.keys
+
+    def flush(self):
+        "Write the pending bucket hits"
+        if self.pending:
+            self.db.executemany('UPDATE buckets SET count = count + ?, last_seen = ? WHERE key = ?',
+                [(hits, last_seen, key) for key, (hits, last_seen) in self.pending.iteritems()])
+            self.db.commit()
+            self.pending.clear()
+        self._flushed = time.time()
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def seen(self, evidence):
+        return bucket_key(evidence, self.depth) in self.keys
+
+    def add(self, evidence, data, notes=()):
+        """Record a crash; returns its bucket key and whether the bucket is new.
+
+        The test case `data`, the pickled evidence and a text report (the
+        evidence and `notes`, e.g. the mutations) are written out for new
+        buckets only.
+        """
+        key = bucket_key(evidence, self.depth)
+        now = time.time()
+        if key in self.keys:
+            try:
+                hit = self.pending[key]
+                hit[0] += 1
+                hit[1] = now
+            except KeyError:
+                self.pending[key] = [1, now]
+            if now - self._flushed >= self.flush_interval:
+                self.flush()
+            return key, False
+        sample = key + self.suffix
+        with open(os.path.join(self.path, sample), 'wb') as fp:
+            fp.write(data)
+        with open(os.path.join(self.path, key + '.txt'), 'w') as fp:
+            fp.write('%s\n' % evidence.info)
+            symbol = getattr(evidence, 'symbol', None)
+            if symbol is not None:
+                fp.write('at %s\n' % symbol)
+            for line in evidence.signature(self.depth):
+                fp.write('  %s\n' % line)
+            for note in notes:
+                fp.write('%s\n' % note)
+        with open(os.path.join(self.path, key + '.evidence'), 'wb') as fp:
+            cPickle.dump(evidence, fp, cPickle.HIGHEST_PROTOCOL)
+        self.db.execute('INSERT INTO buckets VALUES (?, ?, ?, ?, ?, ?)',
+            (key, '\n'.join(evidence.signature(self.depth)), 1, now, now, sample))
+        self.db.commit()
+        self.keys.add(key)
+        return key, True
+
+    def get(self, key):
+        self.flush()
+        row = self.db.execute('SELECT * FROM buckets WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return Bucket(*row)
+
+    def buckets(self):
+        "All buckets, most hit first"
+        self.flush()
+        for row in self.db.execute('SELECT * FROM buckets ORDER BY count DESC'):
+            yield Bucket(*row)
+
+    def sample_path(self, bucket):
+        return os.path.join(self.path, bucket.sample)
+    def evidence_path(self, bucket):
+        return os.path.join(self.path, bucket.key + '.evidence')
+# EOF
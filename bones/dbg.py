@@ -5,10 +5,28 @@ This wraps CPython objects and adds more functionality that
 can be more easily implemented in Python than in C.
 """
 
-import _bones
+import array
+import bisect
+import logging
 import os.path
+import struct
+from formats import pe
+try:
+    import _bones
+except ImportError:
+    # No native core here; only non-native backends (see replay.py) work
+    _bones = None
 
-class BonesError(_bones.BonesException):
+if _bones is not None:
+    BonesException = _bones.BonesException
+    NtStatusError = _bones.NtStatusError
+else:
+    class BonesException(Exception):
+        pass
+    class NtStatusError(BonesException):
+        pass
+
+class BonesError(BonesException):
     pass
 
 class InvalidOperationError(BonesError):
@@ -22,6 +40,11 @@ class Location:
         if self.module is not None:
             return '%s+%08x' % (self.module.name, self.rva - self.module.base_address)
         return '%08x' % self.rva
+    def symbolize(self):
+        "module!export+0xN, as near as the exports tell"
+        if self.module is not None:
+            return self.module.symbolize(self.rva)
+        return '%08x' % self.rva
 
 class Breakpoint:
     """Software breakpoint class.
@@ -56,11 +79,199 @@ class Breakpoint:
 
     def _arm(self):
         self.old_byte = self.process.read_memory(self.address, 1)
-        self.process.write_memory(address, 1, "\xCC")
+        self.process.write_memory(self.address, "\xCC")
 
     def _disarm(self):
-        self.process.write_memory(address, 1, self.old_byte)
-        self._write_byte(self.address, self.old_byte)
+        self.process.write_memory(self.address, self.old_byte)
+
+class BreakpointManager(object):
+    """Bulk software breakpoint handling for a process.
+
+    Breakpoints are identified by slot numbers; per-slot state is kept in
+    compact arrays: the address, the original byte, the armed and the
+    persistent flags, the hit count and the last thread to hit it.
+    Arming or disarming a batch touches each page once: one read, one
+    protection change there and back, and one write of the patched span.
+
+    Persistent breakpoints are re-armed after the hitting thread steps
+    over the original instruction; their pages are left writable so that
+    a hit costs two one-byte writes.
+    """
+
+    PAGE_SIZE = 0x1000
+
+    def __init__(self, process):
+        self.process = process
+        self.slots = {}
+        self.addresses = array.array('I')
+        self.old_bytes = bytearray()
+        self.armed = bytearray()
+        self.persistent = bytearray()
+        self.hit_counts = array.array('I')
+        self.last_thread = array.array('I')
+        # Thread id -> slot to re-arm after the thread's single step
+        self.pending = {}
+        # Page -> original protection, for pages left writable
+        self.writable_pages = {}
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def add(self, address, persistent=False):
+        "Register a (disarmed) breakpoint; returns its slot"
+        try:
+            slot = self.slots[address]
+        except KeyError:
+            slot = len(self.addresses)
+            self.slots[address] = slot
+            self.addresses.append(address)
+            self.old_bytes.append(0)
+            self.armed.append(0)
+            self.persistent.append(0)
+            self.hit_counts.append(0)
+            self.last_thread.append(0)
+        if persistent:
+            self.persistent[slot] = 1
+        return slot
+
+    def set_persistent(self, address, persistent):
+        self.persistent[self.slots[address]] = 1 if persistent else 0
+
+    def is_armed(self, address):
+        slot = self.slots.get(address)
+        return slot is not None and self.armed[slot] != 0
+
+    def arm(self, addresses=None, persistent=False):
+        "Arm the given (or all registered) breakpoints that are not armed yet"
+        if addresses is None:
+            slots = [s for s in xrange(len(self.addresses)) if not self.armed[s]]
+        else:
+            slots = [s for s in (self.add(a, persistent) for a in addresses) if not self.armed[s]]
+        self._patch(slots, True)
+
+    def disarm(self, addresses=None):
+        "Disarm the given (or all) breakpoints that are armed"
+        if addresses is None:
+            slots = [s for s in xrange(len(self.addresses)) if self.armed[s]]
+        else:
+            slots = [self.slots[a] for a in addresses if self.armed[self.slots[a]]]
+        self._patch(slots, False)
+        if addresses is None:
+            self._restore_protection()
+        else:
+            page_mask = ~(BreakpointManager.PAGE_SIZE - 1)
+            self._release_pages(set(self.addresses[s] & page_mask for s in slots))
+
+    def discard(self, addresses):
+        "Mark breakpoints disarmed without touching memory (e.g. after unload)"
+        pages = set()
+        for address in addresses:
+            slot = self.slots.get(address)
+            if slot is not None:
+                self.armed[slot] = 0
+                self.persistent[slot] = 0
+                pages.add(address & ~(BreakpointManager.PAGE_SIZE - 1))
+        # Forget the pages left writable only for these breakpoints
+        in_use = self._pages_in_use()
+        for page in pages:
+            if page not in in_use:
+                self.writable_pages.pop(page, None)
+
+    def on_hit(self, slot, thread_id):
+        "Restore the original byte of a hit breakpoint; True if it is to be re-armed"
+        self._write_byte(slot, chr(self.old_bytes[slot]))
+        self.armed[slot] = 0
+        self.hit_counts[slot] += 1
+        self.last_thread[slot] = thread_id
+        if self.persistent[slot]:
+            self.pending[thread_id] = slot
+            return True
+        return False
+
+    def on_step(self, thread_id):
+        "Re-arm the breakpoint the thread has stepped over; False if none"
+        slot = self.pending.pop(thread_id, None)
+        if slot is None:
+            return False
+        if self.persistent[slot] and not self.armed[slot]:
+            self._write_byte(slot, "\xCC")
+            self.armed[slot] = 1
+        return True
+
+    def _write_byte(self, slot, value):
+        address = self.addresses[slot]
+        page = address & ~(BreakpointManager.PAGE_SIZE - 1)
+        process = self.process
+        if page in self.writable_pages:
+            process.write_memory(address, value)
+            return
+        old_protect = process.protect_memory(page, BreakpointManager.PAGE_SIZE, Process.PAGE_EXECUTE_READWRITE)
+        try:
+            process.write_memory(address, value)
+        finally:
+            process.protect_memory(page, BreakpointManager.PAGE_SIZE, old_protect)
+
+    def _pages_in_use(self):
+        "Pages holding persistent breakpoints that are armed or about to be re-armed"
+        page_mask = ~(BreakpointManager.PAGE_SIZE - 1)
+        pending = set(self.pending.itervalues())
+        return set(self.addresses[s] & page_mask for s in xrange(len(self.addresses))
+            if self.persistent[s] and (self.armed[s] or s in pending))
+
+    def _release_pages(self, pages):
+        "Restore the protection of writable pages no breakpoint needs any more"
+        in_use = self._pages_in_use()
+        for page in pages:
+            if page in self.writable_pages and page not in in_use:
+                self.process.protect_memory(page, BreakpointManager.PAGE_SIZE, self.writable_pages.pop(page))
+
+    def _restore_protection(self):
+        for page, protect in self.writable_pages.iteritems():
+            self.process.protect_memory(page, BreakpointManager.PAGE_SIZE, protect)
+        self.writable_pages.clear()
+
+    def _patch(self, slots, arm):
+        addresses = self.addresses
+        slots.sort(key=addresses.__getitem__)
+        page_mask = ~(BreakpointManager.PAGE_SIZE - 1)
+        start = 0
+        while start < len(slots):
+            # Gather the run of slots on the same page
+            page = addresses[slots[start]] & page_mask
+            end = start + 1
+            while end < len(slots) and (addresses[slots[end]] & page_mask) == page:
+                end += 1
+            self._patch_page(page, slots[start:end], arm)
+            start = end
+
+    def _patch_page(self, page, slots, arm):
+        process = self.process
+        addresses = self.addresses
+        first = addresses[slots[0]] - page
+        last = addresses[slots[-1]] - page
+        data = bytearray(process.read_memory(page + first, last - first + 1))
+        keep_writable = False
+        for slot in slots:
+            offset = addresses[slot] - page - first
+            if arm:
+                self.old_bytes[slot] = data[offset]
+                data[offset] = 0xCC
+                if self.persistent[slot]:
+                    keep_writable = True
+            else:
+                data[offset] = self.old_bytes[slot]
+            self.armed[slot] = arm
+        if page in self.writable_pages:
+            process.write_memory(page + first, str(data))
+            return
+        old_protect = process.protect_memory(page, BreakpointManager.PAGE_SIZE, Process.PAGE_EXECUTE_READWRITE)
+        try:
+            process.write_memory(page + first, str(data))
+        finally:
+            if keep_writable:
+                self.writable_pages[page] = old_protect
+            else:
+                process.protect_memory(page, BreakpointManager.PAGE_SIZE, old_protect)
 
 class HwBreakpoint:
     """Hardware breakpoint class.
@@ -68,7 +279,8 @@ class HwBreakpoint:
     This is used to abstract CPU debug registers and provide the interface
     similar to how software breakpoints operate.
 
-    These trigger the single stepping event.
+    These trigger the single stepping event. Create them through the
+    process' HwBreakpointManager.
     """
 
     EVENT_X = 0
@@ -76,11 +288,203 @@ class HwBreakpoint:
     EVENT_IO = 2 # Not actually implemented
     EVENT_RW = 3
 
-    def __init__(self, process, address, event):
+    def __init__(self, process, address, event, length=1, thread=None):
         self.process = process
         self.address = address
         self.event = event
+        self.length = length
+        # The one thread it is set in, or None for all threads
+        self.thread = thread
+        self.hits = 0
+        # Thread id -> debug register slot
+        self.slots = {}
+
+    def __str__(self):
+        return 'HwBreakpoint at %08x (%s, %d byte(s))' % (self.address, 'xw?a'[self.event], self.length)
+
+# DR7 LENn encodings by length
+_dr7_lengths = {1: 0, 2: 1, 8: 2, 4: 3}
+
+# DR6 bits: B0-B3, then BS for a single step
+DR6_HITS = 0xF
+DR6_SINGLE_STEP = 0x4000
+
+def dr7_enable(dr7, slot, event, length):
+    "DR7 with the slot locally enabled for the event and length"
+    shift = 16 + 4 * slot
+    dr7 &= ~((0xF << shift) | (3 << 2 * slot))
+    return dr7 | (1 << 2 * slot) | ((event | _dr7_lengths[length] << 2) << shift)
+
+def dr7_disable(dr7, slot):
+    "DR7 with the slot disabled and its condition bits cleared"
+    return dr7 & ~((0xF << (16 + 4 * slot)) | (3 << 2 * slot))
+
+def dr7_condition(dr7, slot):
+    "(event, length) of the slot if DR7 enables it locally, else None"
+    if not dr7 & (1 << 2 * slot):
+        return None
+    bits = dr7 >> (16 + 4 * slot)
+    lengths = dict((v, k) for k, v in _dr7_lengths.iteritems())
+    return bits & 3, lengths[(bits >> 2) & 3]
+
+def dr6_hits(dr6):
+    "The slots DR6 reports as hit"
+    return [slot for slot in xrange(4) if dr6 & (1 << slot)]
 
+class HwBreakpointManager(object):
+    """Hardware breakpoints of a process, in the DR0-DR3 of its threads.
+
+    A breakpoint is set either in one thread or in all of them, including
+    threads created later. Changes are collected and written by apply(),
+    with one context get and set per changed thread. Nothing is patched,
+    so watching data or hooking self-checking code costs no memory writes.
+    """
+
+    SLOTS = 4
+
+    def __init__(self, process):
+        self._logger = logging.getLogger()
+        self.process = process
+        # Breakpoints set in all threads
+        self.breakpoints = []
+        # Thread id -> [HwBreakpoint or None] per debug register
+        self.threads = {}
+        # Thread ids whose debug registers need writing
+        self.dirty = set()
+
+    def _allocate(self, bp, tid):
+        slots = self.threads.setdefault(tid, [None] * HwBreakpointManager.SLOTS)
+        try:
+            slot = slots.index(None)
+        except ValueError:
+            raise InvalidOperationError('No free debug register in thread %d.' % tid)
+        slots[slot] = bp
+        bp.slots[tid] = slot
+        self.dirty.add(tid)
+
+    def add(self, address, event=HwBreakpoint.EVENT_X, length=1, thread=None):
+        "Set a breakpoint in the thread, or all threads; apply() writes it"
+        if event not in (HwBreakpoint.EVENT_X, HwBreakpoint.EVENT_W, HwBreakpoint.EVENT_RW):
+            raise ValueError('Unsupported event %r' % event)
+        if length not in _dr7_lengths or (event == HwBreakpoint.EVENT_X and length != 1):
+            raise ValueError('Unsupported length %r' % length)
+        if address & (length - 1):
+            raise ValueError('Address %08x not aligned to %d' % (address, length))
+        bp = HwBreakpoint(self.process, address, event, length, thread)
+        tids = [thread.id] if thread is not None else list(self.process.threads)
+        try:
+            for tid in tids:
+                self._allocate(bp, tid)
+        except InvalidOperationError:
+            self.remove(bp)
+            raise
+        if thread is None:
+            self.breakpoints.append(bp)
+        return bp
+
+    def remove(self, bp):
+        for tid, slot in bp.slots.iteritems():
+            self.threads[tid][slot] = None
+            self.dirty.add(tid)
+        bp.slots.clear()
+        if bp in self.breakpoints:
+            self.breakpoints.remove(bp)
+
+    def fill(self, tid, context):
+        "Write the thread's breakpoints into the debug registers of the context"
+        dr7 = context.dr7
+        for slot, bp in enumerate(self.threads.get(tid, ())):
+            if bp is None:
+                dr7 = dr7_disable(dr7, slot)
+            else:
+                setattr(context, 'dr%d' % slot, bp.address)
+                dr7 = dr7_enable(dr7, slot, bp.event, bp.length)
+        context.dr7 = dr7
+
+    def apply(self):
+        "Write the pending changes to the threads"
+        for tid in self.dirty:
+            thread = self.process.threads.get(tid)
+            if thread is None:
+                continue
+            context = thread.context
+            self.fill(tid, context)
+            thread.context = context
+            if self.threads[tid].count(None) == HwBreakpointManager.SLOTS:
+                del self.threads[tid]
+        self.dirty.clear()
+
+    def hits(self, tid, dr6):
+        "The thread's breakpoints that DR6 reports hit"
+        slots = self.threads.get(tid)
+        if not slots:
+            return []
+        return [slots[slot] for slot in dr6_hits(dr6) if slots[slot] is not None]
+
+    def on_thread_create(self, thread):
+        "Set the process-wide breakpoints in a new thread, as many as fit"
+        if self.breakpoints:
+            for bp in self.breakpoints:
+                try:
+                    self._allocate(bp, thread.id)
+                except InvalidOperationError:
+                    # More process-wide breakpoints than debug registers
+                    self._logger.warning('%s: no debug register for %s', thread, bp)
+            self.apply()
+    def on_thread_exit(self, thread):
+        slots = self.threads.pop(thread.id, ())
+        for bp in slots:
+            if bp is not None:
+                bp.slots.pop(thread.id, None)
+        self.dirty.discard(thread.id)
+
+class PageCache(object):
+    """Per-stop cache of whole remote memory pages.
+
+    `read` is a callable (address, size) -> string doing the actual
+    remote read. Sub-reads are served as memoryview slices of the cached
+    pages; the owner must clear() the cache whenever the target may run.
+    """
+
+    PAGE_SIZE = 0x1000
+
+    def __init__(self, read):
+        self.read = read
+        self.pages = {}
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        if self.pages:
+            self.pages.clear()
+    def invalidate(self, address, size):
+        page = address & ~(PageCache.PAGE_SIZE - 1)
+        while page < address + size:
+            self.pages.pop(page, None)
+            page += PageCache.PAGE_SIZE
+
+    def _get_page(self, page):
+        try:
+            data = self.pages[page]
+            self.hits += 1
+        except KeyError:
+            data = self.read(page, PageCache.PAGE_SIZE)
+            self.pages[page] = data
+            self.misses += 1
+        return data
+
+    def read_view(self, address, size):
+        "Read size bytes at address as a memoryview"
+        page_mask = ~(PageCache.PAGE_SIZE - 1)
+        first = address & page_mask
+        last = (address + size - 1) & page_mask
+        if first == last:
+            data = self._get_page(first)
+        else:
+            data = ''.join(self._get_page(p) for p in xrange(first, last + 1, PageCache.PAGE_SIZE))
+        offset = address - first
+        return memoryview(data)[offset:offset + size]
+#
 class Process(object):
     """An abstraction representing a debugged process."""
 
@@ -96,9 +500,10 @@ class Process(object):
     PAGE_NOCACHE = 0x00000200
     PAGE_WRITECOMBINE = 0x00000400
 
-    def __init__(self, pid, handle, base_address):
+    def __init__(self, pid, handle, base_address, backend):
         self.id = pid
         self.handle = handle
+        self.backend = backend
         self.base_address = base_address
         self.image = None
         self.initial_thread = None
@@ -106,19 +511,73 @@ class Process(object):
         self.threads = {}
         self.modules = {}
         self.breakpoints = {}
+        self.breakpoint_manager = BreakpointManager(self)
+        self.hw_breakpoints = HwBreakpointManager(self)
+        # Thread id -> auto_rearm Breakpoint to re-arm after a single step
+        self.pending_rearm = {}
+        # Module interval index: sorted bases, with the modules and their
+        # end addresses (None until first needed) in the same order.
+        self._module_bases = []
+        self._module_list = []
+        self._module_ends = []
+        # A PageCache, if enabled
+        self.cache = None
     def __str__(self):
         return '[%05d]' % (self.id)
 
-    def get_module_from_va(self, address):
-        for m in self.modules.values():
-            base = m.base_address
-            if base <= address < (base + m.mapped_size):
-                return m
+    def enable_cache(self):
+        "Cache memory reads page-wise while the process is stopped"
+        if self.cache is None:
+            self.cache = PageCache(self._read_memory)
+    def disable_cache(self):
+        self.cache = None
+
+    def _add_module(self, module):
+        pos = bisect.bisect_left(self._module_bases, module.base_address)
+        self._module_bases.insert(pos, module.base_address)
+        self._module_list.insert(pos, module)
+        self._module_ends.insert(pos, None)
+    def _remove_module(self, module):
+        pos = bisect.bisect_left(self._module_bases, module.base_address)
+        del self._module_bases[pos]
+        del self._module_list[pos]
+        del self._module_ends[pos]
+
+    def _module_at(self, pos, address):
+        "Module #pos of the index if it contains the address"
+        if pos < 0:
+            return None
+        end = self._module_ends[pos]
+        if end is None:
+            m = self._module_list[pos]
+            end = m.base_address + m.mapped_size
+            self._module_ends[pos] = end
+        if address < end:
+            return self._module_list[pos]
         return None
 
+    def get_module_from_va(self, address):
+        return self._module_at(bisect.bisect_right(self._module_bases, address) - 1, address)
+
+    def get_modules_from_va(self, addresses):
+        "Batch get_module_from_va() for e.g. a stack trace or a coverage list"
+        bases = self._module_bases
+        result = [None] * len(addresses)
+        pos = -1
+        for i in sorted(xrange(len(addresses)), key=addresses.__getitem__):
+            address = addresses[i]
+            # Addresses are visited in order, so the module cursor only advances
+            while pos + 1 < len(bases) and bases[pos + 1] <= address:
+                pos += 1
+            result[i] = self._module_at(pos, address)
+        return result
+
     def get_location_from_va(self, address):
         return Location(address, self.get_module_from_va(address))
 
+    def get_locations_from_va(self, addresses):
+        return [Location(a, m) for a, m in zip(addresses, self.get_modules_from_va(addresses))]
+
     def get_breakpoint(self, address):
         address = long(address)
         try:
@@ -129,17 +588,30 @@ class Process(object):
             return bp
 
     def terminate(self, exit_code=0xDEADBEEFL):
-        _bones.process_terminate(self.handle, exit_code)
+        self.backend.process_terminate(self.handle, exit_code)
+    def _read_memory(self, address, size):
+        return self.backend.vmem_read(self.handle, address, size)
     def read_memory(self, address, size):
-        return _bones.vmem_read(self.handle, address, size)
+        if self.cache is not None:
+            return self.cache.read_view(address, size).tobytes()
+        return self.backend.vmem_read(self.handle, address, size)
+    def read_memory_view(self, address, size):
+        "Same as read_memory(), but avoids copying when cached"
+        if self.cache is not None:
+            return self.cache.read_view(address, size)
+        return memoryview(self.backend.vmem_read(self.handle, address, size))
     def write_memory(self, address, buffer):
-        return _bones.vmem_write(self.handle, address, buffer)
+        if self.cache is not None:
+            self.cache.invalidate(address, len(buffer))
+        return self.backend.vmem_write(self.handle, address, buffer)
     def query_memory(self, address):
-        return _bones.vmem_query(self.handle, address)
+        return self.backend.vmem_query(self.handle, address)
     def protect_memory(self, address, size, protect):
-        return _bones.vmem_protect(self.handle, address, size, protect)
+        if self.cache is not None:
+            self.cache.invalidate(address, size)
+        return self.backend.vmem_protect(self.handle, address, size, protect)
     def query_section_name(self, address):
-        return _bones.vmem_query_section_name(self.handle, address)
+        return self.backend.vmem_query_section_name(self.handle, address)
 #
 
 class Thread(object):
@@ -151,25 +623,29 @@ class Thread(object):
         self.start_address = start_address
         self.is_initial = False
         self.exit_status = None
+        # Single stepped throughout, e.g. by steptrace.Tracer
+        self.tracing = False
     def __str__(self):
         return '[%05d/%05d]' % (self.process.id, self.id)
 
     def __get_context(self):
-        return _bones.thread_get_context(self.handle)
+        return self.process.backend.thread_get_context(self.handle)
     def __set_context(self, value):
-        return _bones.thread_set_context(self.handle, value)
+        return self.process.backend.thread_set_context(self.handle, value)
     context = property(__get_context, __set_context, None, "Thread context")
 
     def __get_teb(self):
-        return _bones.thread_get_teb(self.handle)
+        return self.process.backend.thread_get_teb(self.handle)
     teb_address = property(__get_teb, None, None, "Thread's TEB address")
 
     def set_single_step(self):
-        _bones.thread_set_single_step(self.handle)
+        self.process.backend.thread_set_single_step(self.handle)
     def suspend(self):
-        return _bones.thread_suspend(self.handle)
+        return self.process.backend.thread_suspend(self.handle)
     def resume(self):
-        return _bones.thread_resume(self.handle)
+        if self.process.cache is not None:
+            self.process.cache.clear()
+        return self.process.backend.thread_resume(self.handle)
 #
 
 class Module(object):
@@ -181,14 +657,32 @@ class Module(object):
     def __str__(self):
         return '%08X: %s' % (self.base_address, self.name)
 
+    def __get_image(self):
+        try:
+            return self._image
+        except AttributeError:
+            # The mapped image: section names are NT device paths, not
+            # openable files; the path only keys the header cache
+            try:
+                self._image = pe.read_image(self.process.read_memory, self.base_address, self.path)
+            except (ValueError, EnvironmentError, struct.error, NtStatusError):
+                self._image = None
+            return self._image
+
     def __get_entry_point(self):
-        # TODO
-        return None
+        image = self.image
+        if image is None or not image.entry_point:
+            return None
+        return self.base_address + image.entry_point
 
     def __get_mapped_size(self):
         try:
             return self._mapped_size
         except:
+            image = self.image
+            if image is not None:
+                self._mapped_size = image.size_of_image
+                return self._mapped_size
             size = 0
             address = self.base_address
             while True:
@@ -199,7 +693,7 @@ class Module(object):
                     # Hit another module?
                     if self.process.query_section_name(address) != self.path:
                         break
-                except _bones.NtStatusError:
+                except NtStatusError:
                     # Hit unallocated space?
                     break
             self._mapped_size = size
@@ -215,8 +709,20 @@ class Module(object):
             self._path = self.process.query_section_name(self.base_address)
             return self._path
 
+    def symbolize(self, address):
+        "module!export+0xN for an address within the module"
+        name = os.path.splitext(self.name)[0]
+        image = self.image
+        if image is not None:
+            found = image.nearest_export(address - self.base_address)
+            if found is not None:
+                return '%s!%s+0x%x' % (name, found[0], found[1])
+        return '%s+0x%x' % (name, address - self.base_address)
+
     name = property(__get_name, None, None, "Module file name")
     path = property(__get_path, None, None, "Module file path")
+    image = property(__get_image, None, None, "Module's parsed PE headers and exports, or None")
+    entry_point = property(__get_entry_point, None, None, "Module's entry point address, or None")
     mapped_size = property(__get_mapped_size, None, None, "Module's size in virtual memory")
 #
 
@@ -226,9 +732,13 @@ class ExceptionInfo(object):
     def __str__(self):
         return "Exception %08X at address %08X" % (self.code, self.address)
     def __eq__(self, other):
-        if other is not ExceptionInfo:
+        if not isinstance(other, ExceptionInfo):
             return False
         return self.code == other.code and self.address == other.address
+    def __ne__(self, other):
+        return not self == other
+    def __hash__(self):
+        return hash((self.code, self.address))
 class AccessViolationInfo(ExceptionInfo):
     __kind_map = { 0: 'read', 1: 'write', 8: 'dep' }
     def __init__(self, info):
@@ -239,16 +749,146 @@ class AccessViolationInfo(ExceptionInfo):
         return "Access violation at %08X: %s %08X" % (self.address, self.kind, self.target)
 #
 
-class Debugger(_bones.Debugger):
+class Backend(object):
+    """The interface between the debugger object and the system.
+
+    A backend generates debug events from wait_event() by calling the
+    bound debugger's _on_* handlers, and services the process, thread
+    and memory requests of the objects the debugger creates.
+    """
+
+    def bind(self, debugger):
+        "Route debug events to the given debugger"
+        raise NotImplementedError()
+
+    def spawn(self, cmdline):
+        raise NotImplementedError()
+    def attach(self, process_handle):
+        raise NotImplementedError()
+    def detach(self, process_handle):
+        raise NotImplementedError()
+    def wait_event(self, timeout=None):
+        "Dispatch one debug event; return False on timeout"
+        raise NotImplementedError()
+
+    def process_terminate(self, handle, exit_code):
+        raise NotImplementedError()
+
+    def thread_get_context(self, handle):
+        raise NotImplementedError()
+    def thread_set_context(self, handle, context):
+        raise NotImplementedError()
+    def thread_get_teb(self, handle):
+        raise NotImplementedError()
+    def thread_set_single_step(self, handle):
+        raise NotImplementedError()
+    def thread_suspend(self, handle):
+        raise NotImplementedError()
+    def thread_resume(self, handle):
+        raise NotImplementedError()
+
+    def vmem_read(self, handle, address, size):
+        raise NotImplementedError()
+    def vmem_write(self, handle, address, buffer):
+        raise NotImplementedError()
+    def vmem_query(self, handle, address):
+        raise NotImplementedError()
+    def vmem_protect(self, handle, address, size, protect):
+        raise NotImplementedError()
+    def vmem_query_section_name(self, handle, address):
+        raise NotImplementedError()
+#
+
+# The handlers a backend dispatches debug events to
+EVENT_HANDLERS = (
+    '_on_process_create',
+    '_on_process_exit',
+    '_on_thread_create',
+    '_on_thread_exit',
+    '_on_module_load',
+    '_on_module_unload',
+    '_on_exception',
+    '_on_breakpoint',
+    '_on_single_step',
+    )
+
+if _bones is not None:
+    class NativeBackend(_bones.Debugger, Backend):
+        """The NT debugging API backend, as implemented by _bones."""
+
+        def bind(self, debugger):
+            # _bones.Debugger dispatches events via self._on_*, so bind
+            # these straight to the debugger's handlers.
+            for name in EVENT_HANDLERS:
+                setattr(self, name, getattr(debugger, name))
+
+        process_terminate = staticmethod(_bones.process_terminate)
+
+        thread_get_context = staticmethod(_bones.thread_get_context)
+        thread_set_context = staticmethod(_bones.thread_set_context)
+        thread_get_teb = staticmethod(_bones.thread_get_teb)
+        thread_set_single_step = staticmethod(_bones.thread_set_single_step)
+        thread_suspend = staticmethod(_bones.thread_suspend)
+        thread_resume = staticmethod(_bones.thread_resume)
+
+        vmem_read = staticmethod(_bones.vmem_read)
+        vmem_write = staticmethod(_bones.vmem_write)
+        vmem_query = staticmethod(_bones.vmem_query)
+        vmem_protect = staticmethod(_bones.vmem_protect)
+        vmem_query_section_name = staticmethod(_bones.vmem_query_section_name)
+    #
+else:
+    NativeBackend = None
+
+class Debugger(object):
     """The debugger object.
 
-    The object provides access to debugging capabilities on the system.
+    The object provides access to debugging capabilities on the system,
+    through the NT debugging API by default or any other Backend.
     """
 
-    def __init__(self):
-        _bones.Debugger.__init__(self)
+    DBG_EXCEPTION_HANDLED = 0x00010001L
+    DBG_CONTINUE = 0x00010002L
+    DBG_EXCEPTION_NOT_HANDLED = 0x80010001L
+    DBG_TERMINATE_THREAD = 0x40010003L
+    DBG_TERMINATE_PROCESS = 0x40010004L
+
+    def __init__(self, backend=None, recorder=None):
+        if backend is None:
+            if NativeBackend is None:
+                raise BonesError('The native backend is not available.')
+            backend = NativeBackend()
+        self.backend = backend
+        backend.bind(self)
+        # An eventlog.EventRecorder, if the events are to be logged
+        self.recorder = recorder
         self.processes = {}
 
+    def spawn(self, cmdline):
+        "Spawn and attach to the process"
+        self.backend.spawn(cmdline)
+    def attach(self, process_handle):
+        "Attach to a process"
+        self.backend.attach(process_handle)
+    def detach(self, process_handle):
+        "Detach from the given process"
+        self.backend.detach(process_handle)
+    def wait_event(self, timeout=None):
+        "Wait for a debugging event for a specified timeout in ms; False if none occurs"
+        # Targets run between (and after) events: drop cached memory
+        self._clear_caches()
+        try:
+            if timeout is None:
+                return self.backend.wait_event()
+            return self.backend.wait_event(timeout)
+        finally:
+            self._clear_caches()
+
+    def _clear_caches(self):
+        for process in self.processes.itervalues():
+            if process.cache is not None:
+                process.cache.clear()
+
     # These event handlers are designed to be overridden as needed when subclassing
 
     def on_process_create_begin(self, process):
@@ -275,9 +915,15 @@ class Debugger(_bones.Debugger):
     def on_breakpoint(self, thread, context, bp):
         "Called when a breakpoint exception occurs"
         pass
+    def on_managed_breakpoint(self, thread, context, address):
+        "Called when a BreakpointManager breakpoint is hit (it is disarmed by then)"
+        pass
     def on_single_step(self, thread):
         "Called when a single step exception occurs"
         pass
+    def on_hw_breakpoint(self, thread, context, breakpoints):
+        "Called when hardware breakpoints are hit (DR6 is cleared by then)"
+        pass
     def on_exception(self, thread, info, first_chance):
         "Called when an exception occurs (other than SS/BP)"
         return Debugger.DBG_EXCEPTION_NOT_HANDLED
@@ -286,14 +932,16 @@ class Debugger(_bones.Debugger):
 
     def _on_process_create(self, pid, process_handle, tid, thread_handle, base_address, start_address):
         """The DbgCreateProcessStateChange handler."""
-        process = Process(pid, process_handle, base_address)
+        if self.recorder is not None:
+            self.recorder.process_create(pid, process_handle, tid, thread_handle, base_address, start_address)
+        process = Process(pid, process_handle, base_address, self.backend)
         self.processes[pid] = process
         self.on_process_create_begin(process)
-        # Fake the main module load
-        self._on_module_load(pid, base_address)
+        # Fake the main module load (not recorded, implied by this event)
+        self._handle_module_load(pid, base_address)
         process.image = process.modules[base_address]
         # Fake the initial thread creation
-        self._on_thread_create(pid, tid, thread_handle, start_address)
+        self._handle_thread_create(pid, tid, thread_handle, start_address)
         initial_thread = process.threads[tid]
         initial_thread.is_initial = True
         process.initial_thread = initial_thread
@@ -303,6 +951,8 @@ class Debugger(_bones.Debugger):
 
     def _on_process_exit(self, pid, exit_status):
         """The DbgExitProcessStateChange handler."""
+        if self.recorder is not None:
+            self.recorder.process_exit(pid, exit_status)
         process = self.processes[pid]
         process.exit_status = exit_status
         del self.processes[pid]
@@ -311,34 +961,52 @@ class Debugger(_bones.Debugger):
 
     def _on_thread_create(self, pid, tid, handle, start_address):
         """The DbgCreateThreadStateChange handler."""
+        if self.recorder is not None:
+            self.recorder.thread_create(pid, tid, handle, start_address)
+        return self._handle_thread_create(pid, tid, handle, start_address)
+
+    def _handle_thread_create(self, pid, tid, handle, start_address):
         process = self.processes[pid]
         thread = Thread(tid, handle, process, start_address)
         process.threads[tid] = thread
+        process.hw_breakpoints.on_thread_create(thread)
         self.on_thread_create(thread)
         return Debugger.DBG_CONTINUE
 
     def _on_thread_exit(self, pid, tid, exit_status):
         """The DbgExitThreadStateChange handler."""
+        if self.recorder is not None:
+            self.recorder.thread_exit(pid, tid, exit_status)
         process = self.processes[pid]
         thread = process.threads[tid]
         thread.exit_status = exit_status
         del process.threads[tid]
+        process.hw_breakpoints.on_thread_exit(thread)
         self.on_thread_exit(thread)
         return Debugger.DBG_CONTINUE
 
     def _on_module_load(self, pid, base_address):
         """The DbgLoadDllStateChange handler."""
+        if self.recorder is not None:
+            self.recorder.module_load(pid, base_address)
+        return self._handle_module_load(pid, base_address)
+
+    def _handle_module_load(self, pid, base_address):
         process = self.processes[pid]
         module = Module(base_address, process)
         process.modules[base_address] = module
+        process._add_module(module)
         self.on_module_load(module)
         return Debugger.DBG_CONTINUE
 
     def _on_module_unload(self, pid, base_address):
         """The DbgUnloadDllStateChange handler."""
+        if self.recorder is not None:
+            self.recorder.module_unload(pid, base_address)
         process = self.processes[pid]
         module = process.modules[base_address]
         del process.modules[base_address]
+        process._remove_module(module)
         self.on_module_unload(module)
         return Debugger.DBG_CONTINUE
 
@@ -346,6 +1014,9 @@ class Debugger(_bones.Debugger):
         """The DbgExceptionStateChange handler."""
         process = self.processes[pid]
         thread = process.threads[tid]
+        if self.recorder is not None:
+            # The handlers look at the context; replays need it too
+            self.recorder.exception(pid, tid, info, first_chance, thread.handle, thread.context)
         if info[0] == 0xC0000005L:
             xinfo = AccessViolationInfo(info)
         else:
@@ -358,26 +1029,73 @@ class Debugger(_bones.Debugger):
         process = self.processes[pid]
         thread = process.threads[tid]
         context = thread.context
-        context.eip -= 1
-        bp = None
-        try:
-            bp = process.breakpoints[context.eip]
+        if self.recorder is not None:
+            # Logged as the handlers get it
+            self.recorder.breakpoint(pid, tid, thread.handle, context)
+        address = context.eip - 1
+        manager = process.breakpoint_manager
+        slot = manager.slots.get(address)
+        if slot is not None and manager.armed[slot]:
+            context.eip = address
+            if manager.on_hit(slot, tid) or thread.tracing:
+                # Step over the original instruction, then re-arm
+                context.eflags.tf = True
+            thread.context = context
+            self.on_managed_breakpoint(thread, context, address)
+            return Debugger.DBG_CONTINUE
+
+        context.eip = address
+        bp = process.breakpoints.get(address)
+        if bp is not None:
             bp.disarm()
+            if bp.auto_rearm:
+                process.pending_rearm[tid] = bp
+            if bp.auto_rearm or thread.tracing:
+                context.eflags.tf = True
             thread.context = context
-        except KeyError:
-            pass
+        elif thread.tracing:
+            thread.set_single_step()
 
         self.on_breakpoint(thread, context, bp)
 
-        if bp is not None and bp.auto_rearm:
-            pass
-
         return Debugger.DBG_CONTINUE
 
     def _on_single_step(self, pid, tid):
         """The DbgSingleStepStateChange handler."""
         process = self.processes[pid]
         thread = process.threads[tid]
+        context = None
+        if self.recorder is not None:
+            # Logged as the handlers get it
+            context = thread.context
+            self.recorder.single_step(pid, tid, thread.handle, context)
+        hw = process.hw_breakpoints
+        if tid in hw.threads:
+            if context is None:
+                context = thread.context
+            dr6 = context.dr6
+            if dr6 & (DR6_HITS | DR6_SINGLE_STEP):
+                # DR6 is sticky: clear what this event consumed
+                context.dr6 = dr6 & ~(DR6_HITS | DR6_SINGLE_STEP)
+                hits = hw.hits(tid, dr6)
+                for bp in hits:
+                    bp.hits += 1
+                    if bp.event == HwBreakpoint.EVENT_X:
+                        # Don't fault on the same instruction again
+                        context.eflags.rf = True
+                thread.context = context
+                if hits:
+                    self.on_hw_breakpoint(thread, context, hits)
+                    if not dr6 & DR6_SINGLE_STEP:
+                        return Debugger.DBG_CONTINUE
+        # Stepped over a breakpoint to be re-armed? Traced threads step on.
+        if process.breakpoint_manager.on_step(tid) and not thread.tracing:
+            return Debugger.DBG_CONTINUE
+        bp = process.pending_rearm.pop(tid, None)
+        if bp is not None:
+            bp.arm()
+            if not thread.tracing:
+                return Debugger.DBG_CONTINUE
         self.on_single_step(thread)
         return Debugger.DBG_CONTINUE
 #
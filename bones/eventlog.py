@@ -0,0 +1,206 @@
+"""
+Layer 2 of the METALBONES core -- Python wrappers.
+
+Compact binary log of the debug events dispatched by dbg.Debugger.
+
+The log is a header followed by 32-byte records:
+
+    kind:u8 flags:u8 extra:u16 pid:u32 tid:u32 a0..a4:u32
+
+Exception, breakpoint and single step records may carry the thread's
+context (flag FLAG_CONTEXT, a0: thread handle): the registers follow the
+record in CONTEXT_REGISTERS order, as u32 words. Exception records then
+have `extra` bytes of u32 words: for each exception in the nested chain,
+code, address, flags, argument count and the arguments themselves.
+
+Only events and contexts are logged, not target memory. Replaying a run
+whose handlers read memory (e.g. to arm breakpoints) needs that memory
+set up on the ReplayBackend with add_region(), e.g. from the module
+images; otherwise the reads fail with NtStatusError.
+"""
+
+import mmap
+import struct
+import replay
+
+MAGIC = 'BNEVLOG1'
+
+EV_PROCESS_CREATE = 1
+EV_PROCESS_EXIT = 2
+EV_THREAD_CREATE = 3
+EV_THREAD_EXIT = 4
+EV_MODULE_LOAD = 5
+EV_MODULE_UNLOAD = 6
+EV_EXCEPTION = 7
+EV_BREAKPOINT = 8
+EV_SINGLE_STEP = 9
+
+# Record flags; exceptions keep the first chance flag in bit 0
+FLAG_FIRST_CHANCE = 1
+FLAG_CONTEXT = 2
+
+# As packed by the contexts' pack()
+CONTEXT_REGISTERS = replay.Context.__slots__
+CONTEXT_SIZE = 4 * len(CONTEXT_REGISTERS)
+
+_record = struct.Struct('<BBHIIIIIII')
+RECORD_SIZE = _record.size
+
+def _pack_exception(info):
+    words = []
+    while info is not None:
+        code, address, flags, args, info = info
+        words.extend((code, address, flags, len(args)))
+        words.extend(args)
+    return struct.pack('<%dI' % len(words), *words)
+_context = struct.Struct('<%dI' % len(CONTEXT_REGISTERS))
+def _unpack_context(buffer, offset):
+    return replay.Context(**dict(zip(CONTEXT_REGISTERS, _context.unpack_from(buffer, offset))))
+def _unpack_exception(buffer, offset, size):
+    words = struct.unpack_from('<%dI' % (size // 4), buffer, offset)
+    chain = []
+    pos = 0
+    while pos < len(words):
+        code, address, flags, nargs = words[pos:pos + 4]
+        pos += 4
+        chain.append((code, address, flags, words[pos:pos + nargs]))
+        pos += nargs
+    info = None
+    for code, address, flags, args in reversed(chain):
+        info = (long(code), long(address), long(flags), tuple(long(x) for x in args), info)
+    return info
+
+class EventRecorder(object):
+    """Appends debug events to a log file.
+
+    Records are packed into a list and written out every `flush_every`
+    records, on flush() and on close().
+    """
+    def __init__(self, path, flush_every=4096):
+        self.fp = open(path, 'wb')
+        self.fp.write(MAGIC)
+        self.flush_every = flush_every
+        self._pending = []
+        self._pack = _record.pack
+
+    def flush(self):
+        if self._pending:
+            self.fp.write(''.join(self._pending))
+            del self._pending[:]
+        self.fp.flush()
+    def close(self):
+        self.flush()
+        self.fp.close()
+
+    # The record methods below are on the hot path: each is kept to a
+    # single pack and append, with the flush check inlined.
+
+    def process_create(self, pid, process_handle, tid, thread_handle, base_address, start_address):
+        pending = self._pending
+        pending.append(self._pack(EV_PROCESS_CREATE, 0, 0, pid, tid, process_handle, thread_handle, base_address, start_address, 0))
+        if len(pending) >= self.flush_every:
+            self.flush()
+    def process_exit(self, pid, exit_status):
+        pending = self._pending
+        pending.append(self._pack(EV_PROCESS_EXIT, 0, 0, pid, 0, exit_status, 0, 0, 0, 0))
+        if len(pending) >= self.flush_every:
+            self.flush()
+    def thread_create(self, pid, tid, handle, start_address):
+        pending = self._pending
+        pending.append(self._pack(EV_THREAD_CREATE, 0, 0, pid, tid, handle, start_address, 0, 0, 0))
+        if len(pending) >= self.flush_every:
+            self.flush()
+    def thread_exit(self, pid, tid, exit_status):
+        pending = self._pending
+        pending.append(self._pack(EV_THREAD_EXIT, 0, 0, pid, tid, exit_status, 0, 0, 0, 0))
+        if len(pending) >= self.flush_every:
+            self.flush()
+    def module_load(self, pid, base_address):
+        pending = self._pending
+        pending.append(self._pack(EV_MODULE_LOAD, 0, 0, pid, 0, base_address, 0, 0, 0, 0))
+        if len(pending) >= self.flush_every:
+            self.flush()
+    def module_unload(self, pid, base_address):
+        pending = self._pending
+        pending.append(self._pack(EV_MODULE_UNLOAD, 0, 0, pid, 0, base_address, 0, 0, 0, 0))
+        if len(pending) >= self.flush_every:
+            self.flush()
+    # The thread's context (a _bones or replay Context) goes with the
+    # events whose handlers look at it, packed in one call
+
+    def exception(self, pid, tid, info, first_chance, thread_handle=0, context=None):
+        extra = _pack_exception(info)
+        pending = self._pending
+        if context is None:
+            pending.append(self._pack(EV_EXCEPTION, first_chance, len(extra), pid, tid, 0, 0, 0, 0, 0) + extra)
+        else:
+            pending.append(self._pack(EV_EXCEPTION, first_chance | FLAG_CONTEXT, len(extra), pid, tid,
+                thread_handle, 0, 0, 0, 0) + context.pack() + extra)
+        if len(pending) >= self.flush_every:
+            self.flush()
+    def breakpoint(self, pid, tid, thread_handle=0, context=None):
+        pending = self._pending
+        if context is None:
+            pending.append(self._pack(EV_BREAKPOINT, 0, 0, pid, tid, 0, 0, 0, 0, 0))
+        else:
+            pending.append(self._pack(EV_BREAKPOINT, FLAG_CONTEXT, 0, pid, tid, thread_handle, 0, 0, 0, 0) + context.pack())
+        if len(pending) >= self.flush_every:
+            self.flush()
+    def single_step(self, pid, tid, thread_handle=0, context=None):
+        pending = self._pending
+        if context is None:
+            pending.append(self._pack(EV_SINGLE_STEP, 0, 0, pid, tid, 0, 0, 0, 0, 0))
+        else:
+            pending.append(self._pack(EV_SINGLE_STEP, FLAG_CONTEXT, 0, pid, tid, thread_handle, 0, 0, 0, 0) + context.pack())
+        if len(pending) >= self.flush_every:
+            self.flush()
+#
+class EventLog(object):
+    """Reads an event log back through mmap.
+
+    Iterating yields events in the form replay.ReplayBackend consumes:
+    the handler name followed by its arguments.
+    """
+    def __init__(self, path):
+        self.fp = open(path, 'rb')
+        self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError('Not an event log')
+    def close(self):
+        self.map.close()
+        self.fp.close()
+    def __iter__(self):
+        buffer = self.map
+        unpack_from = _record.unpack_from
+        offset = len(MAGIC)
+        end = len(buffer)
+        while offset + RECORD_SIZE <= end:
+            kind, flags, extra, pid, tid, a0, a1, a2, a3, a4 = unpack_from(buffer, offset)
+            offset += RECORD_SIZE
+            if flags & FLAG_CONTEXT:
+                yield ('context', a0, _unpack_context(buffer, offset))
+                offset += CONTEXT_SIZE
+            if kind == EV_PROCESS_CREATE:
+                yield ('_on_process_create', pid, a0, tid, a1, a2, a3)
+            elif kind == EV_PROCESS_EXIT:
+                yield ('_on_process_exit', pid, a0)
+            elif kind == EV_THREAD_CREATE:
+                yield ('_on_thread_create', pid, tid, a0, a1)
+            elif kind == EV_THREAD_EXIT:
+                yield ('_on_thread_exit', pid, tid, a0)
+            elif kind == EV_MODULE_LOAD:
+                yield ('_on_module_load', pid, a0)
+            elif kind == EV_MODULE_UNLOAD:
+                yield ('_on_module_unload', pid, a0)
+            elif kind == EV_EXCEPTION:
+                info = _unpack_exception(buffer, offset, extra)
+                offset += extra
+                yield ('_on_exception', pid, tid, info, bool(flags & FLAG_FIRST_CHANCE))
+            elif kind == EV_BREAKPOINT:
+                yield ('_on_breakpoint', pid, tid)
+            elif kind == EV_SINGLE_STEP:
+                yield ('_on_single_step', pid, tid)
+            else:
+                raise ValueError('Unknown event record kind %d at %08x' % (kind, offset - RECORD_SIZE))
+# EOF
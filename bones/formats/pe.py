@@ -0,0 +1,200 @@
+"""Portable Executable headers and exports"""
+
+import os
+import mmap
+import array
+import bisect
+import struct
+
+DOS_SIGNATURE = 'MZ'
+NT_SIGNATURE = 'PE\0\0'
+
+OPTIONAL_MAGIC_PE32 = 0x10B
+OPTIONAL_MAGIC_PE32_PLUS = 0x20B
+
+DIRECTORY_EXPORT = 0
+
+SCN_MEM_EXECUTE = 0x20000000
+
+# Enough for the headers of any sane image
+HEADERS_SIZE = 0x1000
+
+_file_header = struct.Struct('<4sHHIIIHH')
+_section_header = struct.Struct('<8sIIIIIIHHI')
+_export_directory = struct.Struct('<IIHHIIIIIII')
+
+class Section:
+    def __init__(self, name, virtual_size, virtual_address, raw_size, raw_offset, characteristics):
+        self.name = name
+        self.virtual_size = virtual_size
+        self.virtual_address = virtual_address
+        self.raw_size = raw_size
+        self.raw_offset = raw_offset
+        self.characteristics = characteristics
+    def __str__(self):
+        return '%-8s %08x~%08x' % (self.name, self.virtual_address, self.virtual_address + self.virtual_size)
+
+class PEImage:
+    """Headers and exports of a PE image.
+
+    Addresses are RVAs. Exports are kept sorted by address, for looking up
+    the export nearest to an address; forwarders are left out.
+    """
+    def __init__(self, headers):
+        if headers[:2] != DOS_SIGNATURE:
+            raise ValueError('Invalid DOS signature')
+        nt_offset = struct.unpack_from('<I', headers, 0x3C)[0]
+        (signature, self.machine, section_count, self.timestamp, _, _,
+            optional_size, self.characteristics) = _file_header.unpack_from(headers, nt_offset)
+        if signature != NT_SIGNATURE:
+            raise ValueError('Invalid NT signature')
+        optional = nt_offset + _file_header.size
+        magic = struct.unpack_from('<H', headers, optional)[0]
+        if magic == OPTIONAL_MAGIC_PE32:
+            self.image_base = struct.unpack_from('<I', headers, optional + 28)[0]
+            directories = optional + 96
+        elif magic == OPTIONAL_MAGIC_PE32_PLUS:
+            self.image_base = struct.unpack_from('<Q', headers, optional + 24)[0]
+            directories = optional + 112
+        else:
+            raise ValueError('Unknown optional header magic %04x' % magic)
+        self.entry_point = struct.unpack_from('<I', headers, optional + 16)[0]
+        self.size_of_image, self.size_of_headers = struct.unpack_from('<II', headers, optional + 56)
+        count = struct.unpack_from('<I', headers, directories - 4)[0]
+        self.directories = [struct.unpack_from('<II', headers, directories + 8 * i) for i in xrange(min(count, 16))]
+
+        self.sections = []
+        offset = optional + optional_size
+        for i in xrange(section_count):
+            fields = _section_header.unpack_from(headers, offset + i * _section_header.size)
+            self.sections.append(Section(fields[0].rstrip('\0'), *(fields[1:5] + fields[9:])))
+
+        self.dll_name = None
+        # Export name -> RVA, and the same sorted by RVA
+        self.exports = {}
+        self.export_rvas = array.array('I')
+        self.export_names = []
+
+    def directory(self, index):
+        "(rva, size) of a data directory; (0, 0) if absent"
+        if index < len(self.directories):
+            return self.directories[index]
+        return 0, 0
+
+    def rva_to_offset(self, rva):
+        "File offset of an RVA, or None if it isn't backed by the file"
+        if rva < self.size_of_headers:
+            return rva
+        for s in self.sections:
+            if s.virtual_address <= rva < s.virtual_address + max(s.virtual_size, s.raw_size):
+                if rva - s.virtual_address >= s.raw_size:
+                    return None
+                return s.raw_offset + rva - s.virtual_address
+        return None
+
+    def is_executable(self, rva):
+        "Whether the RVA is in an executable section"
+        for s in self.sections:
+            if s.virtual_address <= rva < s.virtual_address + max(s.virtual_size, s.raw_size):
+                return bool(s.characteristics & SCN_MEM_EXECUTE)
+        return False
+
+    def parse_exports(self, read):
+        "Load the export table; read(rva, size) returns up to `size` bytes at the RVA"
+        start, size = self.directory(DIRECTORY_EXPORT)
+        if not size:
+            return
+        (_, _, _, _, name, ordinal_base, function_count, name_count,
+            functions, names, ordinals) = _export_directory.unpack(read(start, _export_directory.size))
+        def string(rva):
+            data = read(rva, 256)
+            return data[:data.find('\0')] if '\0' in data else data
+        self.dll_name = string(name)
+        function_rvas = array.array('I', read(functions, function_count * 4))
+        names_of = {}
+        if name_count:
+            name_rvas = array.array('I', read(names, name_count * 4))
+            name_ordinals = array.array('H', read(ordinals, name_count * 2))
+            for name_rva, index in zip(name_rvas, name_ordinals):
+                names_of[index] = string(name_rva)
+        exports = []
+        for index, rva in enumerate(function_rvas):
+            # Forwarders point into the export directory itself
+            if not rva or start <= rva < start + size:
+                continue
+            name = names_of.get(index)
+            if name is None:
+                name = '#%d' % (ordinal_base + index)
+            self.exports[name] = rva
+            exports.append((rva, name))
+        exports.sort()
+        self.export_rvas = array.array('I', [e[0] for e in exports])
+        self.export_names = [e[1] for e in exports]
+
+    def nearest_export(self, rva):
+        "(name, displacement) of the closest export at or below the RVA, or None"
+        i = bisect.bisect_right(self.export_rvas, rva) - 1
+        if i < 0 or rva >= self.size_of_image:
+            return None
+        return self.export_names[i], rva - self.export_rvas[i]
+
+def parse(data):
+    "Parse an image file's contents (a string or an mmap)"
+    image = PEImage(data)
+    def read(rva, size):
+        offset = image.rva_to_offset(rva)
+        if offset is None:
+            raise ValueError('RVA %08x is not in the file' % rva)
+        return data[offset:offset + size]
+    image.parse_exports(read)
+    return image
+
+# path -> ((mtime, size), PEImage)
+_file_cache = {}
+# (path, timestamp, size_of_image) -> PEImage
+_memory_cache = {}
+
+def load(path):
+    "Parse an image file, memory-mapped; cached until the file changes"
+    st = os.stat(path)
+    stamp = st.st_mtime, st.st_size
+    try:
+        cached_stamp, image = _file_cache[path]
+        if cached_stamp == stamp:
+            return image
+    except KeyError:
+        pass
+    fp = open(path, 'rb')
+    try:
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            image = parse(data)
+        finally:
+            data.close()
+    finally:
+        fp.close()
+    _file_cache[path] = stamp, image
+    return image
+
+def read_image(read, base, path=None):
+    """Parse an image mapped at `base`; read(address, size) reads memory.
+
+    One read gets the headers and one more the whole export directory.
+    With the image's path given, images are cached by path and link time,
+    so later loads of the same file cost just the headers read.
+    """
+    image = PEImage(read(base, HEADERS_SIZE))
+    key = path, image.timestamp, image.size_of_image
+    if path is not None and key in _memory_cache:
+        return _memory_cache[key]
+    start, size = image.directory(DIRECTORY_EXPORT)
+    if size:
+        blob = read(base + start, size)
+        def read_export(rva, count):
+            if start <= rva < start + size:
+                return blob[rva - start:rva - start + count]
+            return read(base + rva, count)
+        image.parse_exports(read_export)
+    if path is not None:
+        _memory_cache[key] = image
+    return image
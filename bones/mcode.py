@@ -1,6 +1,12 @@
 import sys
 import functools
 
+try:
+    import numpy
+except ImportError:
+    # Only AddressTable needs it
+    numpy = None
+
 class Error(Exception):
     """Base class for errors raised in this module."""
     pass
@@ -79,6 +85,35 @@ class MemoryRef:
         self.seg = seg
     def __str__(self):
         return 'Base: %s Index: %s Scale: %s Displacement: %s' % (self.base, self.index, self.scale, self.displ)
+    def access_size(self):
+        "Bytes accessed"
+        return _opwidth_bits[self.size] >> 3
+    def address_mask(self):
+        "Offsets wrap at 64K with 16-bit addressing, at 4G otherwise"
+        for reg in (self.base, self.index):
+            if reg is not None:
+                return 0xFFFF if reg.size == OPW_16BIT else 0xFFFFFFFF
+        if self.displ is not None and self.displ.size == OPW_16BIT:
+            return 0xFFFF
+        return 0xFFFFFFFF
+    def evaluate(self, context, segment_bases=None):
+        """The linear address named, given the register values.
+
+        The context is a dict or an object (e.g. _bones.Context) with the
+        32-bit register values; segment_bases maps segment register names
+        to bases, e.g. {'fs': teb_address}; others are flat.
+        """
+        offset = 0
+        if self.base is not None:
+            offset += _register_value(context, self.base)
+        if self.index is not None:
+            offset += _register_value(context, self.index) * self.scale
+        if self.displ is not None:
+            offset += self.displ.get_value()
+        offset &= self.address_mask()
+        if segment_bases and self.seg is not None:
+            offset += segment_bases.get(self.seg.name, 0)
+        return offset & 0xFFFFFFFF
 #
 class Address:
     def __init__(self, seg, off):
@@ -94,6 +129,19 @@ class Register:
     def __str__(self):
         return self.name
 #
+def _register_value(context, reg):
+    "Value of an address register; 16-bit ones are the low half of the 32-bit"
+    name = reg.name
+    if reg.size == OPW_16BIT:
+        name = 'e' + name
+    if isinstance(context, dict):
+        value = context[name]
+    else:
+        value = getattr(context, name)
+    if reg.size == OPW_16BIT:
+        value &= 0xFFFF
+    return value
+
 
 _register_map = {
     "rax": Register("rax", OPW_64BIT),
@@ -181,6 +229,16 @@ _rfpu_decode = (
     _register_map["st(0)"], _register_map["st(1)"], _register_map["st(2)"], _register_map["st(3)"], 
     _register_map["st(4)"], _register_map["st(5)"], _register_map["st(6)"], _register_map["st(7)"],
     )
+class StringReader:
+    """Reads insn bytes from a string, for State"""
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+    def read(self):
+        b = ord(self.data[self.offset])
+        self.offset += 1
+        return b
+#
 class State:
     def __init__(self, reader):
         self.reader = reader
@@ -343,7 +401,7 @@ _modrm_lookup_16 = (
     (_register_map['bp'], _register_map['si'], _register_map['ss'], None),
     (_register_map['bp'], _register_map['di'], _register_map['ss'], None),
     (               None, _register_map['si'], _register_map['ds'], None),
-    (               None, _register_map['si'], _register_map['ds'], None),
+    (               None, _register_map['di'], _register_map['ds'], None),
     (               None,                None, _register_map['ds'], 1),
     (_register_map['bx'],                None, _register_map['ds'], None),
     
@@ -352,7 +410,7 @@ _modrm_lookup_16 = (
     (_register_map['bp'], _register_map['si'], _register_map['ss'], 0),
     (_register_map['bp'], _register_map['di'], _register_map['ss'], 0),
     (               None, _register_map['si'], _register_map['ds'], 0),
-    (               None, _register_map['si'], _register_map['ds'], 0),
+    (               None, _register_map['di'], _register_map['ds'], 0),
     (_register_map['bp'],                None, _register_map['ss'], 0),
     (_register_map['bx'],                None, _register_map['ds'], 0),
     
@@ -361,7 +419,7 @@ _modrm_lookup_16 = (
     (_register_map['bp'], _register_map['si'], _register_map['ss'], 1),
     (_register_map['bp'], _register_map['di'], _register_map['ss'], 1),
     (               None, _register_map['si'], _register_map['ds'], 1),
-    (               None, _register_map['si'], _register_map['ds'], 1),
+    (               None, _register_map['di'], _register_map['ds'], 1),
     (_register_map['bp'],                None, _register_map['ss'], 1),
     (_register_map['bx'],                None, _register_map['ds'], 1))
 _modrm_lookup_32 = (
@@ -444,7 +502,7 @@ def _decode_E_mem(state, size):
         d_size = l[2]
         if state.modrm_rm == 4:
             # SIB
-            scale = 1 << state.sib_scale
+            s = 1 << state.sib_scale
             i = _sib_index_lookup[state.sib_index]
             if not (state.modrm_mod == 0 and state.sib_base == 5):
                 b = _r32_decode[state.sib_base]
@@ -1598,6 +1656,78 @@ def decode(state):
     state.handler = decode_main_32
     return state.handler(state)
 
+def memory_operands(insn):
+    return [op for op in insn.operands if isinstance(op, MemoryRef)]
+
+def memory_addresses(insn, context, segment_bases=None):
+    "Linear addresses of the insn's memory operands, in operand order"
+    return [op.evaluate(context, segment_bases) for op in insn.operands if isinstance(op, MemoryRef)]
+
+# Column order of the register rows AddressTable.evaluate() takes
+TABLE_REGISTERS = ('eax', 'ecx', 'edx', 'ebx', 'esp', 'ebp', 'esi', 'edi')
+
+class AddressTable:
+    """Memory operand addressing of a set of insns, for batch evaluation.
+
+    Each insn's `operand`-th memory operand is reduced to register columns,
+    scale, displacement, address mask and segment base. evaluate() then
+    resolves a whole trace -- insn ids plus register rows -- with a few
+    NumPy array operations.
+    """
+    def __init__(self, insns, operand=0, segment_bases=None):
+        if numpy is None:
+            raise RuntimeError('AddressTable needs NumPy.')
+        count = len(insns)
+        # Column 8 of the padded register rows is all zeros
+        none = len(TABLE_REGISTERS)
+        self.base_column = numpy.full(count, none, dtype=numpy.intp)
+        self.index_column = numpy.full(count, none, dtype=numpy.intp)
+        self.scale = numpy.zeros(count, dtype=numpy.int64)
+        self.displ = numpy.zeros(count, dtype=numpy.int64)
+        self.mask = numpy.full(count, 0xFFFFFFFF, dtype=numpy.int64)
+        self.segment_base = numpy.zeros(count, dtype=numpy.int64)
+        self.valid = numpy.zeros(count, dtype=numpy.bool_)
+        columns = dict((name, i) for i, name in enumerate(TABLE_REGISTERS))
+        for i, insn in enumerate(insns):
+            if insn is None:
+                continue
+            refs = memory_operands(insn)
+            if len(refs) <= operand:
+                continue
+            ref = refs[operand]
+            # 16-bit registers use the 32-bit column; the mask drops the rest
+            if ref.base is not None:
+                self.base_column[i] = columns['e' + ref.base.name if ref.base.size == OPW_16BIT else ref.base.name]
+            if ref.index is not None:
+                self.index_column[i] = columns['e' + ref.index.name if ref.index.size == OPW_16BIT else ref.index.name]
+            self.scale[i] = ref.scale
+            if ref.displ is not None:
+                self.displ[i] = ref.displ.get_value()
+            self.mask[i] = ref.address_mask()
+            if segment_bases and ref.seg is not None:
+                self.segment_base[i] = segment_bases.get(ref.seg.name, 0)
+            self.valid[i] = True
+
+    def evaluate(self, insn_ids, registers):
+        """Addresses for a trace: insn ids and an (n, 8) array of register rows.
+
+        Returns a uint32 address array and a bool array telling which rows'
+        insns have the operand at all.
+        """
+        ids = numpy.asarray(insn_ids, dtype=numpy.intp)
+        rows = numpy.asarray(registers, dtype=numpy.int64)
+        padded = numpy.zeros((rows.shape[0], rows.shape[1] + 1), dtype=numpy.int64)
+        padded[:, :-1] = rows
+        n = numpy.arange(len(ids))
+        offsets = padded[n, self.base_column[ids]]
+        offsets += padded[n, self.index_column[ids]] * self.scale[ids]
+        offsets += self.displ[ids]
+        offsets &= self.mask[ids]
+        offsets += self.segment_base[ids]
+        offsets &= 0xFFFFFFFF
+        return offsets.astype(numpy.uint32), self.valid[ids]
+#
+
 class Printer:
     """Pretty print the insn"""
     def print_insn(self, insn, insn_width=10):
@@ -0,0 +1,141 @@
+"""
+Layer 3 of the METALBONES core -- high-level code.
+
+Reduces a crashing set of mutations to a minimal one (delta debugging).
+"""
+
+import copy
+import os
+import shutil
+import tempfile
+import multiprocessing.dummy
+import mutation
+import runner
+
+def _split(items, n):
+    "Split the list into n chunks of (nearly) equal size"
+    chunks = []
+    start = 0
+    for i in xrange(n):
+        end = start + (len(items) - start) // (n - i)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+def _complement(items, chunk):
+    excluded = set(chunk)
+    return [x for x in items if x not in excluded]
+
+class Minimizer(object):
+    """ddmin over a list of mutations.
+
+    The oracle is any callable taking a list of mutations (with only the
+    tested ones active) and returning True if the failure reproduces.
+    Outcomes are cached per subset; candidate subsets of each round are
+    tested in parallel by `workers` threads (the native debugger releases
+    the GIL while waiting for events).
+    """
+    def __init__(self, mutations, oracle, workers=1):
+        self.mutations = mutations
+        self.oracle = oracle
+        self.workers = workers
+        self.cache = {}
+        self.tests_run = 0
+
+    def minimize(self):
+        """Find a 1-minimal failing subset; marks the rest of mutations inactive.
+
+        Raises ValueError if the full set doesn't reproduce the failure.
+        """
+        pool = multiprocessing.dummy.Pool(self.workers) if self.workers > 1 else None
+        try:
+            everything = range(len(self.mutations))
+            if not self._test_many([everything], None)[0]:
+                raise ValueError('The failure does not reproduce with all mutations.')
+            current = self._ddmin(everything, pool)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        keep = set(current)
+        for i, m in enumerate(self.mutations):
+            m.active = i in keep
+        return [self.mutations[i] for i in current]
+
+    def _ddmin(self, current, pool):
+        n = 2
+        while len(current) >= 2:
+            chunks = _split(current, n)
+            candidates = chunks
+            if n > 2:
+                candidates = chunks + [_complement(current, c) for c in chunks]
+            results = self._test_many(candidates, pool)
+            try:
+                found = results.index(True)
+            except ValueError:
+                if n >= len(current):
+                    break
+                n = min(n * 2, len(current))
+                continue
+            current = candidates[found]
+            # Reduced to a subset: restart; to a complement: keep granularity
+            n = 2 if found < len(chunks) else max(n - 1, 2)
+        return current
+
+    def _test_many(self, subsets, pool):
+        pending = []
+        for subset in subsets:
+            key = tuple(subset)
+            if key not in self.cache and key not in pending:
+                pending.append(key)
+        if pending:
+            if pool is not None:
+                outcomes = pool.map(self._run, pending)
+            else:
+                outcomes = map(self._run, pending)
+            self.tests_run += len(pending)
+            self.cache.update(zip(pending, outcomes))
+        return [self.cache[tuple(subset)] for subset in subsets]
+
+    def _run(self, subset):
+        # Work on copies so concurrent tests don't fight over `active`
+        keep = set(subset)
+        mutations = []
+        for i, m in enumerate(self.mutations):
+            m = copy.copy(m)
+            m.active = i in keep
+            mutations.append(m)
+        return bool(self.oracle(mutations))
+#
+class TargetRunnerOracle(object):
+    "Reproduce a crash by running the target on a mutated copy of the seed"
+    def __init__(self, seed_path, cmdline, expected=None, ignore_exceptions=None, work_dir=None):
+        self.seed_path = seed_path
+        # Command line template, '%s' is replaced with the test case path
+        self.cmdline = cmdline
+        # If given, the ExceptionInfo that must be reproduced
+        self.expected = expected
+        self.ignore_exceptions = ignore_exceptions or ()
+        self.work_dir = work_dir
+    def __call__(self, mutations):
+        suffix = os.path.splitext(self.seed_path)[1]
+        fd, path = tempfile.mkstemp(suffix=suffix, dir=self.work_dir)
+        os.close(fd)
+        try:
+            shutil.copyfile(self.seed_path, path)
+            with open(path, 'r+b') as fp:
+                mutation.apply_mutations(mutations, fp)
+            r = runner.TargetRunner(self.ignore_exceptions)
+            r.start(self.cmdline % path)
+            while not r.done:
+                r.update()
+        finally:
+            os.remove(path)
+        return self._matches(r.evidence)
+    def _matches(self, evidence):
+        if evidence is None:
+            return False
+        if self.expected is None:
+            return True
+        info = evidence.info
+        return info.code == self.expected.code and info.address == self.expected.address
+# EOF
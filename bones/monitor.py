@@ -5,39 +5,279 @@ This wraps CPython objects and adds more functionality that
 can be more easily implemented in Python than in C.
 """
 
-import _bones
+import array
+import itertools
+import math
 
-class ProcessMonitor(_bones.ProcessMonitor):
+try:
+    import _bones
+except ImportError:
+    # No native core here; only non-native sources (see replay.py) work
+    _bones = None
+
+if _bones is not None:
+    class NativeProcessSource(_bones.ProcessMonitor):
+        """CPU time samples via NtQuerySystemInformation(), as implemented by _bones."""
+        def bind(self, monitor):
+            # _bones.ProcessMonitor reports via self._on_update, once per update()
+            self._on_update = monitor._on_update
+        def track_process(self, process_id, context):
+            self._track_process(process_id, context)
+        def untrack_process(self, process_id):
+            self._untrack_process(process_id)
+    #
+else:
+    NativeProcessSource = None
+
+# Verdicts of the idle models
+IDLE = 'idle'
+HUNG = 'hung'
+# Findings of the resource limits
+MEMORY_EXHAUSTION = 'memory exhaustion'
+HANDLE_LEAK = 'handle leak'
+
+def percentile(values, fraction):
+    "Nearest-rank percentile of the values, `fraction` in [0, 1]"
+    values = sorted(values)
+    if not values:
+        raise ValueError('No values')
+    rank = int(math.ceil(fraction * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+class IdleModel(object):
+    """The fixed idle heuristic.
+
+    A process is idle after more than `max_inactive` samples where its
+    kernel+user time grew by less than `delta_threshold` (100 ns units).
+    """
+    timeout = None
+
+    def __init__(self, delta_threshold=50, max_inactive=3):
+        self.delta_threshold = delta_threshold
+        self.max_inactive = max_inactive
+
+    def check(self, context, total_time, delta):
+        "Account one sample; returns IDLE, HUNG or None"
+        context['samples'] += 1
+        if delta < self.delta_threshold:
+            inactive_count = context['inactive_count'] + 1
+            context['inactive_count'] = inactive_count
+            if inactive_count > self.max_inactive:
+                return IDLE
+        return None
+
+    def observe(self, context):
+        "A tracked process finished a clean run"
+        pass
+#
+class AdaptiveIdleModel(IdleModel):
+    """Idle/hang detection calibrated on the target's own CPU time profile.
+
+    The first `calibration_runs` clean runs are judged by the fixed
+    heuristic while their total CPU times and sample counts are recorded.
+    After that:
+
+    - a quiet sample ends the run at once if the process has used at
+      least `done_cpu` (the `done_percentile` of the calibrated totals);
+      quiet runs short of that still take `max_inactive` samples;
+    - a process using more than `hang_cpu` (the `hang_percentile` of the
+      totals, times `margin`) is hung, busy or not;
+    - `timeout` is the matching wall time limit, in seconds.
+    """
+    def __init__(self, delta_threshold=50, max_inactive=3, calibration_runs=5,
+            done_percentile=0.5, hang_percentile=0.95, margin=1.5, sample_interval=0.05):
+        IdleModel.__init__(self, delta_threshold, max_inactive)
+        self.calibration_runs = calibration_runs
+        self.done_percentile = done_percentile
+        self.hang_percentile = hang_percentile
+        self.margin = margin
+        self.sample_interval = sample_interval
+        self.totals = []
+        self.lengths = []
+        self.done_cpu = None
+        self.hang_cpu = None
+        self.timeout = None
+
+    def __str__(self):
+        if self.done_cpu is None:
+            return 'Calibrating (%d/%d runs)' % (len(self.totals), self.calibration_runs)
+        return 'Done at %d, hung at %d (100ns CPU), timeout %.2fs' % (self.done_cpu, self.hang_cpu, self.timeout)
+
+    @property
+    def calibrated(self):
+        return self.done_cpu is not None
+
+    def check(self, context, total_time, delta):
+        if self.done_cpu is None:
+            return IdleModel.check(self, context, total_time, delta)
+        context['samples'] += 1
+        if total_time > self.hang_cpu:
+            return HUNG
+        if delta < self.delta_threshold:
+            inactive_count = context['inactive_count'] + 1
+            context['inactive_count'] = inactive_count
+            if total_time >= self.done_cpu or inactive_count > self.max_inactive:
+                return IDLE
+        return None
+
+    def observe(self, context):
+        if self.done_cpu is not None:
+            return
+        self.totals.append(context['kernel_time'] + context['user_time'])
+        self.lengths.append(context['samples'])
+        if len(self.totals) >= self.calibration_runs:
+            self.calibrate()
+
+    def calibrate(self):
+        "Derive the thresholds from the runs observed so far"
+        self.done_cpu = percentile(self.totals, self.done_percentile)
+        top = percentile(self.totals, self.hang_percentile)
+        # Allow at least a sample interval of full CPU use beyond the top
+        self.hang_cpu = max(int(top * self.margin), top + int(self.sample_interval * 10000000))
+        samples = percentile(self.lengths, self.hang_percentile) * self.margin
+        self.timeout = max(samples, self.max_inactive + 2) * self.sample_interval
+#
+class ResourceSeries(object):
+    "Resource usage of a process, one compact column per counter, one row per sample"
+    __slots__ = ('working_set', 'private_bytes', 'handles', 'threads')
+    def __init__(self):
+        self.working_set = array.array('L')
+        self.private_bytes = array.array('L')
+        self.handles = array.array('I')
+        self.threads = array.array('I')
+    def __len__(self):
+        return len(self.handles)
+    def __str__(self):
+        if not len(self):
+            return 'No samples'
+        return 'Peak working set %dK, private %dK, %d handles, %d threads over %d samples' % (
+            max(self.working_set) // 1024, max(self.private_bytes) // 1024,
+            max(self.handles), max(self.threads), len(self))
+    def append(self, working_set, private_bytes, handles, threads):
+        self.working_set.append(working_set)
+        self.private_bytes.append(private_bytes)
+        self.handles.append(handles)
+        self.threads.append(threads)
+    def rows(self):
+        return itertools.izip(self.working_set, self.private_bytes, self.handles, self.threads)
+#
+class ResourceLimits(object):
+    """Resource use that makes a process a finding; None disables a check.
+
+    Only the latest sample is looked at, so a check costs the same however
+    long the series: memory against the absolute limits, handles against
+    both the absolute limit and the growth since the first sample.
+    """
+    def __init__(self, max_private_bytes=None, max_working_set=None, max_handles=None, max_handle_growth=None):
+        self.max_private_bytes = max_private_bytes
+        self.max_working_set = max_working_set
+        self.max_handles = max_handles
+        self.max_handle_growth = max_handle_growth
+
+    def check(self, series):
+        "Returns MEMORY_EXHAUSTION, HANDLE_LEAK or None"
+        if self.max_private_bytes is not None and series.private_bytes[-1] > self.max_private_bytes:
+            return MEMORY_EXHAUSTION
+        if self.max_working_set is not None and series.working_set[-1] > self.max_working_set:
+            return MEMORY_EXHAUSTION
+        handles = series.handles
+        if self.max_handles is not None and handles[-1] > self.max_handles:
+            return HANDLE_LEAK
+        if self.max_handle_growth is not None and handles[-1] - handles[0] > self.max_handle_growth:
+            return HANDLE_LEAK
+        return None
+#
+class ProcessMonitor(object):
     """
     Track processes in the system via NtQuerySystemInformation()
+    (or another sample source)
+
+    Whether a process is done is up to the idle model: IdleModel with the
+    given thresholds unless another (e.g. AdaptiveIdleModel) is passed.
+
+    Resource usage from the same samples is kept in `series`, a
+    ResourceSeries per process ever tracked; processes going over the
+    `limits` (if any) are reported via on_process_finding().
     """
-    def __init__(self, delta_threshold=50, max_inactive=3):
-        _bones.ProcessMonitor.__init__(self)
+    def __init__(self, delta_threshold=50, max_inactive=3, source=None, model=None, limits=None):
+        if source is None:
+            if NativeProcessSource is None:
+                raise RuntimeError('The native process source is not available.')
+            source = NativeProcessSource()
+        self.source = source
+        source.bind(self)
         self.delta_threshold = delta_threshold
         self.max_inactive = max_inactive
+        self.model = model or IdleModel(delta_threshold, max_inactive)
+        self.limits = limits
+        self.contexts = {}
+        self.series = {}
+
+    def update(self):
+        "Update the counters."
+        self.source.update()
 
     def track_process(self, process_id):
         context = {
             'kernel_time' : 0,
             'user_time' : 0,
             'inactive_count' : 0,
+            'samples' : 0,
+            'resources' : ResourceSeries(),
         }
-        self._track_process(process_id, context)
+        self.series[process_id] = context['resources']
+        self.contexts[process_id] = context
+        self.source.track_process(process_id, context)
     def untrack_process(self, process_id):
-        self._untrack_process(process_id)
+        if self.contexts.pop(process_id, None) is not None:
+            self.source.untrack_process(process_id)
+    def process_exited(self, process_id, clean=True):
+        "Stop tracking an exited process; clean runs go to the idle model"
+        context = self.contexts.get(process_id)
+        if context is None:
+            return
+        self.untrack_process(process_id)
+        if clean:
+            self.model.observe(context)
 
     def on_process_idle(self, process_id):
         pass
+    def on_process_hung(self, process_id):
+        self.on_process_idle(process_id)
+    def on_process_finding(self, process_id, finding):
+        pass
 
-    def _on_update(self, process_id, context, kernel_time, user_time):
-        kernel_delta = kernel_time - context['kernel_time']
-        user_delta = user_time - context['user_time']
-        context['kernel_time'] = kernel_time
-        context['user_time'] = user_time
-        if kernel_delta + user_delta < self.delta_threshold:
-            inactive_count = context['inactive_count'] + 1
-            context['inactive_count'] = inactive_count
-            if inactive_count > self.max_inactive:
+    def _on_update(self, process_ids, contexts, kernel_times, user_times, resources):
+        "Sample callback: parallel sequences for the tracked processes found"
+        check = self.model.check
+        check_limits = self.limits.check if self.limits is not None else None
+        finished = []
+        for process_id, context, kernel_time, user_time, sample in itertools.izip(
+                process_ids, contexts, kernel_times, user_times, resources):
+            series = context['resources']
+            series.append(*sample)
+            if check_limits is not None:
+                finding = check_limits(series)
+                if finding is not None:
+                    finished.append((process_id, context, finding))
+                    continue
+            total_time = kernel_time + user_time
+            delta = total_time - context['kernel_time'] - context['user_time']
+            context['kernel_time'] = kernel_time
+            context['user_time'] = user_time
+            verdict = check(context, total_time, delta)
+            if verdict is not None:
+                finished.append((process_id, context, verdict))
+        # Untracking modifies the source's table; not while walking it
+        for process_id, context, verdict in finished:
+            if verdict in (MEMORY_EXHAUSTION, HANDLE_LEAK):
+                self.on_process_finding(process_id, verdict)
+                self.untrack_process(process_id)
+            elif verdict == HUNG:
+                self.on_process_hung(process_id)
+                self.untrack_process(process_id)
+            else:
                 self.on_process_idle(process_id)
                 self.untrack_process(process_id)
+                self.model.observe(context)
 # EOF
\ No newline at end of file
@@ -4,7 +4,19 @@ Layer 3 of the METALBONES core -- high-level code.
 Implements (simple) mutation algorithms.
 """
 
+import array
+import cPickle
+import functools
+import math
+import os
 import random
+import string
+import struct
+from formats import cfb
+
+class MutationUnavailable(Exception):
+    "Raised by a mutator with nothing to work with in this input"
+    pass
 
 class Mutator(object):
     def __init__(self, input_length):
@@ -43,11 +55,365 @@ class ByteSetter(Mutator):
         fp.seek(self.offset)
         fp.write(self.value * self.size)
 #
-def generate_mutations(mutators, input_length, max_mutations):
+class TokenIndex(object):
+    """Aho-Corasick automaton over a dictionary of tokens.
+
+    Built once, then finds all occurrences of all tokens in a single pass.
+    """
+    def __init__(self, tokens):
+        self.tokens = sorted(set(t for t in tokens if t))
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        for token in self.tokens:
+            self._insert(token)
+        self._link()
+    def _insert(self, token):
+        state = 0
+        for c in token:
+            next_state = self._goto[state].get(c)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][c] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            state = next_state
+        self._out[state] += (token,)
+    def _link(self):
+        # Breadth-first, so failure targets are always linked already
+        queue = list(self._goto[0].values())
+        pos = 0
+        while pos < len(queue):
+            state = queue[pos]
+            pos += 1
+            for c, next_state in self._goto[state].iteritems():
+                queue.append(next_state)
+                f = self._fail[state]
+                while f and c not in self._goto[f]:
+                    f = self._fail[f]
+                f = self._goto[f].get(c, 0)
+                self._fail[next_state] = f if f != next_state else 0
+                self._out[next_state] += self._out[self._fail[next_state]]
+    def scan(self, data):
+        "Map each token found in data to the list of its offsets"
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        hits = {}
+        state = 0
+        for i, c in enumerate(data):
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            for token in out[state]:
+                hits.setdefault(token, []).append(i + 1 - len(token))
+        return hits
+#
+_printable = frozenset(string.letters + string.digits + string.punctuation + ' ')
+def extract_tokens(data, min_length=4, magic_length=4):
+    "Pull likely tokens out of an input: its magic and printable strings"
+    tokens = set()
+    if len(data) >= magic_length:
+        tokens.add(data[:magic_length])
+    start = None
+    for i, c in enumerate(data):
+        if c in _printable:
+            if start is None:
+                start = i
+        else:
+            if start is not None and i - start >= min_length:
+                tokens.add(data[start:i])
+            start = None
+    if start is not None and len(data) - start >= min_length:
+        tokens.add(data[start:])
+    return tokens
+class SeedTokens(object):
+    """Token dictionary together with token occurrences in one seed.
+
+    Scanned once per seed; the token mutators only pick from it.
+    """
+    def __init__(self, data, tokens=None):
+        if tokens is None:
+            tokens = extract_tokens(data)
+        self.index = TokenIndex(tokens)
+        self.tokens = self.index.tokens
+        self.by_length = {}
+        for token in self.tokens:
+            self.by_length.setdefault(len(token), []).append(token)
+        self.hits = []
+        for token, offsets in self.index.scan(data).iteritems():
+            self.hits.extend((offset, token) for offset in offsets)
+        self.hits.sort()
+    def pick_hit(self, input_length):
+        "Random (offset, token) occurrence, or a random offset if none"
+        if self.hits:
+            return random.choice(self.hits)
+        return random.randint(0, input_length), None
+    def pick_similar(self, token):
+        "Random token, preferring the ones as long as the given one; None if no tokens"
+        if not self.tokens:
+            return None
+        if token is not None:
+            same = self.by_length.get(len(token))
+            if same and (len(same) > 1 or same[0] != token):
+                return random.choice(same)
+        return random.choice(self.tokens)
+def _splice(fp, offset, remove, insert):
+    "Replace `remove` bytes at offset by `insert`, resizing the file"
+    fp.seek(offset + remove)
+    tail = fp.read()
+    fp.seek(offset)
+    fp.write(insert)
+    fp.write(tail)
+    fp.truncate()
+# NOTE: Token mutators record offsets in terms of the seed; size-changing
+# mutations applied before them shift the data they land on.
+class TokenInserter(Mutator):
+    def __init__(self, input_length, tokens):
+        Mutator.__init__(self, input_length)
+        self.offset, near = tokens.pick_hit(input_length)
+        self.value = tokens.pick_similar(near)
+        if self.value is None:
+            raise MutationUnavailable('No tokens')
+        self.size = len(self.value)
+    def __str__(self):
+        return '%08X TokenInsert %r' % (self.offset, self.value)
+    def _apply(self, fp):
+        _splice(fp, self.offset, 0, self.value)
+#
+class TokenReplacer(Mutator):
+    def __init__(self, input_length, tokens):
+        Mutator.__init__(self, input_length)
+        self.offset, self.old_value = tokens.pick_hit(input_length)
+        self.value = tokens.pick_similar(self.old_value)
+        if self.value is None:
+            raise MutationUnavailable('No tokens')
+        self.size = len(self.old_value) if self.old_value is not None else 0
+    def __str__(self):
+        return '%08X TokenReplace %r -> %r' % (self.offset, self.old_value, self.value)
+    def _apply(self, fp):
+        _splice(fp, self.offset, self.size, self.value)
+#
+class TokenDeleter(Mutator):
+    def __init__(self, input_length, tokens):
+        Mutator.__init__(self, input_length)
+        if not tokens.tokens:
+            raise MutationUnavailable('No tokens')
+        self.offset, self.value = tokens.pick_hit(input_length)
+        self.size = len(self.value) if self.value is not None else 1
+    def __str__(self):
+        return '%08X TokenDelete %d bytes' % (self.offset, self.size)
+    def _apply(self, fp):
+        _splice(fp, self.offset, self.size, '')
+#
+def token_mutators(tokens):
+    "Token mutator factories bound to the seed, usable with generate_mutations()"
+    return [functools.partial(m, tokens=tokens) for m in (TokenInserter, TokenReplacer, TokenDeleter)]
+def _dwords(data):
+    "Every 4 byte window of data as an integer, by offset"
+    count = len(data) - 3
+    if count <= 0:
+        return array.array('I')
+    words = array.array('I', [0]) * count
+    # Windows at offsets shift, shift+4, ... in one go
+    for shift in xrange(4):
+        n = (count - shift + 3) // 4
+        words[shift::4] = array.array('I', str(data[shift:shift + n * 4]))
+    return words
+def find_splice_points(a, b, min_match=4):
+    "Offset pairs (i, j) where a and b share a min_match (at least 4) bytes long sequence"
+    if min_match < 4:
+        raise ValueError('min_match must be at least 4')
+    words_a = _dwords(a)
+    words_b = _dwords(b)
+    # Sample the larger donors sparsely to keep the table small
+    stride = max(1, len(b) // 4096)
+    # Keys are the first and last 4 bytes: exact up to 8 bytes, checked beyond
+    last = min_match - 4
+    grams = {}
+    for j in xrange(0, len(b) - min_match + 1, stride):
+        grams.setdefault(words_b[j] << 32 | words_b[j + last], j)
+    points = []
+    for i in xrange(1, len(a) - min_match + 1):
+        j = grams.get(words_a[i] << 32 | words_a[i + last])
+        if j is not None and (min_match <= 8 or buffer(a, i, min_match) == buffer(b, j, min_match)):
+            points.append((i, j))
+    return points
+def cfb_splice_points(a, b):
+    "Sector boundaries of two CFB files with the same sector size"
+    if not (a.startswith(cfb.SIGNATURE) and b.startswith(cfb.SIGNATURE)):
+        return []
+    shift_a = struct.unpack_from('<H', a, 0x1E)[0]
+    shift_b = struct.unpack_from('<H', b, 0x1E)[0]
+    if shift_a != shift_b:
+        return []
+    sector_size = 1 << shift_a
+    return [(o, o) for o in xrange(max(512, sector_size), min(len(a), len(b)), sector_size)]
+class SpliceDonors(object):
+    """Donor inputs (e.g. corpus entry files) for splicing into one seed.
+
+    Each donor is read once, when first picked, to find its splice points
+    against the seed; mutations only keep the donor's path.
+    """
+    def __init__(self, data, paths):
+        self.data = data
+        self.paths = list(paths)
+        # Path -> (splice points, donor length)
+        self.points = {}
+    def pick(self):
+        "Random (donor path, offset, donor offset, donor length)"
+        path = random.choice(self.paths)
+        try:
+            points, length = self.points[path]
+        except KeyError:
+            with open(path, 'rb') as fp:
+                donor = fp.read()
+            points = cfb_splice_points(self.data, donor) or find_splice_points(self.data, donor)
+            length = len(donor)
+            self.points[path] = points, length
+        if points:
+            offset, donor_offset = random.choice(points)
+        else:
+            choice = random.random()
+            offset = int(choice * len(self.data))
+            donor_offset = int(choice * length)
+        return path, offset, donor_offset, length
+#
+class Splicer(Mutator):
+    """Crossover with another input: the data from offset on is replaced
+    by the donor's from donor_offset on.
+
+    Offsets are in terms of the seed, as for the token mutators.
+    """
+    def __init__(self, input_length, donors):
+        Mutator.__init__(self, input_length)
+        self.donor_path, self.offset, self.donor_offset, length = donors.pick()
+        self.size = length - self.donor_offset
+    def __str__(self):
+        return '%08X Splice with %s at %08X' % (self.offset, os.path.basename(self.donor_path), self.donor_offset)
+    def _apply(self, fp):
+        with open(self.donor_path, 'rb') as donor:
+            donor.seek(self.donor_offset)
+            tail = donor.read(self.size)
+        fp.seek(self.offset)
+        fp.write(tail)
+        fp.truncate()
+#
+def splice_mutator(donors):
+    "Splicer factory bound to a SpliceDonors, usable with generate_mutations()"
+    return functools.partial(Splicer, donors=donors)
+def _mutator_name(mutator):
+    try:
+        return mutator.__name__
+    except AttributeError:
+        # functools.partial of a mutator class
+        return mutator.func.__name__
+class MutatorScheduler(object):
+    """UCB1 bandit choosing mutators and the number of mutations.
+
+    Every mutation is tagged with the arm it came from; after a test case
+    is run, reward() credits its outcome to these arms. Each mutation is
+    one pull of its mutator arm and each test case one pull of its count
+    arm, for pulls and rewards alike. Statistics are kept as [pulls, total
+    reward] pairs keyed by mutator name and count, and persisted to `path`
+    if given.
+    """
+
+    CRASH_REWARD = 1.0
+    HANG_REWARD = 0.5
+    COVERAGE_REWARD = 0.1
+
+    def __init__(self, path=None, exploration=1.4):
+        self.path = path
+        self.exploration = exploration
+        self.mutator_stats = {}
+        self.count_stats = {}
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def choose_mutator(self, mutators):
+        return self._choose(mutators, [_mutator_name(m) for m in mutators], self.mutator_stats)
+
+    def choose_count(self, max_mutations):
+        counts = range(1, max_mutations + 1)
+        return self._choose(counts, counts, self.count_stats)
+
+    def reward(self, mutations, new_coverage=0, crashes=0, hangs=0):
+        """Credit the outcome of a test case to the arms that produced it.
+
+        Pulls of mutations not chosen through this scheduler are counted
+        here.
+        """
+        value = min(1.0, crashes * self.CRASH_REWARD + hangs * self.HANG_REWARD
+            + new_coverage * self.COVERAGE_REWARD)
+        for m in mutations:
+            stats = self.mutator_stats.setdefault(m.arm, [0, 0.0])
+            if getattr(m, 'scheduled_count', None) is None:
+                stats[0] += 1
+            stats[1] += value
+        if mutations:
+            count = getattr(mutations[0], 'scheduled_count', None)
+            if count is None:
+                count = len(mutations)
+                self.count_stats.setdefault(count, [0, 0.0])[0] += 1
+            self.count_stats.setdefault(count, [0, 0.0])[1] += value
+
+    def _choose(self, arms, keys, stats):
+        total = 0
+        for key in keys:
+            total += stats.setdefault(key, [0, 0.0])[0]
+        best = None
+        best_score = -1.0
+        log_total = math.log(total) if total else 0.0
+        for arm, key in zip(arms, keys):
+            pulls, reward = stats[key]
+            if not pulls:
+                # Try every arm at least once
+                best = arm, key
+                break
+            score = reward / pulls + self.exploration * math.sqrt(log_total / pulls)
+            if score > best_score:
+                best = arm, key
+                best_score = score
+        stats[best[1]][0] += 1
+        return best[0]
+
+    def cancel(self, mutator):
+        "Take back the pull of a mutator that raised MutationUnavailable"
+        self.mutator_stats[_mutator_name(mutator)][0] -= 1
+
+    def load(self):
+        with open(self.path, 'rb') as fp:
+            self.mutator_stats, self.count_stats = cPickle.load(fp)
+
+    def save(self):
+        with open(self.path, 'wb') as fp:
+            cPickle.dump((self.mutator_stats, self.count_stats), fp, cPickle.HIGHEST_PROTOCOL)
+#
+def generate_mutations(mutators, input_length, max_mutations, scheduler=None):
+    "Mutators raising MutationUnavailable are dropped for this input"
     mutations = []
-    while max_mutations > 0:
-        mutator = random.choice(mutators)
-        mutations.append(mutator(input_length))
+    mutators = list(mutators)
+    count = None
+    if scheduler is not None:
+        max_mutations = count = scheduler.choose_count(max_mutations)
+    while max_mutations > 0 and mutators:
+        if scheduler is not None:
+            mutator = scheduler.choose_mutator(mutators)
+        else:
+            mutator = random.choice(mutators)
+        try:
+            mutation = mutator(input_length)
+        except MutationUnavailable:
+            mutators.remove(mutator)
+            if scheduler is not None:
+                scheduler.cancel(mutator)
+            continue
+        mutation.arm = _mutator_name(mutator)
+        # The count arm pulled for the case, if scheduled
+        mutation.scheduled_count = count
+        mutations.append(mutation)
         max_mutations -= 1
     return mutations
 def apply_mutations(mutations, fp):
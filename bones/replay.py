@@ -0,0 +1,256 @@
+"""
+Layer 2 of the METALBONES core -- Python wrappers.
+
+Backends replaying a recorded debug event stream, so the Python layer
+can be run, profiled and load-tested without a live target.
+"""
+
+import bisect
+import struct
+import dbg
+
+def _flag(bitpos, doc):
+    mask = 1 << bitpos
+    def get(self):
+        return bool(self.value & mask)
+    def set(self, value):
+        if value:
+            self.value |= mask
+        else:
+            self.value &= ~mask
+    return property(get, set, doc=doc)
+
+class EFlags(object):
+    "Flags register standing in for _bones.EFlags"
+    __slots__ = ('value',)
+    def __init__(self, value=0):
+        self.value = value
+    def __str__(self):
+        return ' '.join((c.upper() if getattr(self, c + 'f') else c) for c in 'odtszapc')
+    cf = _flag(0, 'Carry flag')
+    pf = _flag(2, 'Parity flag')
+    af = _flag(4, 'Adjust flag')
+    zf = _flag(6, 'Zero flag')
+    sf = _flag(7, 'Sign flag')
+    tf = _flag(8, 'Trap flag')
+    df = _flag(10, 'Direction flag')
+    of = _flag(11, 'Overflow flag')
+    rf = _flag(16, 'Resume flag')
+#
+class Context(object):
+    "Register snapshot standing in for _bones.Context"
+    __slots__ = (
+        'dr0', 'dr1', 'dr2', 'dr3', 'dr6', 'dr7',
+        'gs', 'fs', 'es', 'ds', 'cs', 'ss',
+        'edi', 'esi', 'ebx', 'ecx', 'edx', 'eax',
+        'ebp', 'esp', 'eip', 'eflags')
+    def __init__(self, **regs):
+        for name in Context.__slots__:
+            setattr(self, name, regs.get(name, 0))
+        self.eflags = EFlags(regs.get('eflags', 0))
+    def __str__(self):
+        return ('eax=%08x ebx=%08x ecx=%08x edx=%08x esi=%08x edi=%08x\n'
+            'eip=%08x esp=%08x ebp=%08x efl=%08x %s') % (
+            self.eax, self.ebx, self.ecx, self.edx, self.esi, self.edi,
+            self.eip, self.esp, self.ebp, self.eflags.value, self.eflags)
+    def pack(self):
+        "The registers as u32 words, in __slots__ order, as _bones.Context.pack()"
+        return _context.pack(self.dr0, self.dr1, self.dr2, self.dr3, self.dr6, self.dr7,
+            self.gs, self.fs, self.es, self.ds, self.cs, self.ss,
+            self.edi, self.esi, self.ebx, self.ecx, self.edx, self.eax,
+            self.ebp, self.esp, self.eip, self.eflags.value)
+    def copy(self):
+        c = Context.__new__(Context)
+        for name in Context.__slots__:
+            setattr(c, name, getattr(self, name))
+        c.eflags = EFlags(self.eflags.value)
+        return c
+#
+_context = struct.Struct('<%dI' % len(Context.__slots__))
+
+class _Region(object):
+    "An allocation; protection is per page, as the kernel keeps it"
+    def __init__(self, base, data, protect, name):
+        self.base = base
+        self.data = bytearray(data)
+        self.end = base + len(self.data)
+        # The allocation protection, and the current one of each page
+        self.protect = protect
+        self.page_protects = [protect] * ((len(self.data) + 0xFFF) >> 12)
+        self.name = name
+#
+class ReplayBackend(dbg.Backend):
+    """Feeds a recorded debug event stream to the debugger.
+
+    Events are tuples of the handler name and its arguments, exactly as
+    the native backend would pass them, e.g.:
+
+        ('_on_module_load', pid, base_address)
+
+    Records named 'context' (thread handle, Context) and 'memory'
+    (process handle, address, data) update the replayed target state in
+    between debug events and are not dispatched. The initial state can
+    be set up with set_context() and add_region() as well.
+    """
+
+    def __init__(self, events=()):
+        self.events = iter(events)
+        self.contexts = {}
+        self.regions = {}
+        self.suspend_counts = {}
+        self.terminated = {}
+        self.results = 0
+        self._handlers = None
+
+    def bind(self, debugger):
+        self._handlers = dict((name, getattr(debugger, name)) for name in dbg.EVENT_HANDLERS)
+
+    def spawn(self, cmdline):
+        pass
+    def attach(self, process_handle):
+        pass
+    def detach(self, process_handle):
+        pass
+
+    def wait_event(self, timeout=None):
+        handlers = self._handlers
+        for event in self.events:
+            name = event[0]
+            if name == 'context':
+                self.set_context(event[1], event[2])
+                continue
+            if name == 'memory':
+                self.vmem_write(event[1], event[2], event[3])
+                continue
+            handlers[name](*event[1:])
+            self.results += 1
+            return True
+        return False
+
+    def run(self):
+        "Dispatch all the remaining events; returns the number dispatched"
+        count = self.results
+        while self.wait_event():
+            pass
+        return self.results - count
+
+    # Target state setup
+
+    def set_context(self, thread_handle, context):
+        self.contexts[thread_handle] = context
+    def add_region(self, process_handle, base, data, protect=dbg.Process.PAGE_READWRITE, name=None):
+        regions = self.regions.setdefault(process_handle, ([], []))
+        pos = bisect.bisect(regions[0], base)
+        regions[0].insert(pos, base)
+        regions[1].insert(pos, _Region(base, data, protect, name))
+
+    def _find_region(self, handle, address):
+        try:
+            bases, regions = self.regions[handle]
+        except KeyError:
+            raise dbg.NtStatusError('No memory recorded for the process')
+        pos = bisect.bisect(bases, address) - 1
+        if pos >= 0 and address < regions[pos].end:
+            return regions[pos]
+        raise dbg.NtStatusError('Address %08x is not mapped' % address)
+
+    # Backend requests
+
+    def process_terminate(self, handle, exit_code):
+        self.terminated[handle] = exit_code
+
+    def thread_get_context(self, handle):
+        return self.contexts[handle].copy()
+    def thread_set_context(self, handle, context):
+        self.contexts[handle] = context.copy()
+    def thread_get_teb(self, handle):
+        return 0
+    def thread_set_single_step(self, handle):
+        self.contexts[handle].eflags.tf = True
+    def thread_suspend(self, handle):
+        count = self.suspend_counts.get(handle, 0)
+        self.suspend_counts[handle] = count + 1
+        return count
+    def thread_resume(self, handle):
+        count = self.suspend_counts.get(handle, 0)
+        self.suspend_counts[handle] = max(count - 1, 0)
+        return count
+
+    def vmem_read(self, handle, address, size):
+        r = self._find_region(handle, address)
+        offset = address - r.base
+        return str(r.data[offset:offset + size])
+    def vmem_write(self, handle, address, buffer):
+        if type(buffer) is not str:
+            # As strict as _bones
+            raise TypeError('Expected data to be a string.')
+        r = self._find_region(handle, address)
+        offset = address - r.base
+        if address + len(buffer) > r.end:
+            raise dbg.NtStatusError('Write at %08x crosses the region end' % address)
+        r.data[offset:offset + len(buffer)] = buffer
+    def vmem_query(self, handle, address):
+        "The run of pages with the same protection from the address on"
+        r = self._find_region(handle, address)
+        protects = r.page_protects
+        first = (address - r.base) >> 12
+        last = first + 1
+        while last < len(protects) and protects[last] == protects[first]:
+            last += 1
+        size = min(r.base + (last << 12), r.end) - (address & ~0xFFF)
+        return (r.base, size, r.protect, protects[first], 'commit', 'image' if r.name else 'private')
+    def vmem_protect(self, handle, address, size, protect):
+        r = self._find_region(handle, address)
+        if address + size > r.end:
+            raise dbg.NtStatusError('Protect at %08x crosses the region end' % address)
+        first = (address - r.base) >> 12
+        last = (address + size - 1 - r.base) >> 12
+        old_protect = r.page_protects[first]
+        r.page_protects[first:last + 1] = [protect] * (last + 1 - first)
+        return old_protect
+    def vmem_query_section_name(self, handle, address):
+        r = self._find_region(handle, address)
+        if r.name is None:
+            raise dbg.NtStatusError('Address %08x is not in a mapped section' % address)
+        return r.name
+#
+class ReplayProcessSource(object):
+    """Feeds recorded CPU time samples to a ProcessMonitor.
+
+    Each update() consumes one tick: a snapshot dict mapping process id
+    to (kernel_time, user_time), optionally followed by working set,
+    private bytes, handle and thread counts. Processes missing from a tick
+    are skipped; the rest are reported in one batch, as the native source
+    does.
+    """
+    def __init__(self, ticks=()):
+        self.ticks = iter(ticks)
+        self.processes = {}
+        self._on_update = None
+    def bind(self, monitor):
+        self._on_update = monitor._on_update
+    def track_process(self, process_id, context):
+        self.processes[process_id] = context
+    def untrack_process(self, process_id):
+        del self.processes[process_id]
+    def update(self):
+        tick = next(self.ticks, None)
+        if tick is None:
+            return
+        process_ids = []
+        contexts = []
+        kernel_times = []
+        user_times = []
+        resources = []
+        for process_id, context in self.processes.iteritems():
+            try:
+                sample = tick[process_id]
+            except KeyError:
+                continue
+            process_ids.append(process_id)
+            contexts.append(context)
+            kernel_times.append(sample[0])
+            user_times.append(sample[1])
+            resources.append(tuple(sample[2:6]) if len(sample) > 2 else (0, 0, 0, 0))
+        self._on_update(process_ids, contexts, kernel_times, user_times, resources)
+# EOF
@@ -6,21 +6,28 @@ This governs the whole process of running a fuzzer.
 
 import dbg
 import monitor
+import stack
+import math
+import time
 import logging
 
 class ProcessMonitorAdapter(monitor.ProcessMonitor):
     "Route events to another handler object"
-    def __init__(self, handler, delta_threshold=50, max_inactive=3):
+    def __init__(self, handler, delta_threshold=50, max_inactive=3, source=None, model=None, limits=None):
         self.handler = handler
-        monitor.ProcessMonitor.__init__(self, delta_threshold, max_inactive)
+        monitor.ProcessMonitor.__init__(self, delta_threshold, max_inactive, source, model, limits)
     def on_process_idle(self, process_id):
         self.handler.on_process_idle(process_id)
+    def on_process_hung(self, process_id):
+        self.handler.on_process_hung(process_id)
+    def on_process_finding(self, process_id, finding):
+        self.handler.on_process_finding(process_id, finding)
 #
 class DebuggerAdapter(dbg.Debugger):
     "Route events to another handler object"
-    def __init__(self, handler):
+    def __init__(self, handler, backend=None, recorder=None):
         self.handler = handler
-        dbg.Debugger.__init__(self)
+        dbg.Debugger.__init__(self, backend, recorder)
     def on_process_create_begin(self, process):
         self.handler.on_process_create_begin(process)
     def on_process_create_end(self, process):
@@ -38,6 +45,8 @@ class DebuggerAdapter(dbg.Debugger):
         self.handler.on_module_unload(module)
     def on_breakpoint(self, thread, context, bp):
         self.handler.on_breakpoint(thread, context, bp)
+    def on_managed_breakpoint(self, thread, context, address):
+        self.handler.on_managed_breakpoint(thread, context, address)
     def on_single_step(self, thread):
         self.handler.on_single_step(thread)
     def on_exception(self, thread, info, first_chance):
@@ -46,26 +55,107 @@ class DebuggerAdapter(dbg.Debugger):
         return DebuggerAdapter.DBG_EXCEPTION_NOT_HANDLED
 #
 class ExceptionEvidence(object):
-    def __init__(self, xinfo):
+    """An exception the target didn't survive.
+
+    The faulting location and the stack frames are kept as strings
+    (module+offset), as evidence is passed between processes; `stack` is
+    the raw frame address array, eip first. For triage, `registers` maps
+    register names to values and `code` holds the bytes at eip; `trace`
+    has the thread's last eips, oldest first, if it was traced. `symbol`
+    is the faulting location as near an export as can be told.
+    """
+    REGISTERS = ('eax', 'ecx', 'edx', 'ebx', 'esp', 'ebp', 'esi', 'edi', 'eip')
+    CODE_SIZE = 16
+
+    def __init__(self, xinfo, location=None, frames=(), stack=None, registers=None, code=None, trace=None,
+            symbol=None):
         self.info = xinfo
+        self.location = location
+        self.symbol = symbol
+        self.frames = tuple(frames)
+        self.stack = stack
+        self.registers = registers
+        self.code = code
+        self.trace = trace
+    def signature(self, depth):
+        "What identifies the crash, for bucketing"
+        location = self.location or '%08x' % self.info.address
+        return ('%08X' % self.info.code, location) + self.frames[:depth]
+#
+class ResourceEvidence(object):
+    "A process going over the resource limits (see monitor.ResourceLimits)"
+    def __init__(self, finding, process_id, series):
+        self.finding = finding
+        self.process_id = process_id
+        self.series = series
+        self.info = '%s in process %d: %s' % (finding, process_id, series)
+    def signature(self, depth):
+        return (self.finding,)
 #
 class TargetRunner(object):
-    "The main test runner, doing a single test run"
-    def __init__(self, ignore_exceptions=None):
+    """The main test runner, doing a single test run
+
+    Debug events are waited for only until the nearest deadline: the next
+    CPU usage sample (every `sample_interval` seconds) or the end of the
+    test case's `time_budget`, whichever comes first.
+
+    An idle model (see monitor.AdaptiveIdleModel) shared between runs can
+    be passed in; its timeout is used when no time budget is given.
+    Processes going over `resource_limits` (a monitor.ResourceLimits) are
+    killed and reported as ResourceEvidence. With a steptrace.Tracer, crash
+    evidence includes the last `trace_depth` instructions of the thread.
+    Debug events go to `recorder` (an eventlog.EventRecorder), if given;
+    it is flushed when the run is done.
+    """
+    def __init__(self, ignore_exceptions=None, backend=None, monitor_source=None,
+            sample_interval=0.05, time_budget=None, coverage=None, idle_model=None,
+            resource_limits=None, tracer=None, trace_depth=256, recorder=None):
         self._logger = logging.getLogger()
-        self.__dbg = DebuggerAdapter(self)
-        self.__pm = ProcessMonitorAdapter(self)
+        self.recorder = recorder
+        self.__dbg = DebuggerAdapter(self, backend, recorder)
+        self.__pm = ProcessMonitorAdapter(self, source=monitor_source, model=idle_model, limits=resource_limits)
         self.__initial_bp_hit = False
-        self.ignore_exceptions = ignore_exceptions
+        self.__next_sample = None
+        self.__deadline = None
+        self.ignore_exceptions = ignore_exceptions or ()
+        self.sample_interval = sample_interval
+        self.time_budget = time_budget
+        # A coverage.CoverageCollector, if coverage is collected
+        self.coverage = coverage
+        self.tracer = tracer
+        self.trace_depth = trace_depth
         self.evidence = None
+        self.timed_out = False
         self.done = False
     def start(self, cmdline):
         self._logger.debug('Running `%s`', cmdline)
+        now = time.time()
+        self.__next_sample = now + self.sample_interval
+        time_budget = self.time_budget
+        if time_budget is None:
+            time_budget = self.__pm.model.timeout
+        if time_budget is not None:
+            self.__deadline = now + time_budget
         self.__dbg.spawn(cmdline)
     def update(self):
-        while self.__dbg.wait_event(50):
-            pass
-        self.__pm.update()
+        "Dispatch debug events until the next CPU sample is taken or the run is done"
+        wait_event = self.__dbg.wait_event
+        now = time.time()
+        while not self.done:
+            if self.__deadline is not None and now >= self.__deadline:
+                self._logger.info('Time budget exceeded')
+                self.__deadline = None
+                self.timed_out = True
+                self._terminate_target()
+            if now >= self.__next_sample:
+                self.__next_sample = now + self.sample_interval
+                self.__pm.update()
+                return
+            wake = self.__next_sample
+            if self.__deadline is not None and self.__deadline < wake:
+                wake = self.__deadline
+            wait_event(int(math.ceil((wake - now) * 1000)))
+            now = time.time()
     def on_process_create_begin(self, process):
         pass
     def on_process_create_end(self, process):
@@ -74,40 +164,92 @@ class TargetRunner(object):
         process.initial_thread.resume()
     def on_process_exit(self, process):
         self._logger.info('%s: exited', process)
-        # Process gets untracked automatically
-        # self.__pm.untrack_process(process.id)
+        self.__pm.process_exited(process.id, clean=self.evidence is None and not self.timed_out)
         if not self.__dbg.processes:
+            if self.tracer is not None:
+                self.tracer.close()
+            if self.recorder is not None:
+                self.recorder.flush()
             self.done = True
             self._logger.debug('Execution completed')
     def on_thread_create(self, thread):
         self._logger.debug('%s: created', thread)
+        if self.tracer is not None:
+            self.tracer.on_thread_create(thread)
     def on_thread_exit(self, thread):
         self._logger.debug('%s: exited', thread)
+        if self.tracer is not None:
+            self.tracer.on_thread_exit(thread)
     def on_module_load(self, module):
         self._logger.debug('Loaded %s', module)
+        if self.coverage is not None:
+            self.coverage.on_module_load(module)
     def on_module_unload(self, module):
         self._logger.debug('Unloaded %s', module)
+        if self.coverage is not None:
+            self.coverage.on_module_unload(module)
     def on_breakpoint(self, thread, context, bp):
         if not self.__initial_bp_hit:
             self.__initial_bp_hit = True
             return
         # Didn't expect the breakpoint.
         pass
+    def on_managed_breakpoint(self, thread, context, address):
+        if self.coverage is not None:
+            self.coverage.on_managed_breakpoint(thread, context, address)
     def on_single_step(self, thread):
-        # Single stepping is not expected.
-        pass
+        if self.tracer is not None:
+            self.tracer.on_single_step(thread)
     def on_exception(self, thread, info, first_chance):
         self._logger.info('%s: %s (%s)', thread, info, "1st chance" if first_chance else "2nd chance")
         if first_chance:
             # Log and be done; might be expected/handled
             return
         if info.code not in self.ignore_exceptions:
-            self.evidence = ExceptionEvidence(info)
+            process = thread.process
+            location = process.get_location_from_va(info.address)
+            context = thread.context
+            registers = dict((name, getattr(context, name)) for name in ExceptionEvidence.REGISTERS)
+            try:
+                frames = stack.walk_stack(thread, context)
+            except dbg.BonesException, e:
+                self._logger.info('%s: stack walk failed: %s', thread, e)
+                frames = None
+            locations = process.get_locations_from_va(frames[1:]) if frames else ()
+            trace = self.tracer.last(thread, self.trace_depth) if self.tracer is not None else None
+            self.evidence = ExceptionEvidence(info, str(location), [str(l) for l in locations], frames,
+                registers, self._read_code(process, context.eip), trace, location.symbolize())
         self._terminate_target()
     def on_process_idle(self, process_id):
         process = self.__dbg.processes[process_id]
         self._logger.info('%s: idle', process)
         self._terminate_target()
+    def on_process_hung(self, process_id):
+        process = self.__dbg.processes[process_id]
+        self._logger.info('%s: hung', process)
+        self.timed_out = True
+        self._terminate_target()
+    def on_process_finding(self, process_id, finding):
+        process = self.__dbg.processes[process_id]
+        self._logger.info('%s: %s', process, finding)
+        if self.evidence is None:
+            self.evidence = ResourceEvidence(finding, process_id, self.__pm.series[process_id])
+        self._terminate_target()
+    def __get_resources(self):
+        return self.__pm.series
+    resources = property(__get_resources, None, None, "Per-process ResourceSeries of the run")
+    def __get_features(self):
+        if self.coverage is not None:
+            return self.coverage.features()
+        return ()
+    features = property(__get_features, None, None, "Coverage features of the run, for corpus feedback")
+    def _read_code(self, process, address):
+        "Code bytes at the address, up to the end of its page; None if unreadable"
+        size = min(ExceptionEvidence.CODE_SIZE, 0x1000 - (address & 0xFFF))
+        try:
+            return process.read_memory(address, size)
+        except dbg.NtStatusError:
+            return None
     def _terminate_target(self):
         for pid, process in self.__dbg.processes.iteritems():
             process.terminate()
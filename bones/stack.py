@@ -0,0 +1,142 @@
+"""
+Layer 2 of the METALBONES core -- Python wrappers.
+
+Stack walking for crash evidence.
+
+The walk follows the EBP chain while it looks sane and falls back to
+scanning the stack for return addresses into module code. Memory is
+read through the process' page cache, so a walk costs one read per stack
+page touched plus one per code page looked at to check call sites.
+"""
+
+import array
+import struct
+import dbg
+
+PAGE_SIZE = 0x1000
+
+_dword = struct.Struct('<I')
+
+def _read(process, address, size):
+    "Memory at the address, or None if unreadable"
+    try:
+        return process.read_memory(address, size)
+    except dbg.NtStatusError:
+        return None
+
+def _dword_at(process, address):
+    data = _read(process, address, 4)
+    if data is None:
+        return None
+    return _dword.unpack(data)[0]
+
+def _in_code(process, address):
+    "Whether the address is in an executable section of a module"
+    module = process.get_module_from_va(address)
+    if module is None:
+        return False
+    image = module.image
+    if image is None:
+        # No headers to go by; anywhere in the module will do
+        return True
+    return image.is_executable(address - module.base_address)
+
+def _follows_call(process, address):
+    "Whether the instruction before the address may be a call"
+    code = _read(process, address - 7, 7)
+    if code is None:
+        return False
+    # call rel32
+    if code[2] == '\xE8':
+        return True
+    # call r/m32 (FF /2), with the common ModRM encodings
+    for length in (2, 3, 6, 7):
+        if code[7 - length] == '\xFF' and (ord(code[8 - length]) >> 3) & 7 == 2:
+            return True
+    return False
+
+def _stack_base(thread, esp):
+    "Stack base from the TEB, or a guess above esp"
+    teb = thread.teb_address
+    if teb:
+        try:
+            base, limit = struct.unpack('<II', thread.process.read_memory(teb + 4, 8))
+            if limit <= esp < base:
+                return base
+        except dbg.NtStatusError:
+            pass
+    return (esp | 0xFFFFF) + 1
+
+def walk_stack(thread, context=None, max_frames=32, scan_limit=0x2000, check_calls=True):
+    """Walk the thread's stack; returns an array('I') of frame addresses.
+
+    The first element is eip. Return addresses come from the EBP chain
+    while each saved frame pointer lies further up the stack and each
+    return address is within a module's code; after that, up to
+    `scan_limit` bytes of stack are scanned for dwords pointing into
+    executable module sections (and, with `check_calls`, just past
+    something that looks like a call). Reads go through the process'
+    page cache, enabled for the walk if it isn't already.
+    """
+    if context is None:
+        context = thread.context
+    process = thread.process
+    if process.cache is not None:
+        return _walk(process, thread, context, max_frames, scan_limit, check_calls)
+    process.enable_cache()
+    try:
+        return _walk(process, thread, context, max_frames, scan_limit, check_calls)
+    finally:
+        process.disable_cache()
+
+def _walk(process, thread, context, max_frames, scan_limit, check_calls):
+    frames = array.array('I', (context.eip,))
+    # Nothing below the lowest module can be a return address
+    lowest = min(process.modules) if process.modules else 0x100000000
+    esp = context.esp
+    base = _stack_base(thread, esp)
+    ebp = context.ebp
+    # Lowest stack address not yet accounted for
+    cursor = esp
+
+    while len(frames) < max_frames:
+        # Follow the chain as long as it is sane
+        while len(frames) < max_frames and cursor <= ebp < base - 8 and not ebp & 3:
+            next_ebp = _dword_at(process, ebp)
+            ret = _dword_at(process, ebp + 4)
+            if next_ebp is None or ret is None or not _in_code(process, ret):
+                break
+            frames.append(ret)
+            cursor = ebp + 8
+            ebp = next_ebp
+        if len(frames) >= max_frames:
+            break
+
+        # Scan for the next return address, a page of dwords at a time
+        found = False
+        address = cursor
+        end = min(base - 4, cursor + scan_limit)
+        while address <= end and not found:
+            page = address & ~(PAGE_SIZE - 1)
+            data = _read(process, page, PAGE_SIZE)
+            last = min(end, page + PAGE_SIZE - 4)
+            if data is not None:
+                words = array.array('I', data)
+                for i in xrange((address - page) >> 2, ((last - page) >> 2) + 1):
+                    ret = words[i]
+                    if ret >= lowest and _in_code(process, ret) and (
+                            not check_calls or _follows_call(process, ret)):
+                        address = page + (i << 2)
+                        found = True
+                        break
+            if not found:
+                address = last + 4
+        if not found:
+            break
+        frames.append(ret)
+        cursor = address + 4
+        # A standard frame keeps the saved EBP right below the return address
+        saved = _dword_at(process, address - 4)
+        ebp = saved if saved is not None and address < saved < base else base
+    return frames
+# EOF
@@ -0,0 +1,346 @@
+"""
+Layer 3 of the METALBONES core -- high-level code.
+
+Single-step execution tracing.
+
+Traced threads are single stepped throughout. Every step lands in a
+per-thread ring buffer, so the last instructions before a crash are
+always at hand, and optionally in a trace file.
+
+Trace files hold blocks of steps: eips (and register rows, if recorded)
+delta-encoded against the previous step and zlib-compressed per block.
+An index of blocks at the end gives random access; the code bytes of
+every distinct eip are saved too, so traces decode without the target.
+Values are little-endian u32 unless noted.
+
+    header:  magic flags block_size
+    block:   steps compressed_length data
+    index:   (offset:u64 first_step:u32) per block
+    code:    count compressed_length data (eips, lengths:u8, bytes)
+    footer:  index_offset:u64 code_offset:u64 blocks steps magic
+"""
+
+import os
+import mmap
+import zlib
+import array
+import bisect
+import struct
+import dbg
+import mcode
+
+MAGIC = 'BNTRACE1'
+FLAG_REGISTERS = 1
+
+# Register row layout, as mcode.AddressTable takes it
+REGISTERS = mcode.TABLE_REGISTERS
+ROW = len(REGISTERS)
+
+CODE_SIZE = 16
+
+_header = struct.Struct('<8sII')
+_block = struct.Struct('<II')
+_index_entry = struct.Struct('<QI')
+_code = struct.Struct('<II')
+_footer = struct.Struct('<QQII8s')
+
+def _delta_encode(values, stride):
+    "Each value minus the one `stride` before it, mod 2**32"
+    deltas = array.array('I', values)
+    for i in xrange(len(values) - 1, stride - 1, -1):
+        deltas[i] = (values[i] - values[i - stride]) & 0xFFFFFFFF
+    return deltas
+
+def _delta_decode(deltas, stride):
+    for i in xrange(stride, len(deltas)):
+        deltas[i] = (deltas[i] + deltas[i - stride]) & 0xFFFFFFFF
+    return deltas
+
+class RingBuffer(object):
+    "The last `size` steps of a thread: eips and, optionally, register rows"
+    def __init__(self, size=4096, registers=False):
+        self.size = size
+        self.eips = array.array('I', [0]) * size
+        self.rows = array.array('I', [0]) * (size * ROW) if registers else None
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, eip, row=None):
+        pos = self.count % self.size
+        self.eips[pos] = eip
+        if self.rows is not None:
+            self.rows[pos * ROW:pos * ROW + ROW] = row
+        self.count += 1
+
+    def _span(self, n, buffer, width):
+        n = min(len(self), self.size if n is None else n)
+        if n <= 0:
+            return array.array('I')
+        end = self.count % self.size
+        start = (end - n) % self.size
+        if start < end:
+            return buffer[start * width:end * width]
+        return buffer[start * width:] + buffer[:end * width]
+
+    def last(self, n=None):
+        "The last n eips, oldest first"
+        return self._span(n, self.eips, 1)
+    def last_rows(self, n=None):
+        "The register rows of the last n steps, flattened, oldest first"
+        if self.rows is None:
+            return None
+        return self._span(n, self.rows, ROW)
+#
+class TraceWriter(object):
+    "Writes a trace file; see the module docstring for the layout"
+    def __init__(self, path, registers=False, block_size=4096, level=6):
+        self.fp = open(path, 'wb')
+        self.registers = registers
+        self.block_size = block_size
+        self.level = level
+        self.fp.write(_header.pack(MAGIC, FLAG_REGISTERS if registers else 0, block_size))
+        self.index = []
+        self.steps = 0
+        self.code = {}
+        self._eips = array.array('I')
+        self._rows = array.array('I')
+
+    def append(self, eip, row=None):
+        self._eips.append(eip)
+        if self.registers:
+            self._rows.extend(row)
+        if len(self._eips) >= self.block_size:
+            self._flush_block()
+
+    def add_code(self, eip, code):
+        "Save the code bytes at eip, for decoding later"
+        self.code.setdefault(eip, code)
+
+    def _flush_block(self):
+        count = len(self._eips)
+        if not count:
+            return
+        body = _delta_encode(self._eips, 1).tostring()
+        if self.registers:
+            body += _delta_encode(self._rows, ROW).tostring()
+        data = zlib.compress(body, self.level)
+        self.index.append((self.fp.tell(), self.steps))
+        self.fp.write(_block.pack(count, len(data)))
+        self.fp.write(data)
+        self.steps += count
+        self._eips = array.array('I')
+        self._rows = array.array('I')
+
+    def close(self):
+        self._flush_block()
+        index_offset = self.fp.tell()
+        for entry in self.index:
+            self.fp.write(_index_entry.pack(*entry))
+        code_offset = self.fp.tell()
+        eips = array.array('I', sorted(self.code))
+        lengths = array.array('B', (len(self.code[eip]) for eip in eips))
+        data = zlib.compress(eips.tostring() + lengths.tostring() + ''.join(self.code[eip] for eip in eips), self.level)
+        self.fp.write(_code.pack(len(eips), len(data)))
+        self.fp.write(data)
+        self.fp.write(_footer.pack(index_offset, code_offset, len(self.index), self.steps, MAGIC))
+        self.fp.close()
+#
+class TraceReader(object):
+    """Random access to a trace file through mmap.
+
+    Indexing by step number yields eips; blocks are decompressed on demand
+    and the last one used is kept.
+    """
+    def __init__(self, path):
+        self.fp = open(path, 'rb')
+        if os.fstat(self.fp.fileno()).st_size < _header.size + _footer.size:
+            self.fp.close()
+            raise ValueError('Not a trace file')
+        self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, flags, self.block_size = _header.unpack_from(self.map, 0)
+        index_offset, code_offset, blocks, self.steps, end_magic = _footer.unpack_from(self.map, len(self.map) - _footer.size)
+        if magic != MAGIC or end_magic != MAGIC:
+            self.close()
+            raise ValueError('Not a trace file')
+        self.registers = bool(flags & FLAG_REGISTERS)
+        self.offsets = []
+        self.firsts = []
+        for i in xrange(blocks):
+            offset, first = _index_entry.unpack_from(self.map, index_offset + i * _index_entry.size)
+            self.offsets.append(offset)
+            self.firsts.append(first)
+        self.code_offset = code_offset
+        self._code = None
+        self._insns = {}
+        self._cached = None
+
+    def close(self):
+        self.map.close()
+        self.fp.close()
+
+    def __len__(self):
+        return self.steps
+
+    def block(self, i):
+        "Block #i as (first step, eips, flattened register rows or None)"
+        if self._cached is not None and self._cached[0] == i:
+            return self._cached[1]
+        count, length = _block.unpack_from(self.map, self.offsets[i])
+        start = self.offsets[i] + _block.size
+        body = zlib.decompress(self.map[start:start + length])
+        eips = _delta_decode(array.array('I', body[:count * 4]), 1)
+        rows = None
+        if self.registers:
+            rows = _delta_decode(array.array('I', body[count * 4:]), ROW)
+        result = self.firsts[i], eips, rows
+        self._cached = i, result
+        return result
+
+    def _locate(self, step):
+        if not 0 <= step < self.steps:
+            raise IndexError('Step %d out of range' % step)
+        i = bisect.bisect_right(self.firsts, step) - 1
+        first, eips, rows = self.block(i)
+        return step - first, eips, rows
+
+    def __getitem__(self, step):
+        pos, eips, rows = self._locate(step)
+        return eips[pos]
+
+    def row(self, step):
+        "Registers at the step, as a dict"
+        pos, eips, rows = self._locate(step)
+        if rows is None:
+            return None
+        return dict(zip(REGISTERS, rows[pos * ROW:pos * ROW + ROW]))
+
+    def eips(self, start=0, stop=None):
+        "The eips of a range of steps, as one array"
+        stop = self.steps if stop is None else min(stop, self.steps)
+        result = array.array('I')
+        step = start
+        while step < stop:
+            pos, eips, rows = self._locate(step)
+            chunk = eips[pos:pos + stop - step]
+            result.extend(chunk)
+            step += len(chunk)
+        return result
+
+    def code(self, eip):
+        "The code bytes saved for the eip, or None"
+        if self._code is None:
+            count, length = _code.unpack_from(self.map, self.code_offset)
+            start = self.code_offset + _code.size
+            data = zlib.decompress(self.map[start:start + length])
+            eips = array.array('I', data[:count * 4])
+            lengths = array.array('B', data[count * 4:count * 5])
+            self._code = {}
+            pos = count * 5
+            for eip_, length_ in zip(eips, lengths):
+                self._code[eip_] = data[pos:pos + length_]
+                pos += length_
+        return self._code.get(eip)
+
+    def decode(self, eips):
+        """mcode insns for the eips, each distinct one decoded once.
+
+        Undecodable or missing code gives None.
+        """
+        insns = self._insns
+        result = []
+        for eip in eips:
+            try:
+                insn = insns[eip]
+            except KeyError:
+                insn = None
+                code = self.code(eip)
+                if code:
+                    try:
+                        insn = mcode.decode(mcode.State(mcode.StringReader(code)))
+                    except (mcode.Error, IndexError):
+                        pass
+                insns[eip] = insn
+            result.append(insn)
+        return result
+#
+class Tracer(object):
+    """Single steps threads, keeping their last steps in ring buffers.
+
+    Threads for which `select(thread)` holds (all, by default) are traced
+    from creation. With `path` (a directory) set, full traces are written
+    there as <pid>_<tid>.trace. Route the debugger's on_thread_create,
+    on_thread_exit and on_single_step events here.
+    """
+    def __init__(self, ring_size=4096, registers=False, path=None, select=None, block_size=4096):
+        self.ring_size = ring_size
+        self.registers = registers
+        self.path = path
+        self.select = select
+        self.block_size = block_size
+        # (pid, tid) -> RingBuffer / TraceWriter
+        self.rings = {}
+        self.writers = {}
+        if path is not None and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def start(self, thread):
+        key = thread.process.id, thread.id
+        self.rings[key] = RingBuffer(self.ring_size, self.registers)
+        if self.path is not None:
+            name = os.path.join(self.path, '%d_%d.trace' % key)
+            self.writers[key] = TraceWriter(name, self.registers, self.block_size)
+        thread.tracing = True
+        thread.set_single_step()
+
+    def stop(self, thread):
+        thread.tracing = False
+        writer = self.writers.pop((thread.process.id, thread.id), None)
+        if writer is not None:
+            writer.close()
+
+    def close(self):
+        for writer in self.writers.itervalues():
+            writer.close()
+        self.writers.clear()
+
+    def on_thread_create(self, thread):
+        if self.select is None or self.select(thread):
+            self.start(thread)
+    def on_thread_exit(self, thread):
+        if thread.tracing:
+            self.stop(thread)
+
+    def on_single_step(self, thread):
+        if not thread.tracing:
+            return
+        key = thread.process.id, thread.id
+        context = thread.context
+        eip = context.eip
+        row = None
+        if self.registers:
+            row = array.array('I', [getattr(context, name) for name in REGISTERS])
+        self.rings[key].append(eip, row)
+        writer = self.writers.get(key)
+        if writer is not None:
+            writer.append(eip, row)
+            if eip not in writer.code:
+                writer.add_code(eip, self._read_code(thread.process, eip))
+        context.eflags.tf = True
+        thread.context = context
+
+    def _read_code(self, process, address):
+        size = min(CODE_SIZE, 0x1000 - (address & 0xFFF))
+        try:
+            return process.read_memory(address, size)
+        except dbg.NtStatusError:
+            return ''
+
+    def last(self, thread, n=None):
+        "The thread's last n eips, oldest first; None if not traced"
+        ring = self.rings.get((thread.process.id, thread.id))
+        if ring is None:
+            return None
+        return ring.last(n)
+# EOF
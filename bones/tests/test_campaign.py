@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import campaign
+import corpus
+
+class FailingRunner(object):
+    def start(self, cmdline):
+        raise RuntimeError('Cannot start the target')
+
+class OneFailingRunner(campaign.FakeRunner):
+    "Fails in whichever worker first claims the marker file"
+    marker = None
+    def start(self, cmdline):
+        try:
+            os.rename(OneFailingRunner.marker, OneFailingRunner.marker + '.taken')
+        except OSError:
+            return campaign.FakeRunner.start(self, cmdline)
+        # Let the other worker get ahead
+        time.sleep(0.5)
+        raise RuntimeError('Cannot start the target')
+
+class CampaignTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.corpus = corpus.Corpus(os.path.join(self.path, 'corpus'))
+        self.corpus.add_seed('\0' * 32)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def campaign(self, runner_factory, **kwargs):
+        return campaign.Campaign(self.corpus, 'target %s', os.path.join(self.path, 'crashes'),
+            runner_factory, workers=2, work_dir=self.path, poll_interval=0.1, **kwargs)
+
+    def test_runs(self):
+        c = self.campaign(campaign.FakeRunner)
+        c.run(50)
+        self.assertEqual(c.executions, 50)
+        self.assertTrue(len(self.corpus.entries) > 1)
+
+    def test_worker_error_raised(self):
+        c = self.campaign(FailingRunner)
+        with self.assertRaises(campaign.WorkerError) as cm:
+            c.run(10)
+        self.assertTrue('Cannot start the target' in str(cm.exception))
+
+    def test_worker_error_with_results_pending(self):
+        # Results big enough to fill the pipe once the master gives up
+        self.corpus = corpus.Corpus(os.path.join(self.path, 'big'))
+        self.corpus.add_seed('\0' * 0x40000)
+        OneFailingRunner.marker = os.path.join(self.path, 'fail')
+        open(OneFailingRunner.marker, 'w').close()
+        c = self.campaign(OneFailingRunner)
+        self.assertRaises(campaign.WorkerError, c.run, 100000)
+
+    def test_needs_feature_source(self):
+        self.assertRaises(ValueError, self.campaign, None)
+#
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import shutil
+import tempfile
+import unittest
+import corpus
+
+class CorpusTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_untimed_seeds_not_averaged(self):
+        c = corpus.Corpus(self.path)
+        for i in xrange(3):
+            c.add_seed('seed%d' % i)
+        entry = c.add('x', 2.0, ['a'])
+        c.add('y', 2.0, ['b'])
+        # Average of the timed entries only: `entry` is exactly average
+        entry.times_chosen = 1
+        self.assertEqual(c.energy(entry), int(100 * (1 + 1 / 5.0)))
+
+    def test_feedback_kept_on_load(self):
+        c = corpus.Corpus(self.path)
+        c.add('x', 1.0, ['a'])
+        c.save()
+        mine = corpus.SetFeedback()
+        self.assertTrue(corpus.Corpus(self.path, mine).feedback is mine)
+        loaded = corpus.Corpus(self.path)
+        self.assertEqual(loaded.feedback.seen, set(['a']))
+        self.assertEqual(loaded.timed_entries, 1)
+#
+if __name__ == '__main__':
+    unittest.main()
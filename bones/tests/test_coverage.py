@@ -0,0 +1,36 @@
+import unittest
+import dbg
+import replay
+import coverage
+from tests.test_replay import PID, HPROC, TID, HTHREAD, BASE
+
+class CoverageDebugger(dbg.Debugger):
+    def __init__(self, backend, collector):
+        self.collector = collector
+        dbg.Debugger.__init__(self, backend)
+    def on_module_load(self, module):
+        self.collector.on_module_load(module)
+    def on_managed_breakpoint(self, thread, context, address):
+        self.collector.on_managed_breakpoint(thread, context, address)
+
+def hit(address):
+    "A breakpoint hit at the address, as seen after the int3"
+    return [('context', HTHREAD, replay.Context(eip=address + 1)), ('_on_breakpoint', PID, TID)]
+
+class CoverageTest(unittest.TestCase):
+    def test_block_hits(self):
+        backend = replay.ReplayBackend([('context', HTHREAD, replay.Context(eip=BASE + 0x1000)),
+            ('_on_process_create', PID, HPROC, TID, HTHREAD, BASE, BASE + 0x1000)] +
+            hit(BASE + 0x1010) + hit(BASE + 0x1000))
+        backend.add_region(HPROC, BASE, '\x90' * 0x2000, dbg.Process.PAGE_EXECUTE_READ, 'a.exe')
+        collector = coverage.CoverageCollector({'A.exe': [0x1000, 0x1010, 0x1020]})
+        CoverageDebugger(backend, collector)
+        self.assertEqual(backend.run(), 3)
+        self.assertEqual(backend.vmem_read(HPROC, BASE + 0x1000, 0x21), '\x90' * 0x20 + '\xCC')
+        self.assertEqual(collector.modules['a.exe'].bitmap, bytearray([1, 1, 0]))
+        self.assertEqual(collector.features(), set([('a.exe', 0), ('a.exe', 1)]))
+        collector.reset()
+        self.assertEqual(collector.features(), set())
+#
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+import dbg
+import crashdb
+import runner
+
+def evidence(address=0x401000, frames=('a.exe+00001234', 'a.exe+00002000')):
+    info = dbg.AccessViolationInfo((0xC0000005L, address, 0L, (0L, 0L), None))
+    return runner.ExceptionEvidence(info, 'a.exe+%08x' % (address - 0x400000), frames)
+
+class CrashStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = crashdb.CrashStore(self.path, suffix='.bin')
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.path)
+
+    def test_bucket_key_stable(self):
+        self.assertEqual(crashdb.bucket_key(evidence()), crashdb.bucket_key(evidence()))
+        self.assertNotEqual(crashdb.bucket_key(evidence()), crashdb.bucket_key(evidence(0x401004)))
+        # Frames below the depth don't count
+        deep = evidence(frames=('x', 'y', 'z'))
+        self.assertEqual(crashdb.bucket_key(deep, 2), crashdb.bucket_key(evidence(frames=('x', 'y', 'w')), 2))
+
+    def test_duplicate_bumps_count_only(self):
+        key, new = self.store.add(evidence(), 'first')
+        self.assertTrue(new)
+        files = sorted(os.listdir(self.path))
+        first_seen = self.store.get(key).first_seen
+        for i in xrange(3):
+            self.assertEqual(self.store.add(evidence(), 'again'), (key, False))
+        self.assertEqual(sorted(os.listdir(self.path)), files)
+        bucket = self.store.get(key)
+        self.assertEqual(bucket.count, 4)
+        self.assertEqual(bucket.first_seen, first_seen)
+        self.assertTrue(bucket.last_seen >= first_seen)
+        with open(self.store.sample_path(bucket), 'rb') as fp:
+            self.assertEqual(fp.read(), 'first')
+
+    def test_duplicates_batched(self):
+        key, new = self.store.add(evidence(), 'first')
+        self.store.add(evidence(), 'again')
+        self.assertEqual(self.store.pending[key][0], 1)
+        row = self.store.db.execute('SELECT count FROM buckets WHERE key = ?', (key,)).fetchone()
+        self.assertEqual(row[0], 1)
+        self.store.flush()
+        self.assertEqual(self.store.pending, {})
+        row = self.store.db.execute('SELECT count FROM buckets WHERE key = ?', (key,)).fetchone()
+        self.assertEqual(row[0], 2)
+
+    def test_reopen(self):
+        key, new = self.store.add(evidence(), 'first')
+        other, new = self.store.add(evidence(0x401004), 'second')
+        self.store.add(evidence(), 'again')
+        self.store.close()
+        self.store = crashdb.CrashStore(self.path, suffix='.bin')
+        self.assertEqual(self.store.keys, set([key, other]))
+        self.assertTrue(self.store.seen(evidence()))
+        self.assertEqual(self.store.get(key).count, 2)
+        self.assertEqual(self.store.add(evidence(0x401004), 'again'), (other, False))
+#
+if __name__ == '__main__':
+    unittest.main()
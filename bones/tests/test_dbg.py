@@ -0,0 +1,287 @@
+import logging
+import unittest
+import dbg
+from formats import pe
+import replay
+from tests.test_replay import start, PID, HPROC, TID, HTHREAD, BASE
+
+class PageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.memory = ''.join(chr(i & 0xFF) for i in xrange(0x3000))
+        self.reads = []
+        self.cache = dbg.PageCache(self.read)
+
+    def read(self, address, size):
+        self.reads.append((address, size))
+        return self.memory[address:address + size]
+
+    def test_hit_and_miss(self):
+        self.assertEqual(self.cache.read_view(0x10, 4).tobytes(), self.memory[0x10:0x14])
+        self.assertEqual(self.cache.read_view(0x800, 4).tobytes(), self.memory[0x800:0x804])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(self.reads, [(0, 0x1000)])
+
+    def test_read_across_pages(self):
+        self.assertEqual(self.cache.read_view(0xFFE, 4).tobytes(), self.memory[0xFFE:0x1002])
+        self.assertEqual(self.reads, [(0, 0x1000), (0x1000, 0x1000)])
+
+    def test_invalidate(self):
+        self.cache.read_view(0x10, 4)
+        self.cache.read_view(0x1010, 4)
+        self.memory = '\xFF' * 0x3000
+        self.cache.invalidate(0xFFF, 2)
+        self.assertEqual(self.cache.read_view(0x10, 4).tobytes(), '\xFF' * 4)
+        self.assertEqual(self.cache.read_view(0x1010, 4).tobytes(), '\xFF' * 4)
+        self.assertEqual(self.cache.misses, 4)
+
+    def test_clear(self):
+        self.cache.read_view(0x10, 4)
+        self.cache.clear()
+        self.cache.read_view(0x10, 4)
+        self.assertEqual(self.cache.misses, 2)
+
+class ProcessCacheTest(unittest.TestCase):
+    def test_write_invalidates(self):
+        debugger, backend = start(regions=[(BASE, '\0' * 0x1000, dbg.Process.PAGE_READWRITE)])
+        process = debugger.processes[PID]
+        process.enable_cache()
+        self.assertEqual(process.read_memory(BASE, 2), '\0\0')
+        process.write_memory(BASE, 'ab')
+        self.assertEqual(process.read_memory(BASE, 2), 'ab')
+        self.assertEqual(process.cache.misses, 2)
+class BreakpointManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.debugger, self.backend = start(regions=[(BASE, '\x90' * 0x2000, dbg.Process.PAGE_EXECUTE_READ)])
+        self.manager = self.debugger.processes[PID].breakpoint_manager
+        self.manager.arm([BASE + 0x10, BASE + 0x1010, BASE + 0x1020], persistent=True)
+
+    def protect(self, page):
+        return self.backend.vmem_query(HPROC, page)[3]
+
+    def test_disarm_subset_restores_emptied_pages(self):
+        self.manager.disarm([BASE + 0x10, BASE + 0x1010])
+        self.assertEqual(self.protect(BASE), dbg.Process.PAGE_EXECUTE_READ)
+        self.assertEqual(self.protect(BASE + 0x1000), dbg.Process.PAGE_EXECUTE_READWRITE)
+        self.assertEqual(self.manager.writable_pages.keys(), [BASE + 0x1000])
+        self.manager.disarm([BASE + 0x1020])
+        self.assertEqual(self.protect(BASE + 0x1000), dbg.Process.PAGE_EXECUTE_READ)
+        self.assertEqual(self.manager.writable_pages, {})
+        self.assertEqual(self.backend.vmem_read(HPROC, BASE + 0x1010, 0x11), '\x90' * 0x11)
+
+    def test_discard_keeps_shared_pages(self):
+        self.manager.discard([BASE + 0x10, BASE + 0x1010])
+        self.assertEqual(self.manager.writable_pages.keys(), [BASE + 0x1000])
+        self.assertFalse(self.manager.is_armed(BASE + 0x1010))
+        self.assertTrue(self.manager.is_armed(BASE + 0x1020))
+        self.manager.disarm()
+        self.assertEqual(self.protect(BASE + 0x1000), dbg.Process.PAGE_EXECUTE_READ)
+
+class ModuleImageTest(unittest.TestCase):
+    def test_image_read_from_memory(self):
+        from tests.test_stack import image
+        headers = image([('.text', 0x1000, 0x1000, pe.SCN_MEM_EXECUTE)], size=0x3000)
+        debugger, backend = start(regions=[(BASE, str(headers), dbg.Process.PAGE_EXECUTE_READ)])
+        module = debugger.processes[PID].modules[BASE]
+        self.assertEqual(module.path, 'a.exe')
+        self.assertEqual([s.name for s in module.image.sections], ['.text'])
+        self.assertEqual(module.mapped_size, 0x3000)
+
+class ModuleIndexTest(unittest.TestCase):
+    # Base -> image size; loaded out of order after the executable
+    SIZES = {BASE: 0x3000, 0x30000000: 0x1000, 0x10000000: 0x2000, 0x20000000: 0x4000}
+
+    def setUp(self):
+        from tests.test_stack import image
+        loads = [('_on_module_load', PID, base) for base in (0x30000000, 0x10000000, 0x20000000)]
+        self.debugger, self.backend = start(events=loads + [('_on_module_unload', PID, 0x20000000)],
+            regions=[(base, str(image([], size)), dbg.Process.PAGE_READONLY) for base, size in self.SIZES.items()])
+        self.process = self.debugger.processes[PID]
+
+    def base_of(self, address):
+        module = self.process.get_module_from_va(address)
+        return module and module.base_address
+
+    def test_out_of_order_loads(self):
+        self.backend.run()
+        self.assertEqual(self.process._module_bases, [BASE, 0x10000000, 0x30000000])
+        self.assertEqual(self.base_of(0x10001FFF), 0x10000000)
+        self.assertEqual(self.base_of(0x30000000), 0x30000000)
+        self.assertEqual(self.base_of(BASE + 0x2FFF), BASE)
+
+    def test_unload_in_the_middle(self):
+        for i in xrange(3):
+            self.backend.wait_event()
+        self.assertEqual(self.base_of(0x20000010), 0x20000000)
+        self.backend.wait_event()
+        self.assertEqual(self.base_of(0x20000010), None)
+        self.assertEqual(self.base_of(0x30000010), 0x30000000)
+
+    def test_past_end_and_below_lowest(self):
+        self.backend.run()
+        self.assertEqual(self.base_of(BASE + 0x3000), None)
+        self.assertEqual(self.base_of(0x10002000), None)
+        self.assertEqual(self.base_of(BASE - 1), None)
+        self.assertEqual(self.base_of(0), None)
+        self.assertEqual(self.base_of(0x30001000), None)
+
+    def test_batch_matches_single(self):
+        self.backend.run()
+        addresses = [0x30000FFF, 0, BASE + 0x10, 0x20000000, 0x10001000, BASE + 0x3000, 0x10000000, 0x30000000, BASE - 1]
+        self.assertEqual(self.process.get_modules_from_va(addresses),
+            [self.process.get_module_from_va(a) for a in addresses])
+        self.assertEqual([m and m.base_address for m in self.process.get_modules_from_va(addresses)],
+            [0x30000000, None, BASE, None, 0x10000000, None, 0x10000000, 0x30000000, None])
+
+def hit(address):
+    "A breakpoint hit at the address, then the single step past it"
+    return [('context', HTHREAD, replay.Context(eip=address + 1)), ('_on_breakpoint', PID, TID),
+        ('context', HTHREAD, replay.Context(eip=address + 1)), ('_on_single_step', PID, TID)]
+
+class Events(dbg.Debugger):
+    "Notes the events handed on"
+    def __init__(self, backend):
+        dbg.Debugger.__init__(self, backend)
+        self.seen = []
+    def on_breakpoint(self, thread, context, bp):
+        self.seen.append(('breakpoint', context.eip, bp))
+    def on_managed_breakpoint(self, thread, context, address):
+        self.seen.append(('managed', address))
+    def on_single_step(self, thread):
+        self.seen.append(('step',))
+    def on_hw_breakpoint(self, thread, context, hits):
+        self.seen.append(('hw', hits))
+
+class BreakpointHitTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = replay.ReplayBackend([('context', HTHREAD, replay.Context(eip=BASE)),
+            ('_on_process_create', PID, HPROC, TID, HTHREAD, BASE, BASE)] + hit(BASE + 0x10) + hit(BASE + 0x10))
+        self.backend.add_region(HPROC, BASE, '\x90' * 0x1000, dbg.Process.PAGE_EXECUTE_READ, 'a.exe')
+        self.debugger = Events(self.backend)
+        self.backend.wait_event()
+        self.process = self.debugger.processes[PID]
+
+    def byte(self, address):
+        return self.backend.vmem_read(HPROC, address, 1)
+
+    def context(self):
+        return self.backend.contexts[HTHREAD]
+
+    def test_persistent_rearmed_after_step(self):
+        manager = self.process.breakpoint_manager
+        manager.arm([BASE + 0x10], persistent=True)
+        slot = manager.slots[BASE + 0x10]
+        for count in (1, 2):
+            self.backend.wait_event()
+            self.assertEqual(self.byte(BASE + 0x10), '\x90')
+            self.assertEqual(self.context().eip, BASE + 0x10)
+            self.assertTrue(self.context().eflags.tf)
+            self.assertEqual((manager.hit_counts[slot], manager.last_thread[slot]), (count, TID))
+            self.backend.wait_event()
+            self.assertEqual(self.byte(BASE + 0x10), '\xCC')
+            self.assertTrue(manager.is_armed(BASE + 0x10))
+        self.assertEqual(self.debugger.seen, [('managed', BASE + 0x10)] * 2)
+
+    def test_one_shot_not_rearmed(self):
+        manager = self.process.breakpoint_manager
+        manager.arm([BASE + 0x10])
+        self.backend.wait_event()
+        self.assertEqual(self.byte(BASE + 0x10), '\x90')
+        self.assertFalse(self.context().eflags.tf)
+        self.assertFalse(manager.is_armed(BASE + 0x10))
+        self.backend.wait_event()
+        self.assertEqual(self.byte(BASE + 0x10), '\x90')
+        self.assertEqual(self.debugger.seen, [('managed', BASE + 0x10), ('step',)])
+
+    def test_legacy_auto_rearm(self):
+        self.backend.vmem_protect(HPROC, BASE, 0x1000, dbg.Process.PAGE_EXECUTE_READWRITE)
+        bp = self.process.get_breakpoint(BASE + 0x10)
+        bp.auto_rearm = True
+        bp.arm()
+        self.backend.wait_event()
+        self.assertEqual(self.byte(BASE + 0x10), '\x90')
+        self.assertTrue(self.context().eflags.tf)
+        self.assertTrue(self.process.pending_rearm[TID] is bp)
+        self.backend.wait_event()
+        self.assertEqual(self.byte(BASE + 0x10), '\xCC')
+        self.assertTrue(bp.is_armed())
+        self.assertEqual(self.debugger.seen, [('breakpoint', BASE + 0x10, bp)])
+
+class Dr7Test(unittest.TestCase):
+    def test_round_trip(self):
+        dr7 = 0
+        cases = [(0, dbg.HwBreakpoint.EVENT_X, 1), (1, dbg.HwBreakpoint.EVENT_W, 2),
+            (2, dbg.HwBreakpoint.EVENT_RW, 8), (3, dbg.HwBreakpoint.EVENT_W, 4)]
+        for slot, event, length in cases:
+            dr7 = dbg.dr7_enable(dr7, slot, event, length)
+        self.assertEqual(dr7, 0xDB500055)
+        for slot, event, length in cases:
+            self.assertEqual(dbg.dr7_condition(dr7, slot), (event, length))
+        dr7 = dbg.dr7_disable(dr7, 1)
+        self.assertEqual(dr7, 0xDB000051)
+        self.assertEqual(dbg.dr7_condition(dr7, 1), None)
+        self.assertEqual(dbg.dr7_condition(dr7, 2), (dbg.HwBreakpoint.EVENT_RW, 8))
+
+    def test_enable_replaces_condition(self):
+        dr7 = dbg.dr7_enable(0x400, 0, dbg.HwBreakpoint.EVENT_RW, 4)
+        dr7 = dbg.dr7_enable(dr7, 0, dbg.HwBreakpoint.EVENT_X, 1)
+        self.assertEqual(dr7, 0x401)
+
+class HwBreakpointManagerTest(unittest.TestCase):
+    def test_new_thread_out_of_registers(self):
+        class Debugger(dbg.Debugger):
+            def on_process_create_begin(self, process):
+                # No threads yet: nothing limits the process-wide breakpoints
+                for i in xrange(5):
+                    process.hw_breakpoints.add(BASE + 0x1000 + i)
+        backend = replay.ReplayBackend([('context', HTHREAD, replay.Context()),
+            ('_on_process_create', PID, HPROC, TID, HTHREAD, BASE, BASE + 0x1000)])
+        Debugger(backend)
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logging.getLogger().addHandler(handler)
+        try:
+            backend.wait_event()
+        finally:
+            logging.getLogger().removeHandler(handler)
+        self.assertEqual(len(records), 1)
+        context = backend.contexts[HTHREAD]
+        self.assertEqual([context.dr0, context.dr1, context.dr2, context.dr3],
+            [BASE + 0x1000, BASE + 0x1001, BASE + 0x1002, BASE + 0x1003])
+        self.assertEqual(context.dr7 & 0xFF, 0x55)
+
+    def test_single_step_hits(self):
+        steps = []
+        for eip, dr6 in ((BASE + 0x1000, 0x1), (BASE + 0x1005, 0x2), (BASE + 0x1008, 0x4002), (BASE + 0x1009, 0x4000)):
+            steps += [('context', HTHREAD, replay.Context(eip=eip, dr6=dr6 | 0xFFFF0FF0)), ('_on_single_step', PID, TID)]
+        backend = replay.ReplayBackend([('context', HTHREAD, replay.Context()),
+            ('_on_process_create', PID, HPROC, TID, HTHREAD, BASE, BASE + 0x1000)] + steps)
+        debugger = Events(backend)
+        backend.wait_event()
+        hw = debugger.processes[PID].hw_breakpoints
+        thread = debugger.processes[PID].threads[TID]
+        x = hw.add(BASE + 0x1000, thread=thread)
+        w = hw.add(BASE + 0x2000, dbg.HwBreakpoint.EVENT_W, 4, thread)
+        hw.apply()
+        # B0: the execute breakpoint, resumed with RF
+        backend.wait_event()
+        context = backend.contexts[HTHREAD]
+        self.assertEqual(debugger.seen, [('hw', [x])])
+        self.assertTrue(context.eflags.rf)
+        self.assertEqual(context.dr6, 0xFFFF0FF0)
+        # B1: the write breakpoint, no RF
+        backend.wait_event()
+        self.assertEqual(debugger.seen[1:], [('hw', [w])])
+        self.assertFalse(backend.contexts[HTHREAD].eflags.rf)
+        # B1 and BS: the hit, then the single step
+        backend.wait_event()
+        self.assertEqual(debugger.seen[2:], [('hw', [w]), ('step',)])
+        self.assertEqual(backend.contexts[HTHREAD].dr6, 0xFFFF0FF0)
+        # BS alone
+        backend.wait_event()
+        self.assertEqual(debugger.seen[4:], [('step',)])
+        self.assertEqual(backend.contexts[HTHREAD].dr6, 0xFFFF0FF0)
+        self.assertEqual((x.hits, w.hits), (1, 2))
+#
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import unittest
+import dbg
+import replay
+import eventlog
+
+PID, HPROC, TID, HTHREAD = 1, 0x10, 4, 0x20
+BASE = 0x400000
+
+class Contexts(dbg.Debugger):
+    "Notes the eip and eax seen at each breakpoint"
+    def __init__(self, backend, recorder=None):
+        dbg.Debugger.__init__(self, backend, recorder)
+        self.seen = []
+    def on_breakpoint(self, thread, context, bp):
+        self.seen.append((context.eip, context.eax, context.eflags.zf))
+#
+class EventLogTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_breakpoints_replay_from_log(self):
+        events = [
+            ('context', HTHREAD, replay.Context(eip=BASE + 0x1000)),
+            ('_on_process_create', PID, HPROC, TID, HTHREAD, BASE, BASE + 0x1000),
+            ('context', HTHREAD, replay.Context(eip=BASE + 0x1011, eax=7, eflags=0x40)),
+            ('_on_breakpoint', PID, TID),
+            ('_on_exception', PID, TID, (0xC0000005L, BASE + 0x1020, 0L, (1L, 0L), None), False),
+        ]
+        log_path = os.path.join(self.path, 'events.log')
+        recorder = eventlog.EventRecorder(log_path)
+        original = Contexts(replay.ReplayBackend(events), recorder)
+        original.backend.run()
+        recorder.close()
+
+        log = eventlog.EventLog(log_path)
+        try:
+            replayed = Contexts(replay.ReplayBackend(list(log)))
+        finally:
+            log.close()
+        replayed.backend.run()
+        self.assertEqual(replayed.seen, [(BASE + 0x1010, 7, True)])
+        self.assertEqual(replayed.seen, original.seen)
+
+    def test_breakpoint_manager_run_replays_with_memory(self):
+        code = '\x90' * 0x1000
+        hit = [('context', HTHREAD, replay.Context(eip=BASE + 0x11)), ('_on_breakpoint', PID, TID),
+            ('context', HTHREAD, replay.Context(eip=BASE + 0x11)), ('_on_single_step', PID, TID)]
+        events = [
+            ('context', HTHREAD, replay.Context(eip=BASE + 0x10)),
+            ('_on_process_create', PID, HPROC, TID, HTHREAD, BASE, BASE + 0x10),
+        ] + hit + hit
+        def run(events, regions):
+            backend = replay.ReplayBackend(events)
+            for base, data in regions:
+                backend.add_region(HPROC, base, data, dbg.Process.PAGE_EXECUTE_READ, 'a.exe')
+            debugger = dbg.Debugger(backend, recorder)
+            backend.wait_event()
+            manager = debugger.processes[PID].breakpoint_manager
+            manager.arm([BASE + 0x10], persistent=True)
+            backend.run()
+            return backend, manager
+        log_path = os.path.join(self.path, 'events.log')
+        recorder = eventlog.EventRecorder(log_path)
+        backend, manager = run(events, [(BASE, code)])
+        recorder.close()
+        self.assertEqual(manager.hit_counts[0], 2)
+
+        recorder = None
+        log = eventlog.EventLog(log_path)
+        try:
+            events = list(log)
+        finally:
+            log.close()
+        # Memory isn't logged: the replay needs it set up
+        self.assertRaises(dbg.NtStatusError, run, events, [])
+        replayed, replayed_manager = run(events, [(BASE, code)])
+        self.assertEqual(list(replayed_manager.hit_counts), list(manager.hit_counts))
+        self.assertEqual(replayed.vmem_read(HPROC, BASE + 0x10, 1), '\xCC')
+        self.assertEqual(replayed.contexts[HTHREAD].eip, BASE + 0x11)
+#
+if __name__ == '__main__':
+    unittest.main()
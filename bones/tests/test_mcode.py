@@ -0,0 +1,33 @@
+import unittest
+import mcode
+
+class AddressTableTest(unittest.TestCase):
+    CODES = (
+        '\x8B\x04\x91',         # mov eax, [ecx+edx*4]
+        '\x8B\x44\x24\x10',     # mov eax, [esp+10]
+        '\x67\x8B\x00',         # mov eax, [bx+si]
+        '\x67\x8B\x47\xFE',     # mov eax, [bx-2]
+        '\x67\x8B\x42\x7F',     # mov eax, [bp+si+7f]
+        '\x90',                 # nop
+    )
+    ROWS = (
+        (0x11110000, 0x00500000, 0x00001234, 0x2222FFFF, 0x0012F000, 0x0012F100, 0x33330002, 0x44440000),
+        (0xFFFFFFFF, 0xFFFF0000, 0x40000000, 0x00000001, 0x00000000, 0x0000FFF0, 0x0000FFFF, 0x12345678),
+    )
+
+    @unittest.skipIf(mcode.numpy is None, 'NumPy is not available')
+    def test_matches_scalar_evaluate(self):
+        insns = [mcode.decode(mcode.State(mcode.StringReader(code))) for code in self.CODES]
+        table = mcode.AddressTable(insns)
+        ids = [i for i in xrange(len(insns)) for row in self.ROWS]
+        rows = [row for i in xrange(len(insns)) for row in self.ROWS]
+        addresses, valid = table.evaluate(ids, rows)
+        for k, (i, row) in enumerate(zip(ids, rows)):
+            refs = mcode.memory_operands(insns[i])
+            self.assertEqual(bool(valid[k]), bool(refs))
+            if refs:
+                context = dict(zip(mcode.TABLE_REGISTERS, row))
+                self.assertEqual(int(addresses[k]), refs[0].evaluate(context), self.CODES[i].encode('hex'))
+#
+if __name__ == '__main__':
+    unittest.main()
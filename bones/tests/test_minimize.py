@@ -0,0 +1,39 @@
+import unittest
+import minimize
+
+class FakeMutation(object):
+    def __init__(self, n):
+        self.n = n
+        self.active = True
+#
+def contains(*wanted):
+    "Oracle: fails iff all the wanted mutations are active"
+    def oracle(mutations):
+        active = set(m.n for m in mutations if m.active)
+        return all(n in active for n in wanted)
+    return oracle
+
+class MinimizerTest(unittest.TestCase):
+    def test_one_minimal(self):
+        mutations = [FakeMutation(i) for i in xrange(16)]
+        result = minimize.Minimizer(mutations, contains(3, 7)).minimize()
+        self.assertEqual([m.n for m in result], [3, 7])
+        self.assertEqual([m.n for m in mutations if m.active], [3, 7])
+
+    def test_parallel_matches_serial(self):
+        mutations = [FakeMutation(i) for i in xrange(16)]
+        result = minimize.Minimizer(mutations, contains(3, 7), workers=4).minimize()
+        self.assertEqual([m.n for m in result], [3, 7])
+
+    def test_single_culprit(self):
+        mutations = [FakeMutation(i) for i in xrange(9)]
+        result = minimize.Minimizer(mutations, contains(8)).minimize()
+        self.assertEqual([m.n for m in result], [8])
+
+    def test_not_reproducing(self):
+        mutations = [FakeMutation(i) for i in xrange(4)]
+        m = minimize.Minimizer(mutations, contains(9))
+        self.assertRaises(ValueError, m.minimize)
+#
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+import monitor
+import replay
+
+class RecordingMonitor(monitor.ProcessMonitor):
+    def __init__(self, ticks, **kwargs):
+        monitor.ProcessMonitor.__init__(self, source=replay.ReplayProcessSource(ticks), **kwargs)
+        self.events = []
+    def on_process_idle(self, process_id):
+        self.events.append((process_id, monitor.IDLE))
+    def on_process_hung(self, process_id):
+        self.events.append((process_id, monitor.HUNG))
+    def on_process_finding(self, process_id, finding):
+        self.events.append((process_id, finding))
+
+def run(m, ticks):
+    "Update once per tick; the tick index of each event"
+    found = []
+    for i in xrange(ticks):
+        count = len(m.events)
+        m.update()
+        found.extend((i,) + e for e in m.events[count:])
+    return found
+
+def busy_then_quiet(busy, quiet, step=1000):
+    "CPU time series: `busy` ticks of `step` more time each, then `quiet` flat ones"
+    return [step * (i + 1) for i in xrange(busy)] + [step * busy] * quiet
+
+class BatchedUpdateTest(unittest.TestCase):
+    def test_idle_processes_leave_the_batch(self):
+        a = busy_then_quiet(2, 6)
+        b = busy_then_quiet(5, 6)
+        m = RecordingMonitor([{1: (0, a[i]), 2: (0, b[i])} for i in xrange(8)])
+        m.track_process(1)
+        m.track_process(2)
+        self.assertEqual(run(m, 8), [(5, 1, monitor.IDLE)])
+        self.assertEqual(m.contexts.keys(), [2])
+        self.assertEqual(len(m.series[1]), 6)
+        self.assertEqual(len(m.series[2]), 8)
+
+    def test_missing_processes_skipped(self):
+        m = RecordingMonitor([{1: (0, 1000)}, {}, {1: (0, 2000)}])
+        m.track_process(1)
+        run(m, 3)
+        self.assertEqual(m.contexts[1]['samples'], 2)
+        self.assertEqual(m.contexts[1]['user_time'], 2000)
+
+class AdaptiveIdleModelTest(unittest.TestCase):
+    def setUp(self):
+        self.model = monitor.AdaptiveIdleModel(calibration_runs=3, sample_interval=0.0001)
+        # Three clean runs, each 5 busy samples to 5000 CPU time
+        series = busy_then_quiet(5, 4)
+        ticks = [dict((pid, (0, series[i])) for pid in (1, 2, 3)) for i in xrange(len(series))]
+        m = RecordingMonitor(ticks, model=self.model)
+        for pid in (1, 2, 3):
+            m.track_process(pid)
+        run(m, len(ticks))
+
+    def test_calibration(self):
+        self.assertTrue(self.model.calibrated)
+        self.assertEqual(self.model.done_cpu, 5000)
+        self.assertEqual(self.model.hang_cpu, 7500)
+        self.assertAlmostEqual(self.model.timeout, 9 * 1.5 * 0.0001)
+
+    def test_calibrated_verdicts(self):
+        done = busy_then_quiet(5, 5)
+        short = busy_then_quiet(2, 8)
+        busy = busy_then_quiet(10, 0)
+        m = RecordingMonitor([{1: (0, done[i]), 2: (0, short[i]), 3: (0, busy[i])} for i in xrange(10)],
+            model=self.model)
+        for pid in (1, 2, 3):
+            m.track_process(pid)
+        self.assertEqual(run(m, 10), [
+            # Quiet after the usual CPU time: done at once
+            (5, 1, monitor.IDLE),
+            # Quiet too early: waits out the inactive samples
+            (5, 2, monitor.IDLE),
+            # Busy past the calibrated top: hung
+            (7, 3, monitor.HUNG)])
+
+    def test_uncalibrated_uses_fixed_heuristic(self):
+        model = monitor.AdaptiveIdleModel(calibration_runs=3)
+        series = busy_then_quiet(5, 5)
+        m = RecordingMonitor([{1: (0, t)} for t in series], model=model)
+        m.track_process(1)
+        self.assertEqual(run(m, 10), [(8, 1, monitor.IDLE)])
+        self.assertFalse(model.calibrated)
+
+class ResourceLimitsTest(unittest.TestCase):
+    def series(self, *rows):
+        series = monitor.ResourceSeries()
+        for row in rows:
+            series.append(*row)
+        return series
+
+    def test_check(self):
+        limits = monitor.ResourceLimits(max_private_bytes=1000, max_handles=100, max_handle_growth=10)
+        self.assertEqual(limits.check(self.series((0, 500, 50, 1))), None)
+        self.assertEqual(limits.check(self.series((0, 1001, 50, 1))), monitor.MEMORY_EXHAUSTION)
+        self.assertEqual(limits.check(self.series((0, 0, 101, 1))), monitor.HANDLE_LEAK)
+        self.assertEqual(limits.check(self.series((0, 0, 50, 1), (0, 0, 61, 1))), monitor.HANDLE_LEAK)
+        self.assertEqual(monitor.ResourceLimits().check(self.series((1 << 30, 1 << 30, 10000, 1))), None)
+
+    def test_findings_reported(self):
+        ticks = [{1: (0, 1000 * i, 0, 100 * i, 10, 1), 2: (0, 1000 * i, 0, 0, 10 + 5 * i, 1)}
+            for i in xrange(1, 5)]
+        m = RecordingMonitor(ticks, limits=monitor.ResourceLimits(max_private_bytes=250, max_handle_growth=12))
+        m.track_process(1)
+        m.track_process(2)
+        self.assertEqual(run(m, 4), [(2, 1, monitor.MEMORY_EXHAUSTION), (3, 2, monitor.HANDLE_LEAK)])
+        self.assertEqual(list(m.series[1].private_bytes), [100, 200, 300])
+        self.assertEqual(m.contexts, {})
+#
+if __name__ == '__main__':
+    unittest.main()
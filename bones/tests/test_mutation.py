@@ -0,0 +1,130 @@
+import os
+import random
+import shutil
+import cPickle
+import tempfile
+import unittest
+import StringIO
+import mutation
+
+def naive_splice_points(a, b, min_match=4):
+    grams = {}
+    for j in xrange(len(b) - min_match + 1):
+        grams.setdefault(b[j:j + min_match], j)
+    return [(i, grams[a[i:i + min_match]]) for i in xrange(1, len(a) - min_match + 1)
+        if a[i:i + min_match] in grams]
+
+class TokenMutatorTest(unittest.TestCase):
+    def test_short_seed_has_no_tokens(self):
+        tokens = mutation.SeedTokens('\x01\x02')
+        self.assertEqual(tokens.pick_similar(None), None)
+        self.assertRaises(mutation.MutationUnavailable, mutation.TokenInserter, 2, tokens)
+        self.assertRaises(mutation.MutationUnavailable, mutation.TokenReplacer, 2, tokens)
+        self.assertRaises(mutation.MutationUnavailable, mutation.TokenDeleter, 2, tokens)
+
+    def test_unavailable_mutators_dropped(self):
+        tokens = mutation.SeedTokens('\x01\x02')
+        mutators = mutation.token_mutators(tokens)
+        self.assertEqual(mutation.generate_mutations(mutators, 2, 4), [])
+        scheduler = mutation.MutatorScheduler()
+        mutations = mutation.generate_mutations(mutators + [mutation.BitFlipper], 2, 4, scheduler)
+        self.assertTrue(mutations)
+        self.assertTrue(all(m.arm == 'BitFlipper' for m in mutations))
+        self.assertEqual(scheduler.mutator_stats['TokenInserter'][0], 0)
+        self.assertEqual(scheduler.mutator_stats['BitFlipper'][0], len(mutations))
+
+    def apply(self, m, data):
+        fp = StringIO.StringIO(data)
+        m.apply(fp)
+        return fp.getvalue()
+
+    def test_token_sizes(self):
+        random.seed(2)
+        data = 'xxHELLOxxxWORLDxHIxx'
+        tokens = mutation.SeedTokens(data, ['HELLO', 'WORLD', 'HI', 'BYE'])
+        for i in xrange(50):
+            m = mutation.TokenInserter(len(data), tokens)
+            result = self.apply(m, data)
+            self.assertEqual(len(result), len(data) + len(m.value))
+            self.assertEqual(result[:m.offset] + result[m.offset + len(m.value):], data)
+            m = mutation.TokenReplacer(len(data), tokens)
+            self.assertEqual(data[m.offset:m.offset + m.size], m.old_value)
+            result = self.apply(m, data)
+            self.assertEqual(len(result), len(data) - len(m.old_value) + len(m.value))
+            self.assertEqual(result[m.offset:m.offset + len(m.value)], m.value)
+            m = mutation.TokenDeleter(len(data), tokens)
+            self.assertEqual(len(self.apply(m, data)), len(data) - len(m.value))
+#
+class TokenIndexTest(unittest.TestCase):
+    def test_scan_matches_naive(self):
+        rng = random.Random(4)
+        for round in xrange(20):
+            tokens = [''.join(rng.choice('ab') for i in xrange(rng.randint(1, 5))) for j in xrange(rng.randint(1, 8))]
+            data = ''.join(rng.choice('abc') for i in xrange(200))
+            naive = {}
+            for token in set(tokens):
+                offsets = [i for i in xrange(len(data)) if data.startswith(token, i)]
+                if offsets:
+                    naive[token] = offsets
+            hits = mutation.TokenIndex(tokens).scan(data)
+            self.assertEqual(dict((t, sorted(o)) for t, o in hits.iteritems()), naive)
+
+    def test_empty(self):
+        self.assertEqual(mutation.TokenIndex(['']).scan('abc'), {})
+        self.assertEqual(mutation.TokenIndex(['ab']).scan(''), {})
+#
+class SplicePointsTest(unittest.TestCase):
+    def test_matches_naive(self):
+        rng = random.Random(1)
+        a = ''.join(chr(rng.randint(0, 3)) for i in xrange(300))
+        b = ''.join(chr(rng.randint(0, 3)) for i in xrange(200))
+        for min_match in (4, 6):
+            self.assertEqual(mutation.find_splice_points(a, b, min_match), naive_splice_points(a, b, min_match))
+
+    def test_short_inputs(self):
+        self.assertEqual(mutation.find_splice_points('abc', 'abcd'), [])
+        self.assertEqual(mutation.find_splice_points('xabcd', 'abcd'), [(1, 0)])
+#
+class SplicerTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_pure_and_compact(self):
+        seed = 'HEADER--' + 'a' * 32 + 'SHARED-PART' + 'b' * 16
+        donor = 'zz' + 'SHARED-PART' + 'DONOR-TAIL'
+        path = os.path.join(self.path, 'donor')
+        with open(path, 'wb') as fp:
+            fp.write(donor)
+        donors = mutation.SpliceDonors(seed, [path])
+        m = mutation.splice_mutator(donors)(len(seed))
+        self.assertEqual(seed[m.offset:m.offset + 4], donor[m.donor_offset:m.donor_offset + 4])
+        results = []
+        for i in xrange(2):
+            fp = StringIO.StringIO(seed)
+            m.apply(fp)
+            results.append(fp.getvalue())
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], seed[:m.offset] + donor[m.donor_offset:])
+        self.assertTrue(donor not in cPickle.dumps(m))
+#
+class SchedulerTest(unittest.TestCase):
+    def test_pulls_and_rewards_per_mutation(self):
+        scheduler = mutation.MutatorScheduler()
+        mutations = mutation.generate_mutations([mutation.BitFlipper], 16, 4, scheduler)
+        scheduler.reward(mutations, crashes=1)
+        pulls, reward = scheduler.mutator_stats['BitFlipper']
+        self.assertEqual(pulls, len(mutations))
+        self.assertEqual(reward, len(mutations) * 1.0)
+        self.assertEqual(scheduler.count_stats[len(mutations)], [1, 1.0])
+
+    def test_unscheduled_mutations(self):
+        scheduler = mutation.MutatorScheduler()
+        mutations = mutation.generate_mutations([mutation.ByteSetter], 16, 3)
+        scheduler.reward(mutations, hangs=1)
+        self.assertEqual(scheduler.mutator_stats['ByteSetter'], [3, 1.5])
+        self.assertEqual(scheduler.count_stats[3], [1, 0.5])
+#
+if __name__ == '__main__':
+    unittest.main()
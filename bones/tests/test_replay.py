@@ -0,0 +1,47 @@
+import unittest
+import dbg
+import replay
+
+PID, HPROC, TID, HTHREAD = 1, 0x10, 4, 0x20
+BASE = 0x400000
+
+def start(events=(), regions=()):
+    "A debugger stopped after process creation, with the given memory"
+    backend = replay.ReplayBackend([('context', HTHREAD, replay.Context(eip=BASE + 0x1000)),
+        ('_on_process_create', PID, HPROC, TID, HTHREAD, BASE, BASE + 0x1000)] + list(events))
+    for base, data, protect in regions:
+        backend.add_region(HPROC, base, data, protect, 'a.exe')
+    debugger = dbg.Debugger(backend)
+    backend.wait_event()
+    return debugger, backend
+#
+class ReplayMemoryTest(unittest.TestCase):
+    def test_protection_is_per_page(self):
+        debugger, backend = start(regions=[(BASE, '\x90' * 0x3000, dbg.Process.PAGE_EXECUTE_READ)])
+        old = backend.vmem_protect(HPROC, BASE + 0x1000, 0x1000, dbg.Process.PAGE_EXECUTE_READWRITE)
+        self.assertEqual(old, dbg.Process.PAGE_EXECUTE_READ)
+        self.assertEqual(backend.vmem_query(HPROC, BASE)[1:4],
+            (0x1000, dbg.Process.PAGE_EXECUTE_READ, dbg.Process.PAGE_EXECUTE_READ))
+        self.assertEqual(backend.vmem_query(HPROC, BASE + 0x1800)[1:4],
+            (0x1000, dbg.Process.PAGE_EXECUTE_READ, dbg.Process.PAGE_EXECUTE_READWRITE))
+        self.assertEqual(backend.vmem_query(HPROC, BASE + 0x2000)[1], 0x1000)
+
+    def test_breakpoint_on_second_page_restores_protection(self):
+        debugger, backend = start(regions=[(BASE, '\x90' * 0x2000, dbg.Process.PAGE_EXECUTE_READ)])
+        manager = debugger.processes[PID].breakpoint_manager
+        manager.arm([BASE + 0x10], persistent=True)
+        manager.arm([BASE + 0x1010], persistent=True)
+        self.assertEqual(manager.writable_pages[BASE + 0x1000], dbg.Process.PAGE_EXECUTE_READ)
+        manager.disarm()
+        for page in (BASE, BASE + 0x1000):
+            self.assertEqual(backend.vmem_query(HPROC, page)[3], dbg.Process.PAGE_EXECUTE_READ)
+        self.assertEqual(backend.vmem_read(HPROC, BASE + 0x1010, 1), '\x90')
+
+    def test_write_wants_str(self):
+        debugger, backend = start(regions=[(BASE, '\0' * 0x1000, dbg.Process.PAGE_READWRITE)])
+        self.assertRaises(TypeError, backend.vmem_write, HPROC, BASE, bytearray('ab'))
+        backend.vmem_write(HPROC, BASE, 'ab')
+        self.assertEqual(backend.vmem_read(HPROC, BASE, 2), 'ab')
+#
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import time
+import itertools
+import unittest
+import monitor
+import replay
+import runner
+from tests.test_replay import PID, HPROC, TID, HTHREAD, BASE
+
+class TimedBackend(replay.ReplayBackend):
+    "Replays the events, then waits out the timeouts; terminated processes exit"
+    def __init__(self, events):
+        replay.ReplayBackend.__init__(self, events)
+        self.timeouts = []
+        self.exits = []
+    def process_terminate(self, handle, exit_code):
+        replay.ReplayBackend.process_terminate(self, handle, exit_code)
+        self.exits.append(exit_code)
+    def wait_event(self, timeout=None):
+        self.timeouts.append(timeout)
+        if self.exits:
+            self._handlers['_on_process_exit'](PID, self.exits.pop(0))
+            return True
+        if replay.ReplayBackend.wait_event(self):
+            return True
+        time.sleep(timeout / 1000.0)
+        return False
+#
+def busy():
+    "CPU time samples of a process that never idles"
+    return ({PID: (0, 1000 * i)} for i in itertools.count(1))
+
+class TargetRunnerTest(unittest.TestCase):
+    def start(self, **kwargs):
+        self.backend = TimedBackend([('context', HTHREAD, replay.Context(eip=BASE + 0x1000)),
+            ('_on_process_create', PID, HPROC, TID, HTHREAD, BASE, BASE + 0x1000)])
+        self.backend.add_region(HPROC, BASE, '\0' * 0x1000, name='a.exe')
+        r = runner.TargetRunner(backend=self.backend, monitor_source=replay.ReplayProcessSource(busy()),
+            sample_interval=0.01, **kwargs)
+        r.start('a.exe')
+        return r
+
+    def run_out(self, r):
+        started = time.time()
+        while not r.done:
+            r.update()
+        return time.time() - started
+
+    def test_update_returns_per_sample(self):
+        r = self.start()
+        for samples in (1, 2, 3):
+            r.update()
+            self.assertEqual(len(r.resources[PID]), samples)
+        self.assertFalse(r.done)
+        self.assertTrue(max(self.backend.timeouts) <= 10)
+
+    def test_time_budget(self):
+        r = self.start(time_budget=0.05)
+        elapsed = self.run_out(r)
+        self.assertTrue(r.timed_out)
+        self.assertTrue(HPROC in self.backend.terminated)
+        self.assertTrue(0.04 <= elapsed < 1.0)
+
+    def test_model_timeout(self):
+        model = monitor.IdleModel()
+        model.timeout = 0.05
+        r = self.start(idle_model=model)
+        elapsed = self.run_out(r)
+        self.assertTrue(r.timed_out)
+        self.assertTrue(0.04 <= elapsed < 1.0)
+
+    def test_budget_overrides_model(self):
+        model = monitor.IdleModel()
+        model.timeout = 10.0
+        r = self.start(idle_model=model, time_budget=0.02)
+        self.assertTrue(self.run_out(r) < 1.0)
+        self.assertTrue(r.timed_out)
+#
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import struct
+import unittest
+import dbg
+import stack
+from formats import pe
+from tests.test_replay import start, PID, BASE
+import replay
+
+STACK = 0x100000
+
+def image(sections, size=0x4000):
+    """Headers of a PE32 image with (name, rva, size, characteristics) sections.
+
+    The result is `size` bytes: the headers, the rest zeros.
+    """
+    headers = bytearray(size)
+    struct.pack_into('<2s', headers, 0, 'MZ')
+    struct.pack_into('<I', headers, 0x3C, 0x40)
+    struct.pack_into('<4sHHIIIHH', headers, 0x40, 'PE\0\0', 0x14C, len(sections), 0, 0, 0, 0xE0, 0x102)
+    optional = 0x40 + 24
+    struct.pack_into('<H', headers, optional, pe.OPTIONAL_MAGIC_PE32)
+    struct.pack_into('<I', headers, optional + 28, BASE)
+    struct.pack_into('<II', headers, optional + 56, size, 0x1000)
+    struct.pack_into('<I', headers, optional + 92, 16)
+    offset = optional + 0xE0
+    for name, rva, length, characteristics in sections:
+        struct.pack_into('<8sIIIIIIHHI', headers, offset, name, length, rva, length, rva, 0, 0, 0, 0, characteristics)
+        offset += 40
+    return headers
+
+class WalkStackTest(unittest.TestCase):
+    def setUp(self):
+        code = image([('.text', 0x1000, 0x1000, pe.SCN_MEM_EXECUTE), ('.data', 0x2000, 0x1000, 0)])
+        # call rel32 just before .text+0x20
+        code[0x101B:0x1020] = '\xE8\0\0\0\0'
+        stack_data = struct.pack('<III', BASE + 0x2020, BASE + 0x1020, 0) + '\0' * 0xFF4
+        self.debugger, self.backend = start(regions=[
+            (BASE, str(code), dbg.Process.PAGE_EXECUTE_READ),
+            (STACK, stack_data, dbg.Process.PAGE_READWRITE)])
+        self.process = self.debugger.processes[PID]
+        self.thread = self.process.threads.values()[0]
+
+    def walk(self, **kwargs):
+        context = replay.Context(eip=BASE + 0x1010, esp=STACK, ebp=0)
+        return list(stack.walk_stack(self.thread, context, **kwargs))
+
+    def test_scan_skips_data_sections(self):
+        self.assertEqual(self.walk(check_calls=False), [BASE + 0x1010, BASE + 0x1020])
+        self.assertEqual(self.walk(), [BASE + 0x1010, BASE + 0x1020])
+
+    def test_reads_through_page_cache(self):
+        self.walk()
+        self.assertEqual(self.process.cache, None)
+        self.process.enable_cache()
+        self.walk()
+        self.assertTrue(self.process.cache.hits > 0)
+        # The stack page and the code page
+        self.assertEqual(self.process.cache.misses, 2)
+#
+if __name__ == '__main__':
+    unittest.main()
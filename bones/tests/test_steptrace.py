@@ -0,0 +1,142 @@
+import os
+import array
+import random
+import shutil
+import tempfile
+import unittest
+import dbg
+import replay
+import steptrace
+from tests.test_replay import start, PID, HTHREAD, TID, BASE
+
+def row(i):
+    return array.array('I', [(i * 0x1001 + r * 0x10) & 0xFFFFFFFF for r in xrange(steptrace.ROW)])
+
+class RingBufferTest(unittest.TestCase):
+    def test_partial(self):
+        ring = steptrace.RingBuffer(4)
+        self.assertEqual(list(ring.last()), [])
+        ring.append(1)
+        ring.append(2)
+        self.assertEqual(len(ring), 2)
+        self.assertEqual(list(ring.last()), [1, 2])
+        self.assertEqual(list(ring.last(1)), [2])
+        self.assertEqual(ring.last_rows(), None)
+
+    def test_wraparound(self):
+        ring = steptrace.RingBuffer(4, registers=True)
+        for i in xrange(10):
+            ring.append(i, row(i))
+        self.assertEqual(len(ring), 4)
+        self.assertEqual(list(ring.last()), [6, 7, 8, 9])
+        self.assertEqual(list(ring.last(3)), [7, 8, 9])
+        self.assertEqual(list(ring.last(100)), [6, 7, 8, 9])
+        self.assertEqual(list(ring.last(0)), [])
+        self.assertEqual(list(ring.last_rows(2)), list(row(8) + row(9)))
+        # Exactly full: the span starts at slot 0
+        for i in xrange(10, 12):
+            ring.append(i, row(i))
+        self.assertEqual(list(ring.last()), [8, 9, 10, 11])
+#
+class TraceFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'trace')
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, eips, registers=False, block_size=4, code={}):
+        w = steptrace.TraceWriter(self.path, registers, block_size)
+        for i, eip in enumerate(eips):
+            w.append(eip, row(i) if registers else None)
+        for eip, data in code.iteritems():
+            w.add_code(eip, data)
+        w.close()
+        return steptrace.TraceReader(self.path)
+
+    def test_blocks_with_registers(self):
+        random.seed(3)
+        eips = [random.choice((BASE, 0xFFFFFFF0, 0, BASE + random.randrange(0x1000))) for i in xrange(23)]
+        r = self.write(eips, registers=True, block_size=5)
+        try:
+            self.assertTrue(r.registers)
+            self.assertEqual(len(r), 23)
+            self.assertEqual(len(r.offsets), 5)
+            self.assertEqual([r[i] for i in xrange(23)], eips)
+            # Out of order, across blocks
+            for i in (22, 0, 7, 5, 4, 19):
+                self.assertEqual(r[i], eips[i])
+                self.assertEqual(r.row(i), dict(zip(steptrace.REGISTERS, row(i))))
+            self.assertEqual(list(r.eips(3, 12)), eips[3:12])
+            self.assertEqual(list(r.eips(20, 100)), eips[20:])
+            self.assertRaises(IndexError, r.__getitem__, 23)
+        finally:
+            r.close()
+
+    def test_without_registers(self):
+        r = self.write([1, 2, 3])
+        try:
+            self.assertFalse(r.registers)
+            self.assertEqual(r.row(1), None)
+            self.assertEqual(list(r.eips()), [1, 2, 3])
+        finally:
+            r.close()
+
+    def test_code_and_decode(self):
+        code = {BASE: '\x8B\x45\x08', BASE + 3: '\x90', BASE + 4: '\xFF\xFF'}
+        r = self.write([BASE, BASE + 3, BASE], code=code)
+        try:
+            self.assertEqual(r.code(BASE), '\x8B\x45\x08')
+            self.assertEqual(r.code(BASE + 8), None)
+            insns = r.decode([BASE, BASE + 3, BASE, BASE + 4, BASE + 8])
+            self.assertEqual([i and i.mnemonic for i in insns], ['mov', 'nop', 'mov', None, None])
+            self.assertTrue(insns[0] is insns[2])
+        finally:
+            r.close()
+
+    def test_not_a_trace(self):
+        with open(self.path, 'wb') as fp:
+            fp.write('\0' * 64)
+        self.assertRaises(ValueError, steptrace.TraceReader, self.path)
+#
+class TracerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.debugger, self.backend = start(regions=[(BASE, '\x90' * 0x1000, dbg.Process.PAGE_EXECUTE_READ)])
+        self.thread = self.debugger.processes[PID].threads[TID]
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def step(self, tracer, eip, **regs):
+        self.backend.contexts[HTHREAD] = replay.Context(eip=eip, **regs)
+        tracer.on_single_step(self.thread)
+
+    def test_on_single_step(self):
+        tracer = steptrace.Tracer(ring_size=2, registers=True, path=self.dir)
+        tracer.on_thread_create(self.thread)
+        self.assertTrue(self.thread.tracing)
+        for i in xrange(3):
+            self.step(tracer, BASE + i, eax=i)
+            self.assertTrue(self.backend.contexts[HTHREAD].eflags.tf)
+        self.assertEqual(list(tracer.last(self.thread)), [BASE + 1, BASE + 2])
+        rows = tracer.rings[PID, TID].last_rows(1)
+        self.assertEqual(dict(zip(steptrace.REGISTERS, rows))['eax'], 2)
+        tracer.on_thread_exit(self.thread)
+        self.assertFalse(self.thread.tracing)
+        r = steptrace.TraceReader(os.path.join(self.dir, '%d_%d.trace' % (PID, TID)))
+        try:
+            self.assertEqual(list(r.eips()), [BASE, BASE + 1, BASE + 2])
+            self.assertEqual(r.row(1)['eax'], 1)
+            self.assertEqual(r.code(BASE), '\x90' * steptrace.CODE_SIZE)
+        finally:
+            r.close()
+
+    def test_untraced_thread_ignored(self):
+        tracer = steptrace.Tracer(select=lambda thread: False)
+        tracer.on_thread_create(self.thread)
+        self.step(tracer, BASE)
+        self.assertFalse(self.backend.contexts[HTHREAD].eflags.tf)
+        self.assertEqual(tracer.last(self.thread), None)
+#
+if __name__ == '__main__':
+    unittest.main()
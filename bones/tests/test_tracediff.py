@@ -0,0 +1,51 @@
+import os
+import array
+import shutil
+import tempfile
+import unittest
+import steptrace
+import tracediff
+
+class OpenTraceTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write_raw(self, name, eips):
+        path = os.path.join(self.path, name)
+        with open(path, 'wb') as fp:
+            fp.write(array.array('I', eips).tostring())
+        return path
+
+    def test_short_raw_files(self):
+        for count in (0, 1, 2, 7):
+            t = tracediff.open_trace(self.write_raw('raw%d' % count, range(count)))
+            try:
+                self.assertTrue(isinstance(t, tracediff.RawTrace))
+                self.assertEqual(list(t.eips()), range(count))
+            finally:
+                t.close()
+
+    def test_trace_file(self):
+        path = os.path.join(self.path, 'trace')
+        w = steptrace.TraceWriter(path, block_size=4)
+        for eip in (1, 2, 3, 4, 5):
+            w.append(eip)
+        w.close()
+        t = tracediff.open_trace(path)
+        try:
+            self.assertTrue(isinstance(t, steptrace.TraceReader))
+            self.assertEqual(len(t), 5)
+        finally:
+            t.close()
+
+    def test_diff_files(self):
+        crash = self.write_raw('crash', [1, 2, 3, 9, 5])
+        benign = self.write_raw('benign', [1, 2, 3, 4, 5])
+        d = tracediff.diff_files(crash, benign, window=1)
+        self.assertEqual(d.divergence, 3)
+        self.assertEqual(list(d.unique), [9])
+#
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+import triage
+
+class Info(object):
+    code = triage.STATUS_ACCESS_VIOLATION
+    def __init__(self, kind, target, address=0x401000):
+        self.kind = kind
+        self.target = target
+        self.address = address
+
+class Evidence(object):
+    def __init__(self, code, kind, target, **registers):
+        self.code = code
+        self.info = Info(kind, target)
+        self.registers = dict(eip=0x401000, esp=0x12F000, **registers)
+
+class CulpritTest(unittest.TestCase):
+    def test_faulting_operand_found(self):
+        # movs dword es:[edi], dword ds:[esi]: the read from esi faulted
+        v = triage.analyze(Evidence('\xA5', 'read', 0x41414141, esi=0x41414141, edi=0x500000))
+        self.assertEqual((v.classification, v.culprit), ('tainted-read', 'esi'))
+        v = triage.analyze(Evidence('\xA5', 'write', 0x12, esi=0x500000, edi=0x12))
+        self.assertEqual((v.classification, v.culprit), ('null-write', 'edi'))
+
+    def test_index_astray(self):
+        # mov eax, [ecx+edx*4]: a sane pointer, an index past the end
+        v = triage.analyze(Evidence('\x8B\x04\x91', 'read', 0x520000, ecx=0x500000, edx=0x8000))
+        self.assertEqual(v.culprit, 'edx')
+
+    def test_null_base(self):
+        v = triage.analyze(Evidence('\x8B\x04\x91', 'read', 0x20, ecx=0, edx=8))
+        self.assertEqual((v.classification, v.culprit), ('null-read', 'ecx'))
+
+    def test_inside_access(self):
+        # A dword read straddling into an unmapped page faults past its start
+        v = triage.analyze(Evidence('\x8B\x04\x91', 'read', 0x501000, ecx=0x500FFE, edx=0))
+        self.assertEqual(v.culprit, 'ecx')
+
+    def test_guess_without_match(self):
+        v = triage.analyze(Evidence('\x8B\x04\x91', 'read', 0x12345678, ecx=0x10, edx=0))
+        self.assertEqual(v.culprit, 'ecx')
+
+    def test_missing_register(self):
+        v = triage.analyze(Evidence('\x8B\x04\x91', 'read', 0x12345678, ecx=0x10))
+        self.assertEqual(v.culprit, 'ecx')
+
+    def test_16bit_addressing(self):
+        # mov eax, [bx]: the low half of ebx
+        v = triage.analyze(Evidence('\x67\x8B\x07', 'read', 0x10, ebx=0x12340010))
+        self.assertEqual((v.classification, v.culprit), ('null-read', 'bx'))
+
+    def test_lea_has_no_culprit(self):
+        # lea eax, [ecx+edx*4] computes, it doesn't access
+        v = triage.analyze(Evidence('\x8D\x04\x91', 'read', 0x20, ecx=0, edx=8))
+        self.assertEqual((v.classification, v.culprit), ('null-read', None))
+#
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,245 @@
+"""
+Layer 3 of the METALBONES core -- high-level code.
+
+Differencing a crashing trace against a benign one.
+
+Traces are sequences of executed addresses or basic-block ids: trace
+files (steptrace.TraceReader), flat little-endian u32 files (RawTrace), both
+memory-mapped, or plain arrays. They are compared a chunk at a time with
+array slice equality, so the common stretches cost next to nothing. At a
+divergence, the next `horizon` steps of the benign trace are indexed by
+windows of `window` steps and the crashing trace is scanned for the first
+window found there, which is where the runs fall back in step. Memory use
+is bounded by the chunk and horizon sizes, not the trace lengths.
+"""
+
+import os
+import mmap
+import array
+import bisect
+import struct
+import steptrace
+
+CHUNK = 1 << 16
+
+class RawTrace(object):
+    "A flat file of little-endian u32 addresses, memory-mapped"
+    def __init__(self, path):
+        self.fp = open(path, 'rb')
+        # Empty files can't be mapped
+        self.map = ''
+        if os.fstat(self.fp.fileno()).st_size:
+            self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.steps = len(self.map) // 4
+
+    def close(self):
+        if self.map:
+            self.map.close()
+        self.fp.close()
+
+    def __len__(self):
+        return self.steps
+
+    def eips(self, start=0, stop=None):
+        stop = self.steps if stop is None else min(stop, self.steps)
+        return array.array('I', self.map[start * 4:stop * 4])
+#
+def open_trace(path):
+    "Open a trace file, or a raw one if it doesn't look like a trace file"
+    try:
+        return steptrace.TraceReader(path)
+    except (ValueError, struct.error):
+        return RawTrace(path)
+
+def _slice(t, start, stop):
+    if hasattr(t, 'eips'):
+        return t.eips(start, stop)
+    return t[start:stop]
+
+class ModuleMap(object):
+    """Module ranges for symbolising addresses offline.
+
+    `modules` holds (base, size, name) triples.
+    """
+    def __init__(self, modules=()):
+        modules = sorted(modules)
+        self.bases = [m[0] for m in modules]
+        self.modules = modules
+
+    @classmethod
+    def from_process(cls, process):
+        return cls((m.base_address, m.mapped_size, m.name) for m in process.modules.itervalues())
+
+    def lookup(self, address):
+        "(name, offset) of the module containing the address, or None"
+        i = bisect.bisect_right(self.bases, address) - 1
+        if i < 0:
+            return None
+        base, size, name = self.modules[i]
+        if address - base >= size:
+            return None
+        return name, address - base
+
+    def symbolize(self, address):
+        found = self.lookup(address)
+        if found is None:
+            return '%08x' % address
+        return '%s+%08x' % found
+#
+def match_length(a, i, b, j, chunk=CHUNK):
+    "How many steps a[i:] and b[j:] have in common"
+    n = 0
+    limit = min(len(a) - i, len(b) - j)
+    while n < limit:
+        size = min(chunk, limit - n)
+        x = _slice(a, i + n, i + n + size)
+        y = _slice(b, j + n, j + n + size)
+        if x == y:
+            n += size
+            continue
+        # Narrow down by halves; slice compares are cheap
+        lo, hi = 0, size
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if x[lo:mid] == y[lo:mid]:
+                lo = mid
+            else:
+                hi = mid
+        return n + lo
+    return n
+
+def divergence(crash, benign, chunk=CHUNK):
+    "The first step at which the traces differ, or None if they are the same"
+    n = match_length(crash, 0, benign, 0, chunk)
+    if n == len(crash) == len(benign):
+        return None
+    return n
+
+class Hunk(object):
+    "crash[crash_start:crash_end] ran where benign[benign_start:benign_end] did"
+    def __init__(self, crash_start, crash_end, benign_start, benign_end):
+        self.crash_start = crash_start
+        self.crash_end = crash_end
+        self.benign_start = benign_start
+        self.benign_end = benign_end
+    def __str__(self):
+        return 'crash %d-%d (%d steps) vs benign %d-%d (%d steps)' % (
+            self.crash_start, self.crash_end, self.crash_end - self.crash_start,
+            self.benign_start, self.benign_end, self.benign_end - self.benign_start)
+#
+def _resync(crash, c, benign, b, window, horizon):
+    "Offsets from c and b where the traces agree again on `window` steps, or None"
+    theirs = _slice(benign, b, b + horizon)
+    ours = _slice(crash, c, c + horizon)
+    index = {}
+    data = theirs.tostring()
+    width = window * 4
+    for j in xrange(len(theirs) - window + 1):
+        index.setdefault(data[j * 4:j * 4 + width], j)
+    data = ours.tostring()
+    for i in xrange(len(ours) - window + 1):
+        j = index.get(data[i * 4:i * 4 + width])
+        if j is not None:
+            return i, j
+    return None
+
+def align(crash, benign, window=16, horizon=CHUNK, max_hunks=None, chunk=CHUNK):
+    """Yield the Hunks where the traces part ways, in order.
+
+    Runs that don't fall back in step within `horizon` steps end the
+    alignment with a hunk reaching to the end of both traces.
+    """
+    c = b = 0
+    hunks = 0
+    while max_hunks is None or hunks < max_hunks:
+        n = match_length(crash, c, benign, b, chunk)
+        c += n
+        b += n
+        if c >= len(crash) and b >= len(benign):
+            return
+        found = None
+        if c < len(crash) and b < len(benign):
+            found = _resync(crash, c, benign, b, window, horizon)
+        if found is None:
+            yield Hunk(c, len(crash), b, len(benign))
+            return
+        i, j = found
+        yield Hunk(c, c + i, b, b + j)
+        hunks += 1
+        c += i
+        b += j
+
+def distinct(t, chunk=CHUNK):
+    "The set of distinct addresses in the trace"
+    result = set()
+    for start in xrange(0, len(t), chunk):
+        result.update(_slice(t, start, start + chunk))
+    return result
+
+def unique_to(crash, benign, chunk=CHUNK):
+    "Sorted addresses the crashing trace ran and the benign one didn't"
+    return array.array('I', sorted(distinct(crash, chunk) - distinct(benign, chunk)))
+
+class TraceDiff(object):
+    """The difference between a crashing and a benign trace.
+
+    `divergence` is the first step that differs (None if none does); the
+    step before it is usually the branch that went the other way. `hunks`
+    are the regions where the runs disagree and `unique` the addresses
+    only the crashing run reached. Everything is worked out up front, so
+    the traces may be closed afterwards.
+    """
+    def __init__(self, crash, benign, modules=None, window=16, horizon=CHUNK, max_hunks=64, context=4):
+        self.modules = modules if modules is not None else ModuleMap()
+        self.steps = len(crash), len(benign)
+        self.divergence = d = divergence(crash, benign)
+        self.hunks = []
+        self.unique = array.array('I')
+        # The common steps leading up to the divergence, and the first of each run after it
+        self.context = array.array('I')
+        self.crash_next = self.benign_next = None
+        if d is not None:
+            self.hunks = list(align(crash, benign, window, horizon, max_hunks))
+            self.unique = unique_to(crash, benign)
+            self.context = _slice(crash, max(0, d - context), d)
+            if d < len(crash):
+                self.crash_next = _slice(crash, d, d + 1)[0]
+            if d < len(benign):
+                self.benign_next = _slice(benign, d, d + 1)[0]
+
+    def _name(self, address):
+        return '(end)' if address is None else self.modules.symbolize(address)
+
+    def report(self, max_unique=32):
+        "The diff as lines of text"
+        d = self.divergence
+        if d is None:
+            return ['Traces are identical (%d steps)' % self.steps[0]]
+        lines = ['Diverged at step %d of %d/%d' % ((d,) + self.steps)]
+        for i, address in enumerate(self.context):
+            lines.append('    %10d  %s' % (d - len(self.context) + i, self._name(address)))
+        lines.append('  crash  -> %s' % self._name(self.crash_next))
+        lines.append('  benign -> %s' % self._name(self.benign_next))
+        lines.append('%d hunk(s):' % len(self.hunks))
+        for hunk in self.hunks:
+            lines.append('    %s' % hunk)
+        lines.append('%d address(es) unique to the crash:' % len(self.unique))
+        for address in self.unique[:max_unique]:
+            lines.append('    %s' % self.modules.symbolize(address))
+        if len(self.unique) > max_unique:
+            lines.append('    ...')
+        return lines
+
+    def __str__(self):
+        return '\n'.join(self.report())
+#
+def diff_files(crash_path, benign_path, modules=None, **kwargs):
+    "TraceDiff of two trace files"
+    crash = open_trace(crash_path)
+    benign = open_trace(benign_path)
+    try:
+        return TraceDiff(crash, benign, modules, **kwargs)
+    finally:
+        crash.close()
+        benign.close()
+# EOF
@@ -0,0 +1,214 @@
+"""
+Layer 3 of the METALBONES core -- high-level code.
+
+Offline crash triage.
+
+Works on saved evidence only (see crashdb.CrashStore): the exception, the
+registers and the code bytes at eip. The faulting instruction is decoded
+with mcode to find the register that produced a bad address, the crash is
+classified and given a rough severity. Batches run in a process pool.
+"""
+
+import cPickle
+import multiprocessing
+import mcode
+
+# Severities, most severe first
+EXPLOITABLE = 'exploitable'
+PROBABLY_EXPLOITABLE = 'probably exploitable'
+PROBABLY_NOT_EXPLOITABLE = 'probably not exploitable'
+UNKNOWN = 'unknown'
+SEVERITIES = (EXPLOITABLE, PROBABLY_EXPLOITABLE, PROBABLY_NOT_EXPLOITABLE, UNKNOWN)
+
+STATUS_BREAKPOINT = 0x80000003
+STATUS_ACCESS_VIOLATION = 0xC0000005
+STATUS_ILLEGAL_INSTRUCTION = 0xC000001D
+STATUS_INTEGER_DIVIDE_BY_ZERO = 0xC0000094
+STATUS_PRIVILEGED_INSTRUCTION = 0xC0000096
+STATUS_STACK_OVERFLOW = 0xC00000FD
+STATUS_HEAP_CORRUPTION = 0xC0000374
+STATUS_STACK_BUFFER_OVERRUN = 0xC0000409
+
+# Addresses below this are taken for NULL plus an offset
+NEAR_NULL = 0x10000
+
+# Code -> (classification, severity) for the exceptions that need no analysis
+_simple = {
+    STATUS_BREAKPOINT: ('breakpoint', UNKNOWN),
+    STATUS_ILLEGAL_INSTRUCTION: ('illegal-instruction', PROBABLY_EXPLOITABLE),
+    STATUS_PRIVILEGED_INSTRUCTION: ('privileged-instruction', PROBABLY_EXPLOITABLE),
+    STATUS_INTEGER_DIVIDE_BY_ZERO: ('divide-by-zero', PROBABLY_NOT_EXPLOITABLE),
+    STATUS_STACK_OVERFLOW: ('stack-exhaustion', PROBABLY_NOT_EXPLOITABLE),
+    STATUS_HEAP_CORRUPTION: ('heap-corruption', EXPLOITABLE),
+    STATUS_STACK_BUFFER_OVERRUN: ('stack-smash', EXPLOITABLE),
+}
+
+class Verdict(object):
+    def __init__(self, classification, severity, instruction=None, culprit=None):
+        self.classification = classification
+        self.severity = severity
+        # The faulting instruction as text, if it could be decoded
+        self.instruction = instruction
+        # The register that produced the bad address, if found
+        self.culprit = culprit
+    def __str__(self):
+        text = '%s (%s)' % (self.classification, self.severity)
+        if self.instruction is not None:
+            text += ' at `%s`' % self.instruction
+        if self.culprit is not None:
+            text += ', bad %s' % self.culprit
+        return text
+#
+def decode(code):
+    "Decode the instruction at the start of the code bytes; None if impossible"
+    if not code:
+        return None
+    try:
+        return mcode.decode(mcode.State(mcode.StringReader(code)))
+    except (mcode.Error, IndexError):
+        return None
+
+def _looks_like_pattern(value):
+    "Whether all four bytes of the value are the same, as in 0x41414141"
+    b = value & 0xFF
+    return value == b * 0x01010101 and b not in (0x00, 0xFF)
+
+def _known_value(registers, reg):
+    "mcode._register_value(), or None if the register wasn't captured"
+    try:
+        return mcode._register_value(registers, reg)
+    except KeyError:
+        return None
+
+def _blame(memref, registers):
+    "The register of a memref known to have produced the bad address"
+    if memref.index is None or memref.base is None:
+        reg = memref.base or memref.index
+        return reg.name if reg is not None else None
+    # base + displacement is the pointer; if that looks sane, the index took it astray
+    pointer = mcode._register_value(registers, memref.base)
+    if memref.displ is not None:
+        pointer = (pointer + memref.displ.get_value()) & memref.address_mask()
+    if pointer >= NEAR_NULL and not _looks_like_pattern(pointer) and mcode._register_value(registers, memref.index):
+        return memref.index.name
+    return memref.base.name
+
+def _guess(memref, registers):
+    "The base or index register most likely to have produced the bad address"
+    base = index = None
+    if memref.base is not None:
+        base = _known_value(registers, memref.base)
+    if memref.index is not None:
+        index = _known_value(registers, memref.index)
+    if base is None and index is None:
+        return None
+    for reg, value in ((memref.base, base), (memref.index, index)):
+        if value is not None and _looks_like_pattern(value):
+            return reg.name
+    if base is not None and base < NEAR_NULL:
+        return memref.base.name
+    # A small index is normal; a large one has run away
+    if index is not None and (base is None or index >= NEAR_NULL):
+        return memref.index.name
+    return memref.base.name
+
+def _culprit(memrefs, registers, target):
+    """The base or index register that produced the bad address.
+
+    The memory operand whose access covers the target, evaluated with the
+    captured registers, is the one that faulted; failing that (no target,
+    a segment base, registers missing), the first one is guessed at from
+    its register values.
+    """
+    if target is not None:
+        for memref in memrefs:
+            try:
+                address = memref.evaluate(registers)
+            except KeyError:
+                continue
+            if address <= target < address + memref.access_size():
+                return _blame(memref, registers)
+    if memrefs:
+        return _guess(memrefs[0], registers)
+    return None
+
+def analyze(evidence):
+    "Classify one crash from its evidence; returns a Verdict"
+    info = evidence.info
+    code = info.code
+    if code in _simple:
+        return Verdict(*_simple[code])
+    if code != STATUS_ACCESS_VIOLATION:
+        return Verdict('unknown-exception', UNKNOWN)
+
+    registers = getattr(evidence, 'registers', None) or {}
+    eip = registers.get('eip', info.address)
+    kind = getattr(info, 'kind', None)
+    target = getattr(info, 'target', None)
+
+    # Execution faults: eip itself is bad
+    if kind == 'dep' or target == eip:
+        if _looks_like_pattern(eip) or _looks_like_pattern(registers.get('ebp', 0)):
+            return Verdict('stack-smash', EXPLOITABLE)
+        if eip < NEAR_NULL:
+            return Verdict('null-call', PROBABLY_EXPLOITABLE)
+        if kind == 'dep':
+            return Verdict('dep-violation', EXPLOITABLE)
+        return Verdict('wild-exec', EXPLOITABLE)
+
+    insn = decode(getattr(evidence, 'code', None))
+    text = culprit = None
+    if insn is not None:
+        text = mcode.Printer().print_insn(insn, 0).strip()
+        memrefs = []
+        if insn.mnemonic != 'lea':
+            # lea only computes its address; it never faults on it
+            memrefs = [op for op in insn.operands if isinstance(op, mcode.MemoryRef)]
+        culprit = _culprit(memrefs, registers, target)
+    if insn is not None and insn.mnemonic in ('push', 'call') and kind == 'write' and \
+            target is not None and abs(target - registers.get('esp', 0)) < 0x1000:
+        return Verdict('stack-exhaustion', PROBABLY_NOT_EXPLOITABLE, text, 'esp')
+
+    near_null = target is not None and target < NEAR_NULL
+    if kind == 'write':
+        if near_null:
+            return Verdict('null-write', PROBABLY_NOT_EXPLOITABLE, text, culprit)
+        return Verdict('wild-write', EXPLOITABLE, text, culprit)
+    if near_null:
+        return Verdict('null-read', PROBABLY_NOT_EXPLOITABLE, text, culprit)
+    if target is not None and _looks_like_pattern(target):
+        return Verdict('tainted-read', PROBABLY_EXPLOITABLE, text, culprit)
+    return Verdict('wild-read', UNKNOWN, text, culprit)
+
+def analyze_file(path):
+    "Load pickled evidence and analyze it; returns (path, verdict)"
+    with open(path, 'rb') as fp:
+        evidence = cPickle.load(fp)
+    return path, analyze(evidence)
+
+def triage(paths, workers=None, chunksize=64):
+    """Analyze the evidence files in a process pool.
+
+    Yields (path, verdict) in completion order.
+    """
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap_unordered(analyze_file, paths, chunksize):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def triage_store(store, workers=None):
+    """Triage every bucket of a crashdb.CrashStore.
+
+    Returns (bucket, verdict) pairs, most severe first.
+    """
+    buckets = dict((store.evidence_path(b), b) for b in store.buckets())
+    results = [(buckets[path], verdict) for path, verdict in triage(buckets.keys(), workers)]
+    results.sort(key=lambda r: (SEVERITIES.index(r[1].severity), -r[0].count))
+    return results
+# EOF